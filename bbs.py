@@ -4,16 +4,16 @@ import uuid
 import json
 from datetime import datetime
 from pathlib import Path
+import shutil
 import tempfile
 
-from db import init_db, connect
-from sync import SyncEngine
-from radio import RadioInterface, VaraHFClient, KISSTnc
+from db import get_conn, log_change
 
 CONFIG_FILE = Path('config.json')
 DEFAULT_CONFIG = {
     'db_path': 'openbbs.db',
-    'server_url': 'http://localhost:5000'
+    'server_url': 'http://localhost:5000',
+    'keys_path': 'keys.db'
 }
 
 
@@ -29,11 +29,47 @@ CONF = load_config()
 DB_PATH = Path(CONF['db_path'])
 
 
+def _load_private_key(path):
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+    with open(path, 'rb') as f:
+        return load_pem_private_key(f.read(), password=None)
+
+
+def _sync_engine(require_signatures=False, verify_workers=1):
+    """Return a :class:`SyncEngine` that checks signatures against our key cache."""
+    from sync import SyncEngine
+
+    keys = None
+    path = Path(CONF['keys_path'])
+    # a keys.json from older versions is migrated on first use
+    if path.exists() or path.with_suffix('.json').exists():
+        from keycache import KeyCache
+
+        keys = KeyCache(CONF['keys_path'])
+    return SyncEngine(str(DB_PATH), keys=keys, require_signatures=require_signatures,
+                      verify_workers=verify_workers)
+
+
 def cmd_sync_pull(args):
+    from sync import SyncEngine
+
     engine = SyncEngine(str(DB_PATH))
     with tempfile.NamedTemporaryFile(suffix='.tar.zst', delete=False) as tmp:
         path = tmp.name if args.output == '-' else args.output or tmp.name
-    engine.pull(since=args.since, thread_ids=args.thread, output_path=path)
+    dict_id = args.dict
+    if dict_id == 'latest':
+        from compression import latest_dictionary_id
+
+        dict_id = latest_dictionary_id(str(DB_PATH))
+    signing_key = _load_private_key(args.sign) if args.sign else None
+    summary = engine.export(since=args.since, thread_ids=args.thread, output_path=path,
+                            cursor=args.cursor, peer=args.peer, level=args.level,
+                            dict_id=int(dict_id) if dict_id else None,
+                            long_distance=args.long, format=args.format,
+                            signing_key=signing_key, workers=args.workers)
+    # stdout may carry the package itself, so report the cursor on stderr
+    print(f"cursor {summary['cursor']}", file=sys.stderr)
     if args.output == '-':
         with open(path, 'rb') as f:
             sys.stdout.buffer.write(f.read())
@@ -43,23 +79,80 @@ def cmd_sync_pull(args):
 
 
 def cmd_sync_push(args):
-    engine = SyncEngine(str(DB_PATH))
-    summary = engine.push(args.package)
+    engine = _sync_engine(args.require_signatures, args.verify_workers)
+    summary = engine.push(args.package, peer=args.peer)
     print(summary)
 
 
+def cmd_sync_upload(args):
+    from transfer import upload
+
+    status = upload(args.url, args.package, chunk_size=args.chunk_size, peer=args.peer)
+    print(status.get('import') or status)
+
+
+def cmd_sync_download(args):
+    from transfer import TransferStore, download
+
+    store = TransferStore(str(DB_PATH))
+    base_url = args.url.rstrip('/')
+    # carry on with an interrupted download from this node first
+    pending = store.pending(peer=base_url)
+    if pending:
+        tid, path = download(base_url, store, tid=pending[0])
+    else:
+        options = {'peer': args.peer, 'cursor': args.cursor, 'format': args.format,
+                   'chunk_size': args.chunk_size}
+        tid, path = download(base_url, store, **{k: v for k, v in options.items() if v is not None})
+    shutil.copyfile(path, args.output)
+    print(f'{tid} -> {args.output}')
+
+
+def cmd_sync_peers(_):
+    conn = get_conn(DB_PATH)
+    rows = conn.execute("SELECT * FROM sync_peers ORDER BY peer_id").fetchall()
+    for r in rows:
+        print(
+            f"{r['peer_id']} acked={r['acked_cursor']} sent={r['sent_cursor']} "
+            f"received={r['received_cursor']} out={r['bytes_sent']}B "
+            f"in={r['bytes_received']}B last={r['last_sync']}"
+        )
+
+
+def cmd_dict_train(args):
+    from compression import train_dictionary
+
+    print(train_dictionary(str(DB_PATH), size=args.size, samples=args.samples))
+
+
+def cmd_dict_list(_):
+    from compression import list_dictionaries
+
+    for d in list_dictionaries(str(DB_PATH)):
+        print(d['dict_id'], d['size'], d['samples'], d['created_at'])
+
+
+def cmd_dict_export(args):
+    from compression import dictionary_bytes
+
+    Path(args.file).write_bytes(dictionary_bytes(str(DB_PATH), args.dict_id))
+
+
+def cmd_dict_import(args):
+    from compression import import_dictionary
+
+    print(import_dictionary(str(DB_PATH), Path(args.file).read_bytes()))
+
+
 def cmd_list(_):
-    init_db(DB_PATH)
-    conn = connect(DB_PATH)
+    conn = get_conn(DB_PATH)
     rows = conn.execute("SELECT id, title, updated_at FROM threads ORDER BY updated_at DESC").fetchall()
     for r in rows:
         print(r['id'], r['title'], r['updated_at'])
-    conn.close()
 
 
 def cmd_read(args):
-    init_db(DB_PATH)
-    conn = connect(DB_PATH)
+    conn = get_conn(DB_PATH)
     t = conn.execute("SELECT title FROM threads WHERE id=?", (args.thread_id,)).fetchone()
     if not t:
         print('thread not found')
@@ -68,35 +161,67 @@ def cmd_read(args):
     msgs = conn.execute("SELECT author, body, timestamp FROM messages WHERE thread_id=? ORDER BY timestamp", (args.thread_id,)).fetchall()
     for m in msgs:
         print(f"[{m['timestamp']}] {m['author']}: {m['body']}")
-    conn.close()
 
 
 def cmd_post(args):
-    init_db(DB_PATH)
-    conn = connect(DB_PATH)
+    conn = get_conn(DB_PATH)
     mid = str(uuid.uuid4())
     ts = datetime.utcnow().isoformat()
+    signature = None
+    if args.key:
+        from keycache import sign_message
+
+        signature = sign_message(_load_private_key(args.key), {
+            'id': mid, 'thread_id': args.thread_id, 'timestamp': ts,
+            'author': args.author, 'body': args.body,
+        })
     conn.execute(
-        "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
-        (mid, args.thread_id, ts, ts, args.author, args.body)
+        """INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body, signature)
+        VALUES (?,?,?,?,?,?,?)""",
+        (mid, args.thread_id, ts, ts, args.author, args.body, signature)
     )
     conn.execute("UPDATE threads SET updated_at=? WHERE id=?", (ts, args.thread_id))
+    log_change(conn, 'message', mid)
+    log_change(conn, 'thread', args.thread_id)
     conn.commit()
-    conn.close()
     print(mid)
 
 
+def cmd_keys_add(args):
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+    from cryptography.hazmat.primitives.serialization import load_pem_public_key
+    from keycache import KeyCache
+
+    if Path(args.key).exists():
+        key = load_pem_public_key(Path(args.key).read_bytes())
+    else:
+        key = Ed25519PublicKey.from_public_bytes(bytes.fromhex(args.key))
+    KeyCache(CONF['keys_path']).update(args.user, args.version, key)
+
+
+def cmd_keys_import(args):
+    from keycache import KeyCache
+
+    print(f"{KeyCache(CONF['keys_path']).import_file(args.file)} keys added")
+
+
+def cmd_keys_show(args):
+    from keycache import KeyCache
+
+    for k in KeyCache(CONF['keys_path']).history(args.user):
+        print(k['version'], k['key'], k['added_at'])
+
+
 def cmd_new_thread(args):
-    init_db(DB_PATH)
-    conn = connect(DB_PATH)
+    conn = get_conn(DB_PATH)
     tid = str(uuid.uuid4())
     now = datetime.utcnow().isoformat()
     conn.execute(
         "INSERT INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
         (tid, args.title, now, now)
     )
+    log_change(conn, 'thread', tid)
     conn.commit()
-    conn.close()
     print(tid)
 
 
@@ -105,32 +230,70 @@ def cmd_queue_post(args):
     if not body:
         body = sys.stdin.read()
     tid = args.thread_id
-    init_db(DB_PATH)
-    conn = connect(DB_PATH)
+    conn = get_conn(DB_PATH)
     cur = conn.cursor()
     mid = str(uuid.uuid4())
     ts = datetime.utcnow().isoformat()
     cur.execute(
-        "INSERT INTO outbox (id, thread_id, body, queued_at) VALUES (?,?,?,?)",
-        (mid, tid, body, ts)
+        "INSERT INTO outbox (id, thread_id, author, body, queued_at) VALUES (?,?,?,?,?)",
+        (mid, tid, getattr(args, 'author', None), body, ts)
     )
     conn.commit()
-    conn.close()
     print(mid)
 
 
-def cmd_outbox_view(_):
-    init_db(DB_PATH)
-    conn = connect(DB_PATH)
+def cmd_outbox_view(args):
+    conn = get_conn(DB_PATH)
     cur = conn.cursor()
-    rows = cur.execute("SELECT id, thread_id, queued_at, body FROM outbox ORDER BY queued_at").fetchall()
+    where = '' if getattr(args, 'all', False) else "WHERE state != 'acked'"
+    rows = cur.execute(
+        f"SELECT id, thread_id, queued_at, state, attempts, body FROM outbox {where} ORDER BY queued_at"
+    ).fetchall()
     for r in rows:
         snippet = r['body'][:80].replace('\n', ' ')
-        print(f"{r['id']} {r['thread_id']} {r['queued_at']} {snippet}")
-    conn.close()
+        print(f"{r['id']} {r['thread_id']} {r['queued_at']} {r['state']}/{r['attempts']} {snippet}")
+
+
+def _outbox_link(args):
+    from outbox import HttpLink, RadioLink, radio_sender
+
+    if not args.radio:
+        return HttpLink(args.url, peer=args.peer)
+    from scheduler import LinkScheduler
+    from transfer import TransferStore
+
+    args.port = args.radio
+    send = radio_sender(_arq(args), TransferStore(str(DB_PATH)), DB_PATH.parent / 'outbox',
+                        timeout=args.timeout)
+    return RadioLink(LinkScheduler(send, window=args.window))
+
+
+def cmd_outbox_flush(args):
+    from outbox import OutboxFlusher
+
+    flusher = OutboxFlusher(str(DB_PATH), _outbox_link(args), batch_size=args.batch)
+    if args.daemon:
+        try:
+            flusher.run(interval=args.interval, metrics_file=getattr(args, 'metrics_file', None))
+        except KeyboardInterrupt:
+            pass
+    else:
+        flusher.flush(timeout=args.wait)
+    stats = flusher.stats
+    print(
+        f"{stats['acked']} delivered, {stats['failed']} to retry in {stats['batches']} batches "
+        f"({flusher.rate():.1f} msg/min)"
+    )
+    left = flusher.pending()
+    left.pop('acked', None)
+    if left:
+        print('outbox: ' + ', '.join(f'{n} {state}' for state, n in sorted(left.items())),
+              file=sys.stderr)
 
 
 def _create_iface(mode, port):
+    from radio import RadioInterface, VaraHFClient
+
     if mode == 'varahf':
         host, *p = port.split(':')
         p = int(p[0]) if p else 8300
@@ -138,25 +301,110 @@ def _create_iface(mode, port):
     return RadioInterface(port)
 
 
+def _radio_dictionaries():
+    """Return ``(newest, {id: dictionary})`` from the local database."""
+    from compression import get_dictionary, list_dictionaries
+
+    ids = [d['dict_id'] for d in list_dictionaries(str(DB_PATH))]
+    dicts = {i: get_dictionary(str(DB_PATH), i) for i in ids}
+    return (dicts[ids[0]] if ids else None), dicts
+
+
 def cmd_radio_send(args):
     iface = _create_iface(args.mode, args.port)
+    payload = args.message.encode('utf-8')
+    if args.compress:
+        from radio import compress_frame
+
+        payload = compress_frame(payload, _radio_dictionaries()[0])
     if args.kiss:
+        from radio import KISSTnc
+
         iface = KISSTnc(iface)
-        iface.send_packet(args.message.encode('utf-8'))
+        iface.send_packet(payload)
     else:
-        iface.send(args.message.encode('utf-8'))
+        iface.send(payload)
 
 
 def cmd_radio_recv(args):
     iface = _create_iface(args.mode, args.port)
     if args.kiss:
+        from radio import KISSTnc
+
         iface = KISSTnc(iface)
         data = iface.receive_packet()
     else:
         data = iface.receive()
+    if args.compress and data:
+        from radio import decompress_frame
+
+        data = decompress_frame(data, _radio_dictionaries()[1])
     sys.stdout.buffer.write(data)
 
 
+def _arq(args):
+    from radio import KISSTnc, SlidingWindowARQ
+
+    return SlidingWindowARQ(KISSTnc(_create_iface(args.mode, args.port)))
+
+
+def cmd_radio_send_package(args):
+    from transfer import RADIO_CHUNK_SIZE, TransferStore, radio_send
+
+    store = TransferStore(str(DB_PATH))
+    tid = store.offer(args.package, chunk_size=RADIO_CHUNK_SIZE)['id']
+    if radio_send(_arq(args), store, tid, timeout=args.timeout):
+        print(f'{tid} delivered')
+    else:
+        print(f'{tid} interrupted; run again to resume', file=sys.stderr)
+        sys.exit(1)
+
+
+def cmd_radio_recv_package(args):
+    from transfer import TransferStore, radio_receive
+
+    store = TransferStore(str(DB_PATH))
+    path = radio_receive(_arq(args), store, timeout=args.timeout)
+    if path is None:
+        print('link idle; partial transfers resume on the next run', file=sys.stderr)
+        sys.exit(1)
+    if args.push:
+        print(_sync_engine().push(str(path)))
+    else:
+        print(path)
+
+
+def cmd_gateway(args):
+    from gateway import Gateway
+
+    iface = _create_iface(args.mode, args.port)
+    gateway = Gateway(_sync_engine(), iface, args.work_dir, peer=args.peer, interval=args.interval,
+                      window=args.window, retry=args.retry)
+    print(f"gateway on {args.port}, peer {args.peer or '(first to send)'}", file=sys.stderr)
+    gateway.run(metrics_file=getattr(args, 'metrics_file', None))
+    print(gateway.stats, file=sys.stderr)
+
+
+def cmd_stats(args):
+    import metrics
+
+    if args.file:
+        data = json.loads(Path(args.file).read_text())['metrics']
+    else:
+        import urllib.request
+
+        url = (args.url or CONF['server_url']).rstrip('/') + '/metrics?format=json'
+        with urllib.request.urlopen(url, timeout=10) as resp:
+            data = json.load(resp)
+    if args.prefix:
+        data = {name: m for name, m in data.items() if name.startswith(args.prefix)}
+    if args.json:
+        print(json.dumps(data, indent=2))
+        return
+    for line in metrics.format_snapshot(data):
+        print(line)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Hambbs CLI')
     sub = parser.add_subparsers(dest='command')
@@ -167,27 +415,96 @@ def main():
     pull = sync_sub.add_parser('pull')
     pull.add_argument('--since')
     pull.add_argument('--thread', nargs='*')
+    pull.add_argument('--cursor', type=int,
+                      help='only export changes after this cursor (printed by the previous pull)')
+    pull.add_argument('--peer', help='build the delta this peer has not acknowledged yet')
+    pull.add_argument('--level', type=int, default=3, help='zstd compression level')
+    pull.add_argument('--dict', help="zstd dictionary id, or 'latest'")
+    pull.add_argument('--long', action='store_true',
+                      help='long-distance matching, for large archives')
+    pull.add_argument('--format', choices=['tar', 'pack'], default='tar',
+                      help='package layout; pack is the compact binary format')
+    pull.add_argument('--sign', metavar='KEY',
+                      help='sign the package with this PEM Ed25519 private key')
+    pull.add_argument('--workers', type=int, default=1,
+                      help='processes for building the package, -1 for one per CPU')
     pull.add_argument('output', nargs='?', default='sync.tar.zst')
     pull.set_defaults(func=cmd_sync_pull)
 
     push = sync_sub.add_parser('push')
     push.add_argument('package')
+    push.add_argument('--peer', help='name of the peer the package came from')
+    push.add_argument('--require-signatures', action='store_true',
+                      help='refuse unsigned packages and drop unsigned messages')
+    push.add_argument('--verify-workers', type=int, default=1,
+                      help='processes for checking message signatures, -1 for one per CPU')
     push.set_defaults(func=cmd_sync_push)
 
+    up = sync_sub.add_parser('upload', help='send a package to a node in resumable chunks')
+    up.add_argument('package')
+    up.add_argument('--url', default=CONF['server_url'])
+    up.add_argument('--peer', help='our name on the receiving node')
+    up.add_argument('--chunk-size', type=int, default=64 * 1024)
+    up.set_defaults(func=cmd_sync_upload)
+
+    down = sync_sub.add_parser('download', help='fetch a package from a node in resumable chunks')
+    down.add_argument('output', nargs='?', default='sync.tar.zst')
+    down.add_argument('--url', default=CONF['server_url'])
+    down.add_argument('--peer', help='our name on the sending node')
+    down.add_argument('--cursor', type=int)
+    down.add_argument('--format', choices=['tar', 'pack'])
+    down.add_argument('--chunk-size', type=int)
+    down.set_defaults(func=cmd_sync_download)
+
+    sync_sub.add_parser('peers').set_defaults(func=cmd_sync_peers)
+
+    zdict = sync_sub.add_parser('dict')
+    zdict_sub = zdict.add_subparsers(dest='dict_cmd')
+    dt = zdict_sub.add_parser('train')
+    dt.add_argument('--size', type=int, default=16 * 1024)
+    dt.add_argument('--samples', type=int, default=5000)
+    dt.set_defaults(func=cmd_dict_train)
+    zdict_sub.add_parser('list').set_defaults(func=cmd_dict_list)
+    de = zdict_sub.add_parser('export')
+    de.add_argument('dict_id', type=int)
+    de.add_argument('file')
+    de.set_defaults(func=cmd_dict_export)
+    di = zdict_sub.add_parser('import')
+    di.add_argument('file')
+    di.set_defaults(func=cmd_dict_import)
+
     queue = sub.add_parser('queue')
     queue_sub = queue.add_subparsers(dest='queue_cmd')
 
     qp = queue_sub.add_parser('post')
     qp.add_argument('thread_id')
     qp.add_argument('--body')
+    qp.add_argument('--author')
     qp.set_defaults(func=cmd_queue_post)
 
     outbox = sub.add_parser('outbox')
     outbox_sub = outbox.add_subparsers(dest='outbox_cmd')
 
     ov = outbox_sub.add_parser('view')
+    ov.add_argument('--all', action='store_true', help='include delivered posts')
     ov.set_defaults(func=cmd_outbox_view)
 
+    of = outbox_sub.add_parser('flush', help='send queued posts in batched sync packages')
+    of.add_argument('--url', default=CONF['server_url'])
+    of.add_argument('--peer', help='our name on the receiving node')
+    of.add_argument('--radio', metavar='PORT', help='send over the radio instead of HTTP')
+    of.add_argument('--mode', choices=['com', 'varahf'], default='com')
+    of.add_argument('--window', type=float, default=60.0,
+                    help='seconds between radio transmissions')
+    of.add_argument('--timeout', type=float, default=60.0,
+                    help='seconds to wait for a silent radio peer')
+    of.add_argument('--batch', type=int, default=100, help='posts per package')
+    of.add_argument('--wait', type=float, help='give up on undelivered packages after this many seconds')
+    of.add_argument('--daemon', action='store_true', help='keep flushing until interrupted')
+    of.add_argument('--interval', type=float, default=30.0, help='seconds between daemon flushes')
+    of.add_argument('--metrics-file', help='with --daemon, write a metrics snapshot here after each flush')
+    of.set_defaults(func=cmd_outbox_flush)
+
     sub.add_parser('list').set_defaults(func=cmd_list)
     rd = sub.add_parser('read')
     rd.add_argument('thread_id')
@@ -196,11 +513,47 @@ def main():
     post.add_argument('thread_id')
     post.add_argument('body')
     post.add_argument('--author', default='anon')
+    post.add_argument('--key', help="sign the message with the author's PEM Ed25519 private key")
     post.set_defaults(func=cmd_post)
+
+    keys = sub.add_parser('keys')
+    keys_sub = keys.add_subparsers(dest='keys_cmd')
+    ka = keys_sub.add_parser('add', help='record the public key of a user or node')
+    ka.add_argument('user')
+    ka.add_argument('key', help='PEM public key file or raw key in hex')
+    ka.add_argument('--version', type=int, default=1)
+    ka.set_defaults(func=cmd_keys_add)
+    ki = keys_sub.add_parser('import', help='add the keys in a directory dump')
+    ki.add_argument('file', help="JSON, or lines of 'CALL VERSION HEXKEY'")
+    ki.set_defaults(func=cmd_keys_import)
+    ks = keys_sub.add_parser('show', help='list every key version recorded for a user')
+    ks.add_argument('user')
+    ks.set_defaults(func=cmd_keys_show)
     nt = sub.add_parser('new')
     nt.add_argument('title')
     nt.set_defaults(func=cmd_new_thread)
 
+    gw = sub.add_parser('gateway', help='exchange sync deltas with a peer over the radio until stopped')
+    gw.add_argument('port')
+    gw.add_argument('--mode', choices=['com', 'varahf'], default='com')
+    gw.add_argument('--peer', help="the other node's id; learnt from its first package if omitted")
+    gw.add_argument('--interval', type=float, default=30.0,
+                    help='seconds between checks for changes to send')
+    gw.add_argument('--window', type=float, default=60.0,
+                    help='minimum seconds between outgoing packages')
+    gw.add_argument('--retry', type=float, default=30.0,
+                    help='seconds of silence before a transfer starts over')
+    gw.add_argument('--work-dir', default='gateway', help='packages in flight')
+    gw.add_argument('--metrics-file', help='write a metrics snapshot here every --interval')
+    gw.set_defaults(func=cmd_gateway)
+
+    st = sub.add_parser('stats', help="show a node's counters, gauges and latency histograms")
+    st.add_argument('--url', help='node to ask (default: server_url from config.json)')
+    st.add_argument('--file', help='read a snapshot written with --metrics-file instead')
+    st.add_argument('--prefix', help='only metrics whose name starts with this, e.g. radio_')
+    st.add_argument('--json', action='store_true', help='print the raw snapshot')
+    st.set_defaults(func=cmd_stats)
+
     radio = sub.add_parser('radio')
     radio_sub = radio.add_subparsers(dest='radio_cmd')
 
@@ -209,14 +562,32 @@ def main():
     rs.add_argument('message')
     rs.add_argument('--mode', choices=['com', 'varahf'], default='com')
     rs.add_argument('--kiss', action='store_true', help='use KISS framing')
+    rs.add_argument('--compress', action='store_true',
+                    help='zstd-compress with the newest trained dictionary')
     rs.set_defaults(func=cmd_radio_send)
 
     rr = radio_sub.add_parser('recv')
     rr.add_argument('port')
     rr.add_argument('--mode', choices=['com', 'varahf'], default='com')
     rr.add_argument('--kiss', action='store_true', help='use KISS framing')
+    rr.add_argument('--compress', action='store_true',
+                    help='expect frames sent with --compress')
     rr.set_defaults(func=cmd_radio_recv)
 
+    rsp = radio_sub.add_parser('send-package', help='send a sync package over KISS/ARQ, resumably')
+    rsp.add_argument('port')
+    rsp.add_argument('package')
+    rsp.add_argument('--mode', choices=['com', 'varahf'], default='com')
+    rsp.add_argument('--timeout', type=float, default=60.0)
+    rsp.set_defaults(func=cmd_radio_send_package)
+
+    rrp = radio_sub.add_parser('recv-package', help='receive a sync package over KISS/ARQ')
+    rrp.add_argument('port')
+    rrp.add_argument('--mode', choices=['com', 'varahf'], default='com')
+    rrp.add_argument('--timeout', type=float, default=60.0)
+    rrp.add_argument('--push', action='store_true', help='import the package once complete')
+    rrp.set_defaults(func=cmd_radio_recv_package)
+
     args = parser.parse_args()
     if hasattr(args, 'func'):
         args.func(args)
@@ -0,0 +1,79 @@
+"""Requests per second for the REST API with and without the connection pool.
+
+"before" reproduces the old ``get_conn()``, which ran ``init_db`` and opened
+a fresh connection on every request.
+
+    python benchmarks/bench_api_pool.py --requests 2000 --clients 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def load(app, urls, requests, clients):
+    per_client = requests // clients
+
+    def worker():
+        client = app.test_client()
+        for i in range(per_client):
+            client.get(urls[i % len(urls)])
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return per_client * clients / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=50)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    import db
+    from openbbs import api, create_app
+
+    app = create_app()
+    db_path = app.config["DB_PATH"]
+    conn = db.get_conn(db_path)
+    for i in range(args.threads):
+        conn.execute(
+            "INSERT INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
+            (f"t{i}", f"thread {i}", "2024-01-01", f"2024-01-01T00:00:{i:02d}"),
+        )
+        for j in range(20):
+            conn.execute(
+                "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+                (f"m{i}-{j}", f"t{i}", "2024", "2024", "bench", "hello " * 20),
+            )
+    conn.commit()
+    urls = ["/api/threads"] + [f"/api/threads/t{i}" for i in range(args.threads)]
+
+    pooled = api.get_conn
+
+    def unpooled():
+        db.init_db(db_path)
+        return db.connect(db_path)
+
+    api.get_conn = unpooled
+    before = load(app, urls, args.requests, args.clients)
+    api.get_conn = pooled
+    after = load(app, urls, args.requests, args.clients)
+    print(f"{args.requests} GETs from {args.clients} clients")
+    print(f"before (init_db + connect per request): {before:8.1f} req/s")
+    print(f"after  (thread-local pool):             {after:8.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
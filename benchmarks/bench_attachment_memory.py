@@ -0,0 +1,94 @@
+"""Peak memory of concurrent attachment downloads.
+
+Compares the streaming ``/attachment/<id>`` route against the previous
+implementation, which decompressed the whole file into a ``BytesIO``.
+
+    python benchmarks/bench_attachment_memory.py --size-mb 50 --clients 8
+"""
+import argparse
+import gzip
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def run(app, url, clients, headers):
+    def worker():
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["_user_id"] = "1"
+        resp = client.get(url, headers=headers)
+        for _ in resp.response:
+            pass
+        resp.close()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=50)
+    parser.add_argument("--clients", type=int, default=8)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    from flask import send_file
+    from openbbs import create_app, db
+    from openbbs.models import Attachment, Forum, Post, User
+
+    app = create_app()
+    with app.app_context():
+        user = User(username="bench", password="pw")
+        forum = Forum(name="bench")
+        db.session.add_all([user, forum])
+        db.session.flush()
+        post = Post(title="t", body="b", author=user, forum=forum)
+        db.session.add(post)
+        db.session.flush()
+        dest = Path(app.config["UPLOAD_FOLDER"]) / "bench.bin.gz"
+        block = os.urandom(1024 * 1024)
+        with gzip.open(dest, "wb", compresslevel=1) as f:
+            for _ in range(args.size_mb):
+                f.write(block)
+        att = Attachment(filename=str(dest), original_name="bench.bin", post=post)
+        db.session.add(att)
+        db.session.commit()
+        att_id = att.id
+
+    @app.route("/legacy/<int:att_id>")
+    def legacy(att_id):
+        att = db.session.get(Attachment, att_id)
+        with gzip.open(att.filename, "rb") as f:
+            data = f.read()
+        return send_file(io.BytesIO(data), as_attachment=True, download_name="x")
+
+    cases = [
+        ("legacy in-memory", f"/legacy/{att_id}", {"Accept-Encoding": "identity"}),
+        ("stream decompress", f"/attachment/{att_id}", {"Accept-Encoding": "identity"}),
+        ("gzip passthrough", f"/attachment/{att_id}", {"Accept-Encoding": "gzip"}),
+    ]
+    print(f"{args.clients} concurrent downloads of a {args.size_mb} MB attachment")
+    for name, url, headers in cases:
+        peak, elapsed = run(app, url, args.clients, headers)
+        print(f"{name:18} peak {peak / 2**20:8.1f} MiB  {elapsed:6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Full-archive export time against the number of worker processes.
+
+Builds a synthetic archive (one million messages by default) and exports
+it with each worker count, checking that every parallel export produces
+the same bytes.
+
+    python benchmarks/bench_sync_parallel.py --messages 1000000 --workers 1,2,4,8
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+CALLS = ["W1AW", "K1ABC", "N0CALL", "VE3XYZ", "G4ABC", "JA1XYZ", "DL1ABC", "VK2DEF"]
+WORDS = "net check in signal report qsl copy propagation band antenna power rig 73 tnx wx".split()
+
+
+def populate(db_path, threads, messages):
+    from db import get_conn, init_db
+
+    init_db(db_path)
+    rng = random.Random(42)
+    conn = get_conn(db_path)
+    conn.executemany(
+        "INSERT INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
+        [(f"thread-{t}", f"Net {t}", "2024-03-01T00:00:00", "2024-03-01T00:00:00") for t in range(threads)],
+    )
+
+    def rows():
+        for i in range(messages):
+            ts = f"2024-03-{1 + i // 86400 % 28:02d}T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}"
+            yield (
+                f"{rng.getrandbits(128):032x}", f"thread-{rng.randrange(threads)}", ts, ts,
+                rng.choice(CALLS), " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 25))),
+            )
+
+    conn.executemany(
+        "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+        rows(),
+    )
+    conn.commit()
+
+
+def main():
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--threads", type=int, default=2000)
+    parser.add_argument("--level", type=int, default=3)
+    parser.add_argument(
+        "--workers",
+        default=",".join(str(n) for n in sorted({1, 2, 4, 8, cores}) if n <= cores),
+    )
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    from sync import SyncEngine
+
+    start = time.perf_counter()
+    populate("bench.db", args.threads, args.messages)
+    print(f"{args.messages} messages in {args.threads} threads "
+          f"({time.perf_counter() - start:.1f}s to build), {cores} cores, zstd level {args.level}")
+    engine = SyncEngine("bench.db", blob_root="blobs")
+    print(f"{'workers':>8}{'seconds':>10}{'speedup':>10}{'bytes':>12}  sha256")
+    base = None
+    for workers in (int(w) for w in args.workers.split(",")):
+        start = time.perf_counter()
+        pkg = engine.export(output_path=f"full-{workers}.tar.zst", level=args.level, workers=workers)
+        elapsed = time.perf_counter() - start
+        base = base or elapsed
+        with open(pkg["path"], "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        print(f"{workers:>8}{elapsed:>10.2f}{base / elapsed:>9.2f}x{pkg['size']:>12}  {digest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Size and speed of tar and binary sync packages.
+
+Fills a database with synthetic threads and messages, exports it in both
+formats and imports each package into an empty database.  Sizes are shown
+with and without zstd so the effect of the format itself is visible.
+
+    python benchmarks/bench_syncpack.py --messages 20000 --level 3
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+CALLS = ["W1AW", "K1ABC", "N0CALL", "VE3XYZ", "G4ABC", "JA1XYZ", "DL1ABC", "VK2DEF"]
+WORDS = "net check in signal report qsl copy propagation band antenna power rig 73 tnx wx".split()
+
+
+def populate(db_path, threads, messages):
+    from db import get_conn, init_db, log_change
+
+    init_db(db_path)
+    rng = random.Random(42)
+    conn = get_conn(db_path)
+    for t in range(threads):
+        ts = f"2024-03-01T00:{t % 60:02d}:00"
+        conn.execute(
+            "INSERT INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
+            (f"thread-{t}", f"Net {t}", ts, ts),
+        )
+    for i in range(messages):
+        ts = f"2024-03-{1 + i // 1440 % 28:02d}T{i // 60 % 24:02d}:{i % 60:02d}:{rng.randint(0, 59):02d}"
+        mid = f"{rng.getrandbits(128):032x}"
+        conn.execute(
+            "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+            (mid, f"thread-{rng.randrange(threads)}", ts, ts, rng.choice(CALLS),
+             " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 25)))),
+        )
+        log_change(conn, "message", mid)
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=200)
+    parser.add_argument("--level", type=int, default=3)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    import zstandard as zstd
+    from sync import SyncEngine
+
+    populate("src.db", args.threads, args.messages)
+    engine = SyncEngine("src.db", blob_root="src-blobs")
+    print(f"{args.messages} messages in {args.threads} threads, zstd level {args.level}")
+    print(f"{'format':>8}{'raw':>12}{'zstd':>12}{'export':>10}{'import':>10}")
+    for fmt in ("tar", "pack"):
+        start = time.perf_counter()
+        pkg = engine.export(output_path=f"pkg.{fmt}", format=fmt, level=args.level)
+        exported = time.perf_counter() - start
+        peer = SyncEngine(f"dst-{fmt}.db", blob_root=f"dst-{fmt}-blobs")
+        start = time.perf_counter()
+        peer.push(pkg["path"])
+        imported = time.perf_counter() - start
+        with open(pkg["path"], "rb") as f:
+            raw = len(zstd.ZstdDecompressor().stream_reader(f).read())
+        print(f"{fmt:>8}{raw:>12}{pkg['size']:>12}{exported:>9.2f}s{imported:>9.2f}s")
+
+
+if __name__ == "__main__":
+    main()
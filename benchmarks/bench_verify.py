@@ -0,0 +1,107 @@
+"""Message signature verification throughput.
+
+Signs synthetic messages with a set of author keys and verifies them:
+parsing the author's key for every message, through the parsed-key cache
+of :class:`keycache.KeyCache`, and spread over a process pool with
+:func:`keycache.verify_batch`.  Finally a signed package is pushed into
+an empty database with and without signature checks, and once more into
+a database that already holds it, where nothing needs verifying.
+
+    python benchmarks/bench_verify.py --messages 50000 --authors 200 --workers 4
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def rate(label, count, seconds):
+    print(f"{label:<28} {count / seconds:>10.0f} msg/s  ({seconds:.2f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--authors", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+        Ed25519PrivateKey,
+        Ed25519PublicKey,
+    )
+    from db import get_conn, init_db, log_change
+    from keycache import KeyCache, message_payload, sign_message, verify_batch
+    from sync import SyncEngine
+
+    rng = random.Random(42)
+    authors = {f"CALL{i}": Ed25519PrivateKey.generate() for i in range(args.authors)}
+    keys = KeyCache("keys.db")
+    for call, key in authors.items():
+        keys.update(call, 1, key.public_key())
+    messages = []
+    for i in range(args.messages):
+        author = rng.choice(list(authors))
+        m = {"id": f"m{i}", "thread_id": f"t{i % 100}", "timestamp": f"2024-03-01T00:00:{i % 60:02d}",
+             "author": author, "body": f"signal report {i} 59 tnx 73"}
+        m["signature"] = sign_message(authors[author], m)
+        messages.append(m)
+    items = [(keys.key_bytes(m["author"]), message_payload(m), bytes.fromhex(m["signature"]))
+             for m in messages]
+    print(f"{args.messages} messages from {args.authors} authors")
+
+    start = time.perf_counter()
+    for raw, payload, signature in items:
+        Ed25519PublicKey.from_public_bytes(raw).verify(signature, payload)
+    rate("parse key per message", len(items), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for m, (_, payload, signature) in zip(messages, items):
+        assert keys.verify(m["author"], payload, signature)
+    rate("KeyCache (parsed-key LRU)", len(items), time.perf_counter() - start)
+
+    with ProcessPoolExecutor(args.workers) as pool:
+        verify_batch(items[:1000], pool)  # start the workers
+        start = time.perf_counter()
+        assert all(verify_batch(items, pool))
+        rate(f"pool of {args.workers}", len(items), time.perf_counter() - start)
+
+    init_db("src.db")
+    conn = get_conn("src.db")
+    for t in range(100):
+        conn.execute("INSERT INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
+                     (f"t{t}", f"Net {t}", "2024-03-01", "2024-03-01"))
+    for m in messages:
+        conn.execute(
+            """INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body, signature)
+            VALUES (?,?,?,?,?,?,?)""",
+            (m["id"], m["thread_id"], m["timestamp"], m["timestamp"], m["author"], m["body"], m["signature"]),
+        )
+        log_change(conn, "message", m["id"])
+    conn.commit()
+    path = SyncEngine("src.db", blob_root="blobs").pull(output_path="p.tar.zst")
+    for label, options in [
+        ("push, no checks", {}),
+        ("push, checked", {"keys": keys}),
+        (f"push, checked, {args.workers} workers", {"keys": keys, "verify_workers": args.workers}),
+    ]:
+        db_path = f"dst-{len(options)}-{options.get('verify_workers', 1)}.db"
+        engine = SyncEngine(db_path, blob_root="blobs", **options)
+        start = time.perf_counter()
+        engine.push(path)
+        rate(label, len(messages), time.perf_counter() - start)
+    # the same package again, as when it arrives over a second link
+    start = time.perf_counter()
+    engine.push(path)
+    rate("push again, already held", len(messages), time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
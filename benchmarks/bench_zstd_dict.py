@@ -0,0 +1,82 @@
+"""Compression ratio of small sync payloads against dictionary size.
+
+Trains dictionaries of several sizes on a synthetic ``messages`` table and
+compresses held-out payloads the size of a typical radio delta (one
+message, and a package of a few messages), with and without a dictionary.
+
+    python benchmarks/bench_zstd_dict.py --messages 5000 --level 19
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+CALLS = ["W1AW", "K1ABC", "N0CALL", "VE3XYZ", "G4ABC", "JA1XYZ", "DL1ABC", "VK2DEF"]
+WORDS = "net check in signal report qsl copy propagation band antenna power rig 73 tnx wx".split()
+
+
+def fake_message(rng, i):
+    ts = f"2024-03-{1 + i // 1440 % 28:02d}T{i // 60 % 24:02d}:{i % 60:02d}:00"
+    return {
+        "id": f"{rng.getrandbits(128):032x}",
+        "thread_id": f"thread-{rng.randint(1, 40)}",
+        "timestamp": ts,
+        "updated_at": ts,
+        "author": rng.choice(CALLS),
+        "body": " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 25))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--level", type=int, default=19)
+    parser.add_argument("--sizes", default="1024,4096,16384,65536")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    import zstandard as zstd
+    from compression import compressor, get_dictionary, train_dictionary
+    from db import get_conn, init_db
+
+    db_path = "bench.db"
+    init_db(db_path)
+    rng = random.Random(42)
+    conn = get_conn(db_path)
+    conn.executemany(
+        "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES "
+        "(:id,:thread_id,:timestamp,:updated_at,:author,:body)",
+        [fake_message(rng, i) for i in range(args.messages)],
+    )
+    conn.commit()
+    held_out = [fake_message(rng, args.messages + i) for i in range(200)]
+    payloads = {
+        "1 message": [json.dumps(m).encode() for m in held_out],
+        "5 messages": [json.dumps(held_out[i : i + 5]).encode() for i in range(0, 200, 5)],
+    }
+
+    def ratio(zdict, samples):
+        cctx = compressor(args.level, zdict)
+        raw = sum(len(s) for s in samples)
+        return raw / sum(len(cctx.compress(s)) for s in samples)
+
+    print(f"level {args.level}, trained on {args.messages} messages")
+    header = f"{'dictionary':>12}" + "".join(f"{name:>14}" for name in payloads)
+    print(header)
+    print(f"{'none':>12}" + "".join(f"{ratio(None, p):13.2f}x" for p in payloads.values()))
+    for size in (int(s) for s in args.sizes.split(",")):
+        try:
+            zdict = get_dictionary(db_path, train_dictionary(db_path, size=size))
+        except zstd.ZstdError as exc:
+            print(f"{size:>11}B  training failed: {exc}")
+            continue
+        print(f"{size:>11}B" + "".join(f"{ratio(zdict, p):13.2f}x" for p in payloads.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Content-addressed storage for attachment data.
+
+Blobs are keyed by the SHA-256 of their uncompressed content and stored
+gzip-compressed under two levels of fan-out directories
+(``ab/cd/abcd....gz``) so no single directory grows unbounded.  Identical
+uploads therefore share one file; callers track references themselves and
+call :meth:`BlobStore.delete` once nothing refers to a digest any more.
+:meth:`BlobStore.collect` sweeps up whatever that missed, e.g. blobs still
+inside the delete grace period when their last reference went.
+"""
+from __future__ import annotations
+
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import BinaryIO, Tuple
+
+CHUNK_SIZE = 64 * 1024
+# temporary files older than this were left by uploads that died
+TMP_GRACE = 24 * 3600.0
+
+
+class BlobStore:
+    """Directory of gzip-compressed blobs addressed by SHA-256."""
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / f"{digest}.gz"
+
+    def exists(self, digest: str) -> bool:
+        return self.path(digest).exists()
+
+    def _tmp(self):
+        tmp_dir = self.root / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        fd, name = tempfile.mkstemp(dir=tmp_dir)
+        return os.fdopen(fd, "wb"), Path(name)
+
+    def _commit(self, tmp: Path, digest: str) -> None:
+        dest = self.path(digest)
+        if dest.exists():
+            tmp.unlink(missing_ok=True)
+            # refresh mtime so a concurrent collect() leaves it alone
+            os.utime(dest)
+            return
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, dest)
+
+    def put(self, stream: BinaryIO) -> Tuple[str, int]:
+        """Store the uncompressed *stream* and return ``(digest, size)``."""
+        h = hashlib.sha256()
+        size = 0
+        raw, tmp = self._tmp()
+        try:
+            with raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as out:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    size += len(chunk)
+                    out.write(chunk)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        digest = h.hexdigest()
+        self._commit(tmp, digest)
+        return digest, size
+
+    def put_compressed(self, digest: str, stream: BinaryIO) -> int:
+        """Store an already gzip-compressed blob, verifying it hashes to *digest*.
+
+        Returns the uncompressed size.  Raises ``ValueError`` on mismatch.
+        """
+        raw, tmp = self._tmp()
+        try:
+            with raw:
+                shutil.copyfileobj(stream, raw, CHUNK_SIZE)
+            h = hashlib.sha256()
+            size = 0
+            with gzip.open(tmp, "rb") as f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    size += len(chunk)
+            if h.hexdigest() != digest:
+                raise ValueError(f"blob does not match digest {digest}")
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        self._commit(tmp, digest)
+        return size
+
+    def open(self, digest: str) -> BinaryIO:
+        """Return a file object yielding the uncompressed blob."""
+        return gzip.open(self.path(digest), "rb")
+
+    def delete(self, digest: str, grace: float = 60.0) -> bool:
+        """Remove *digest* unless it was written within the last *grace* seconds.
+
+        The grace period covers uploads that found the blob already present
+        but have not yet committed the row referencing it.
+        """
+        path = self.path(digest)
+        try:
+            if time.time() - path.stat().st_mtime < grace:
+                return False
+            path.unlink()
+        except FileNotFoundError:
+            return False
+        for parent in (path.parent, path.parent.parent):
+            try:
+                parent.rmdir()
+            except OSError:
+                break
+        return True
+
+    def collect(self, referenced, grace: float = 60.0) -> list[str]:
+        """Delete every blob whose digest is not in *referenced*; return those digests.
+
+        Blobs written within the last *grace* seconds are kept, as in
+        :meth:`delete`.  Temporary files from interrupted uploads are removed
+        once older than :data:`TMP_GRACE`.
+        """
+        removed = []
+        for path in sorted(self.root.glob("??/??/*.gz")):
+            digest = path.name[: -len(".gz")]
+            if digest not in referenced and self.delete(digest, grace):
+                removed.append(digest)
+        now = time.time()
+        for tmp in (self.root / "tmp").glob("*"):
+            try:
+                if now - tmp.stat().st_mtime > TMP_GRACE:
+                    tmp.unlink()
+            except FileNotFoundError:
+                pass
+        return removed
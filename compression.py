@@ -0,0 +1,110 @@
+"""zstd settings and trained dictionaries for sync packages and radio frames.
+
+Small payloads (a handful of JSON messages, a 256-byte radio chunk) barely
+compress on their own because zstd has no history to match against.  A
+dictionary trained on a sample of ``messages`` supplies that history.
+Dictionaries are stored in ``zstd_dicts`` keyed by the id zstd assigns at
+training time; the id is written into every frame header, so the
+receiving side picks the right dictionary without any extra signalling,
+provided it has imported it (``bbs.py sync dict export/import``).
+"""
+import json
+from datetime import datetime
+from functools import lru_cache
+
+import zstandard as zstd
+
+from db import get_conn
+
+DEFAULT_LEVEL = 3
+DICT_SIZE = 16 * 1024
+DICT_SAMPLES = 5000
+# window used with long-distance matching; also the decoder's limit
+LONG_WINDOW_LOG = 27
+
+
+def train_dictionary(db_path, size=DICT_SIZE, samples=DICT_SAMPLES):
+    """Train a dictionary on up to *samples* random messages and store it.
+
+    Returns the new dictionary id.  zstd needs a few hundred samples to
+    produce a useful dictionary and raises ``zstd.ZstdError`` on too few.
+    """
+    conn = get_conn(db_path)
+    rows = conn.execute(
+        "SELECT * FROM messages ORDER BY RANDOM() LIMIT ?", (samples,)
+    ).fetchall()
+    # samples look like the records sync packages carry
+    corpus = [json.dumps(dict(r)).encode() for r in rows]
+    trained = zstd.train_dictionary(size, corpus)
+    return _store(conn, trained.as_bytes(), len(corpus))
+
+
+def import_dictionary(db_path, data):
+    """Store dictionary bytes exported by another node; return its id."""
+    return _store(get_conn(db_path), data, None)
+
+
+def _store(conn, data, samples):
+    dict_id = zstd.ZstdCompressionDict(data).dict_id()
+    conn.execute(
+        """INSERT OR IGNORE INTO zstd_dicts (dict_id, data, size, samples, created_at)
+        VALUES (?,?,?,?,?)""",
+        (dict_id, data, len(data), samples, datetime.utcnow().isoformat()),
+    )
+    conn.commit()
+    return dict_id
+
+
+def list_dictionaries(db_path):
+    """Return metadata for every stored dictionary, newest first."""
+    rows = get_conn(db_path).execute(
+        "SELECT dict_id, size, samples, created_at FROM zstd_dicts ORDER BY created_at DESC"
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def latest_dictionary_id(db_path):
+    """Return the id of the newest dictionary, or ``None``."""
+    row = get_conn(db_path).execute(
+        "SELECT dict_id FROM zstd_dicts ORDER BY created_at DESC, rowid DESC LIMIT 1"
+    ).fetchone()
+    return row['dict_id'] if row else None
+
+
+def dictionary_bytes(db_path, dict_id):
+    row = get_conn(db_path).execute(
+        "SELECT data FROM zstd_dicts WHERE dict_id=?", (dict_id,)
+    ).fetchone()
+    if row is None:
+        raise KeyError(f'unknown zstd dictionary {dict_id}; import it first')
+    return bytes(row['data'])
+
+
+@lru_cache(maxsize=32)
+def get_dictionary(db_path, dict_id):
+    """Return dictionary *dict_id*; raises ``KeyError`` if it is unknown."""
+    return zstd.ZstdCompressionDict(dictionary_bytes(db_path, dict_id))
+
+
+def compressor(level=DEFAULT_LEVEL, zdict=None, long_distance=False, threads=0):
+    """Return a compressor for *level*, optionally with a dictionary or LDM.
+
+    Long-distance matching widens the window to ``2**LONG_WINDOW_LOG`` so
+    repeated content far apart in a large archive is still found; it is of
+    no use for small payloads.
+    """
+    if long_distance:
+        params = zstd.ZstdCompressionParameters.from_level(
+            level, enable_ldm=True, window_log=LONG_WINDOW_LOG, threads=threads
+        )
+        return zstd.ZstdCompressor(compression_params=params, dict_data=zdict)
+    return zstd.ZstdCompressor(level=level, dict_data=zdict, threads=threads)
+
+
+def decompressor(db_path, frame):
+    """Return a decompressor for *frame*, loading the dictionary it names."""
+    dict_id = zstd.get_frame_parameters(frame).dict_id
+    zdict = get_dictionary(str(db_path), dict_id) if dict_id else None
+    return zstd.ZstdDecompressor(
+        dict_data=zdict, max_window_size=2 ** LONG_WINDOW_LOG
+    )
@@ -1,19 +1,108 @@
+import os
 import sqlite3
+import threading
+import time
+import uuid
 from pathlib import Path
 from datetime import datetime
 
+from metrics import count_sql
+
 DB_PATH = Path('openbbs.db')
 
+# applied to every pooled connection
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA busy_timeout=5000",
+)
+STATEMENT_CACHE_SIZE = 256
+
+# entity name in ``changes`` -> table holding its rows
+ENTITY_TABLES = {'thread': 'threads', 'message': 'messages'}
+
+_initialized: set = set()
+_init_lock = threading.Lock()
+_pools: dict = {}
+_pools_lock = threading.Lock()
+
 def connect(db_path=DB_PATH):
     conn = sqlite3.connect(db_path)
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db(db_path=DB_PATH):
-    conn = connect(db_path)
-    cur = conn.cursor()
+def table_columns(conn):
+    """Return ``{table: {column, ...}}`` for every table in one pass."""
+    tables = [
+        r[0] for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+        )
+    ]
+    return {
+        t: {c[1] for c in conn.execute(f'PRAGMA table_info("{t}")')} for t in tables
+    }
+
+
+def add_column(conn, schema, table, name, ddl):
+    """``ALTER TABLE`` *table* to add *name* unless the inspected *schema* has it."""
+    if name in schema.get(table, ()):
+        return
+    conn.execute(f'ALTER TABLE "{table}" ADD COLUMN {name} {ddl}')
+    schema.setdefault(table, set()).add(name)
+
+
+def _schema_version(conn, component):
+    try:
+        row = conn.execute(
+            "SELECT version FROM schema_version WHERE component=?", (component,)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row else 0
+
+
+def migrate(conn, component, steps):
+    """Apply the pending *steps* of *component* and return their versions.
+
+    Step ``n`` (1-based) of *steps* is a callable ``step(conn, schema)`` that
+    moves the schema from version ``n - 1`` to ``n``; *schema* is the result
+    of a single :func:`table_columns` pass shared by all pending steps.
+    Versions are tracked per component in ``schema_version``, so when the
+    database is current this costs one indexed lookup.
+    """
+    if _schema_version(conn, component) >= len(steps):
+        return []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS schema_version (
+                component TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            )"""
+        )
+        # another process may have migrated while we waited for the lock
+        current = _schema_version(conn, component)
+        schema = table_columns(conn)
+        applied = []
+        for version, step in enumerate(steps[current:], start=current + 1):
+            step(conn, schema)
+            applied.append(version)
+        conn.execute(
+            "INSERT OR REPLACE INTO schema_version (component, version) VALUES (?,?)",
+            (component, len(steps)),
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return applied
+
+
+def _core_v1(conn, schema):
     # basic threads table
-    cur.execute(
+    conn.execute(
         """CREATE TABLE IF NOT EXISTS threads (
             id TEXT PRIMARY KEY,
             title TEXT,
@@ -22,7 +111,7 @@ def init_db(db_path=DB_PATH):
         )"""
     )
     # messages now carry an updated_at field for merge logic
-    cur.execute(
+    conn.execute(
         """CREATE TABLE IF NOT EXISTS messages (
             id TEXT PRIMARY KEY,
             thread_id TEXT,
@@ -33,7 +122,7 @@ def init_db(db_path=DB_PATH):
         )"""
     )
     # client outbox queue
-    cur.execute(
+    conn.execute(
         """CREATE TABLE IF NOT EXISTS outbox (
             id TEXT PRIMARY KEY,
             thread_id TEXT,
@@ -42,7 +131,7 @@ def init_db(db_path=DB_PATH):
         )"""
     )
     # sync log for auditing operations
-    cur.execute(
+    conn.execute(
         """CREATE TABLE IF NOT EXISTS sync_log (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             op TEXT,
@@ -50,16 +139,305 @@ def init_db(db_path=DB_PATH):
             details TEXT
         )"""
     )
-    conn.commit()
-    conn.close()
+
+
+def _core_v2(conn, schema):
+    # attachments referenced by content hash (see blobstore.BlobStore)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS message_attachments (
+            message_id TEXT,
+            sha256 TEXT,
+            name TEXT,
+            size INTEGER,
+            PRIMARY KEY (message_id, sha256)
+        )"""
+    )
+
+
+def _core_v3(conn, schema):
+    # change capture: one row per thread/message write, in commit order
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_id TEXT NOT NULL,
+            op TEXT NOT NULL,
+            changed_at TEXT
+        )"""
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS changes_entity ON changes (entity, entity_id)"
+    )
+
+
+def _core_v4(conn, schema):
+    # hybrid logical clock stamps for merge order and tombstones
+    add_column(conn, schema, 'threads', 'hlc', 'TEXT')
+    add_column(conn, schema, 'messages', 'hlc', 'TEXT')
+    add_column(conn, schema, 'changes', 'hlc', 'TEXT')
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS node_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )"""
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO node_state (key, value) VALUES ('node_id', ?)",
+        (uuid.uuid4().hex[:12],),
+    )
+
+
+def _core_v5(conn, schema):
+    # which peer a change was imported from, so it is not echoed back
+    add_column(conn, schema, 'changes', 'origin', 'TEXT')
+    # log rows written before change capture so cursor 0 means everything
+    for entity, table in ENTITY_TABLES.items():
+        conn.execute(
+            f"""INSERT INTO changes (entity, entity_id, op, changed_at)
+            SELECT ?, id, 'upsert', updated_at FROM {table}
+            WHERE id NOT IN (SELECT entity_id FROM changes WHERE entity=?)""",
+            (entity, entity)
+        )
+    # per-peer sync state and the packages exchanged with each peer
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS sync_peers (
+            peer_id TEXT PRIMARY KEY,
+            acked_cursor INTEGER NOT NULL DEFAULT 0,
+            sent_cursor INTEGER NOT NULL DEFAULT 0,
+            received_cursor INTEGER NOT NULL DEFAULT 0,
+            bytes_sent INTEGER NOT NULL DEFAULT 0,
+            bytes_received INTEGER NOT NULL DEFAULT 0,
+            last_sync TEXT
+        )"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS sync_packages (
+            sha256 TEXT,
+            peer_id TEXT,
+            direction TEXT,
+            cursor INTEGER,
+            size INTEGER,
+            created_at TEXT,
+            PRIMARY KEY (sha256, peer_id, direction)
+        )"""
+    )
+
+
+def _core_v6(conn, schema):
+    # trained zstd dictionaries, see compression.py
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS zstd_dicts (
+            dict_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            size INTEGER,
+            samples INTEGER,
+            created_at TEXT
+        )"""
+    )
+
+
+def _core_v7(conn, schema):
+    # exports read messages thread by thread
+    conn.execute("CREATE INDEX IF NOT EXISTS messages_thread ON messages (thread_id, timestamp)")
+
+
+def _core_v8(conn, schema):
+    # chunked package transfers and their per-chunk progress, see transfer.py
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS transfers (
+            transfer_id TEXT,
+            direction TEXT,
+            size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            chunks TEXT NOT NULL,
+            bitmap BLOB NOT NULL,
+            path TEXT,
+            peer TEXT,
+            created_at TEXT,
+            completed_at TEXT,
+            PRIMARY KEY (transfer_id, direction)
+        )"""
+    )
+
+
+def _core_v9(conn, schema):
+    # hex Ed25519 signature by the message's author, see keycache.sign_message
+    add_column(conn, schema, 'messages', 'signature', 'TEXT')
+
+
+def _core_v10(conn, schema):
+    # delivery state of queued posts, see outbox.OutboxFlusher
+    add_column(conn, schema, 'outbox', 'author', 'TEXT')
+    add_column(conn, schema, 'outbox', 'state', "TEXT NOT NULL DEFAULT 'pending'")
+    add_column(conn, schema, 'outbox', 'attempts', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, schema, 'outbox', 'next_attempt', 'REAL NOT NULL DEFAULT 0')
+    add_column(conn, schema, 'outbox', 'batch_id', 'TEXT')
+    add_column(conn, schema, 'outbox', 'sent_at', 'REAL')
+    add_column(conn, schema, 'outbox', 'acked_at', 'TEXT')
+    add_column(conn, schema, 'outbox', 'last_error', 'TEXT')
+    conn.execute("CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, queued_at)")
+
+
+def _core_v11(conn, schema):
+    # outcome of importing a received package, so a failed import is retried
+    add_column(conn, schema, 'transfers', 'imported_at', 'TEXT')
+    add_column(conn, schema, 'transfers', 'import_result', 'TEXT')
+    add_column(conn, schema, 'transfers', 'import_error', 'TEXT')
+
+
+# ordered schema steps for the sync tables; append, never reorder
+CORE_MIGRATIONS = [
+    _core_v1, _core_v2, _core_v3, _core_v4, _core_v5, _core_v6, _core_v7, _core_v8,
+    _core_v9, _core_v10, _core_v11,
+]
+
+
+def init_db(db_path=DB_PATH):
+    conn = connect(db_path)
+    try:
+        migrate(conn, 'core', CORE_MIGRATIONS)
+    finally:
+        conn.close()
+
+
+def ensure_schema(db_path=DB_PATH):
+    """Run :func:`init_db` for *db_path* once per process."""
+    key = str(Path(db_path).resolve())
+    if key in _initialized:
+        return
+    with _init_lock:
+        if key not in _initialized:
+            init_db(db_path)
+            _initialized.add(key)
+
+
+class ConnectionPool:
+    """Hand out one pre-configured connection per thread for a database.
+
+    Connections are created on first use in each thread with the pragmas in
+    :data:`PRAGMAS` applied, a larger prepared-statement cache and
+    :func:`metrics.count_sql` counting their statements, and are then
+    reused for the life of the thread.  Callers commit or roll back but
+    never close them.
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = str(db_path)
+        self._local = threading.local()
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        # a forked child must not share its parent's sqlite handle
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        ensure_schema(self.db_path)
+        conn = sqlite3.connect(self.db_path, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        conn.set_trace_callback(count_sql)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def release(self):
+        """Roll back anything the current thread left uncommitted."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+
+    def close(self):
+        """Close the current thread's connection."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def get_pool(db_path=DB_PATH):
+    """Return the process-wide pool for *db_path*."""
+    key = str(Path(db_path).resolve())
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(key, ConnectionPool(key))
+    return pool
+
+
+def get_conn(db_path=DB_PATH):
+    """Return the calling thread's pooled connection to *db_path*."""
+    return get_pool(db_path).get()
+
+
+def _parse_hlc(value):
+    wall, counter, _ = value.split('-', 2)
+    return int(wall), int(counter)
+
+
+def next_hlc(conn, remote=None):
+    """Advance this node's hybrid logical clock and return the new stamp.
+
+    Stamps are ``<wall ms>-<counter>-<node id>`` strings that sort in
+    causal order across nodes regardless of clock skew; passing the
+    *remote* stamp of a received row moves the clock past it.  The caller
+    must already hold the write lock (i.e. have written in this
+    transaction) so concurrent writers cannot read the same state.
+    """
+    state = dict(conn.execute("SELECT key, value FROM node_state").fetchall())
+    now = int(time.time() * 1000)
+    last_wall, last_count = _parse_hlc(state['hlc']) if 'hlc' in state else (0, 0)
+    wall = max(now, last_wall)
+    count = last_count + 1 if wall == last_wall else 0
+    if remote:
+        r_wall, r_count = _parse_hlc(remote)
+        if r_wall > wall:
+            wall, count = r_wall, r_count + 1
+        elif r_wall == wall:
+            count = max(count, r_count + 1)
+    stamp = f"{wall:013d}-{count:05d}-{state['node_id']}"
+    conn.execute("INSERT OR REPLACE INTO node_state (key, value) VALUES ('hlc', ?)", (stamp,))
+    return stamp
+
+
+def log_change(conn, entity, entity_id, op='upsert', hlc=None, origin=None):
+    """Append a ``changes`` row for *entity* (``thread`` or ``message``).
+
+    Call it on the connection that made the write, before committing, so the
+    change is recorded in the same transaction as the row it describes.  The
+    change is stamped with a fresh clock value, or with *hlc* for rows
+    imported from a peer, and an upserted row carries the same stamp.
+    *origin* names the peer an imported change came from.
+    """
+    if hlc is None:
+        hlc = next_hlc(conn)
+    else:
+        next_hlc(conn, hlc)
+    conn.execute(
+        "INSERT INTO changes (entity, entity_id, op, changed_at, hlc, origin) VALUES (?,?,?,?,?,?)",
+        (entity, entity_id, op, datetime.utcnow().isoformat(), hlc, origin),
+    )
+    if op == 'upsert':
+        conn.execute(
+            f"UPDATE {ENTITY_TABLES[entity]} SET hlc=? WHERE id=?", (hlc, entity_id)
+        )
+    return hlc
+
+
+def node_id(conn):
+    """Return this database's node id."""
+    return conn.execute("SELECT value FROM node_state WHERE key='node_id'").fetchone()[0]
+
+
+def high_water(conn):
+    """Return the newest change sequence number, or 0."""
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
 
 
 def record_sync(db_path, op, details=""):
     """Insert a sync operation record."""
-    conn = connect(db_path)
+    conn = get_conn(db_path)
     conn.execute(
         "INSERT INTO sync_log (op, timestamp, details) VALUES (?,?,?)",
         (op, datetime.utcnow().isoformat(), details),
     )
     conn.commit()
-    conn.close()
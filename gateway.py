@@ -0,0 +1,367 @@
+"""Radio gateway: exchange sync deltas with one peer over a radio link.
+
+A :class:`Gateway` keeps the radio interface open and runs four threads:
+
+* **receive** reads the modem and cuts the byte stream into KISS frames;
+* **decode** checks each frame's CRC and FEC and feeds it to the transfer
+  protocol of :mod:`transfer` (our :class:`transfer.RadioReceiver`, or
+  the :class:`transfer.RadioSender` of the package we are sending);
+* **apply** imports each completed package with :meth:`SyncEngine.push`,
+  which applies a binary package record by record as it streams;
+* **link** exports what the peer has not acknowledged as a binary delta
+  package and queues it on a :class:`scheduler.LinkScheduler`, which
+  starts the transfer within the channel's duty cycle.
+
+The stages hand work on through bounded queues, so a slow database
+applies back-pressure to the radio rather than growing memory.  Frames
+travel as ``KISS(add_crc(fec_encode(frame)))``, like
+:class:`radio.SlidingWindowARQ`; a lost frame is recovered by the
+transfer protocol's status exchange, and a transfer that hears nothing
+for *retry* seconds sends its manifest again.  One package is in flight
+each way at a time.  Holding the whole package is not enough: once the
+peer has imported it, it answers with an import ack frame, and only then
+are our changes up to the package's cursor acknowledged and the next
+delta started after them.  A sender that hears no ack for *retry* seconds
+asks again; the peer answers from the import outcome recorded on the
+transfer, or imports the package again if that failed.
+"""
+import logging
+import queue
+import socket
+import struct
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import metrics
+from db import get_conn
+from radio import FEND, add_crc, fec_decode, fec_encode, kiss_decode, kiss_encode, verify_crc
+from scheduler import LinkScheduler
+from transfer import (
+    RADIO_CHUNK_SIZE, RADIO_MTU, STATUS_FRAME, RadioReceiver, RadioSender, TransferStore,
+)
+
+# frames and packages waiting between stages
+FRAME_QUEUE = 256
+PACKAGE_QUEUE = 4
+# seconds a stage waits on its queue before checking for shutdown
+POLL = 0.05
+
+# ack  = b'A' id:8 cursor:u64   the peer imported the package up to cursor
+# query = b'K' id:8 cursor:u64  ask the peer whether it imported it
+_ACK = struct.Struct('>c8sQ')
+ACK_FRAME = b'A'
+ACK_QUERY_FRAME = b'K'
+
+QUEUE_DEPTH = metrics.gauge('radio_queue_depth', 'Items waiting in a radio queue', ('queue',))
+
+logger = logging.getLogger('gateway')
+
+
+def split_kiss(buffer):
+    """Remove complete KISS frames from the bytearray *buffer* and return them."""
+    frames = []
+    while True:
+        start = buffer.find(FEND)
+        if start < 0:
+            buffer.clear()
+            return frames
+        end = buffer.find(FEND, start + 1)
+        if end < 0:
+            del buffer[:start]
+            return frames
+        if end == start + 1:
+            # two FENDs in a row: the second one opens the next frame
+            del buffer[:end]
+            continue
+        frames.append(bytes(buffer[start:end + 1]))
+        del buffer[:end + 1]
+
+
+class Gateway:
+    """Sync *engine*'s database with *peer* over the radio interface *iface*.
+
+    *iface* needs ``send(bytes)`` and ``receive(size)`` (e.g.
+    :class:`radio.VaraHFClient` or :class:`radio.RadioInterface`).
+    *peer* is the other node's id; if ``None`` it is learnt from the first
+    package received, and nothing is sent before then.  *work_dir* holds
+    outgoing packages while they are in flight.  Deltas are checked for
+    every *interval* seconds; *window* is the scheduler's minimum gap
+    between transfers.
+    """
+
+    def __init__(self, engine, iface, work_dir, peer=None, store=None, interval=30.0,
+                 window=0.0, retry=30.0, mtu=RADIO_MTU, frame_queue=FRAME_QUEUE,
+                 package_queue=PACKAGE_QUEUE):
+        self.engine = engine
+        self.iface = iface
+        self.work_dir = Path(work_dir)
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.peer = peer
+        self.store = store or TransferStore(engine.db_path, self.work_dir / 'in')
+        self.interval = interval
+        self.retry = retry
+        self.mtu = mtu
+        self.frames = queue.Queue(frame_queue)
+        self.packages = queue.Queue(package_queue)
+        self._frame_depth = QUEUE_DEPTH.labels('gateway_frames')
+        self._package_depth = QUEUE_DEPTH.labels('gateway_packages')
+        self.receiver = RadioReceiver(self.store, self._received, mtu=mtu)
+        self.scheduler = LinkScheduler(self._begin, window=window)
+        self.stats = {
+            'frames_in': 0, 'frames_bad': 0, 'frames_out': 0,
+            'packages_in': 0, 'packages_out': 0, 'messages_in': 0, 'errors': 0,
+        }
+        self._stop = threading.Event()
+        self._tx_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._threads = []
+        # the outgoing transfer: (sender, cursor, path, last heard)
+        self._outgoing = None
+        # incoming transfers queued for or being imported
+        self._applying = set()
+        self._queued = False
+        self._next_check = 0.0
+
+    # -- lifecycle
+
+    def start(self):
+        for name in ('receive', 'decode', 'apply', 'link'):
+            t = threading.Thread(target=getattr(self, f'_{name}_loop'), name=f'gateway-{name}',
+                                 daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def run(self, metrics_file=None):
+        """Run until interrupted, writing a metrics snapshot to *metrics_file* if given."""
+        self.start()
+        try:
+            while not self._stop.wait(self.interval):
+                logger.info('gateway: %s', self.stats)
+                if metrics_file:
+                    metrics.dump(metrics_file)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            if metrics_file:
+                metrics.dump(metrics_file)
+
+    def idle(self):
+        """Return True when nothing is queued, in flight or being applied."""
+        with self._lock:
+            busy = self._outgoing is not None or self._queued
+        return not busy and self.frames.empty() and self.packages.empty() \
+            and not self.packages.unfinished_tasks
+
+    # -- radio
+
+    def _transmit(self, frames):
+        with self._tx_lock:
+            for frame in frames:
+                self.iface.send(kiss_encode(add_crc(fec_encode(frame))))
+                self.stats['frames_out'] += 1
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=POLL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _receive_loop(self):
+        buffer = bytearray()
+        while not self._stop.is_set():
+            try:
+                data = self.iface.receive(4096)
+            except (socket.timeout, TimeoutError):
+                data = b''
+            except OSError as exc:
+                logger.warning('radio receive failed: %s', exc)
+                self.stats['errors'] += 1
+                self._stop.wait(1.0)
+                continue
+            if not data:
+                self._stop.wait(POLL)
+                continue
+            buffer += data
+            for frame in split_kiss(buffer):
+                if not self._put(self.frames, frame):
+                    return
+            self._frame_depth.set(self.frames.qsize())
+
+    def _decode_loop(self):
+        while not self._stop.is_set():
+            try:
+                raw = self.frames.get(timeout=POLL)
+            except queue.Empty:
+                continue
+            self._frame_depth.set(self.frames.qsize())
+            try:
+                frame = fec_decode(verify_crc(kiss_decode(raw)))
+            except Exception:
+                self.stats['frames_bad'] += 1
+                continue
+            self.stats['frames_in'] += 1
+            try:
+                self._transmit(self._dispatch(frame))
+            except Exception:
+                logger.exception('radio frame failed')
+                self.stats['errors'] += 1
+
+    def _dispatch(self, frame):
+        kind = frame[:1]
+        if kind in (ACK_FRAME, ACK_QUERY_FRAME):
+            if len(frame) != _ACK.size:
+                return []
+            _, prefix, cursor = _ACK.unpack(frame)
+            if kind == ACK_QUERY_FRAME:
+                return self._answer_query(prefix.hex())
+            self._imported(prefix.hex())
+            return []
+        if kind != STATUS_FRAME:
+            return self.receiver.handle(frame)
+        with self._lock:
+            if self._outgoing is None:
+                return []
+            sender, cursor, path, _ = self._outgoing
+            if sender.done:
+                return []
+            replies = sender.handle(frame)
+            # once the peer holds the whole package, wait for its import ack
+            self._outgoing = (sender, cursor, path, time.monotonic())
+        return replies
+
+    def _imported(self, prefix):
+        with self._lock:
+            if self._outgoing is None:
+                return
+            sender, cursor, path, _ = self._outgoing
+            if not sender.tid.startswith(prefix):
+                return
+            self._outgoing = None
+        self.engine.acknowledge(self.peer, cursor)
+        Path(path).unlink(missing_ok=True)
+        self.stats['packages_out'] += 1
+
+    # -- incoming packages
+
+    def _ack_frame(self, kind, tid, cursor):
+        return _ACK.pack(kind, bytes.fromhex(tid[:16]), cursor or 0)
+
+    def _answer_query(self, prefix):
+        try:
+            tid = self.store.find(prefix)
+            status = self.store.status(tid)
+        except KeyError:
+            return []
+        if status['imported']:
+            return [self._ack_frame(ACK_FRAME, tid, status['import']['cursor'])]
+        if status['complete']:
+            # the import failed earlier; try it again
+            self._received(tid, self.store.path(tid))
+        return []
+
+    def _received(self, tid, path):
+        if self.store.status(tid)['imported']:
+            # a repeated chunk of a package we already imported
+            return
+        with self._lock:
+            if tid in self._applying:
+                return
+            self._applying.add(tid)
+        self._put(self.packages, (tid, path))
+        self._package_depth.set(self.packages.qsize())
+
+    def _apply_loop(self):
+        while not self._stop.is_set():
+            try:
+                tid, path = self.packages.get(timeout=POLL)
+            except queue.Empty:
+                continue
+            self._package_depth.set(self.packages.qsize())
+            try:
+                summary = self.engine.push(str(path))
+                self.store.record_import(tid, summary)
+                self.stats['packages_in'] += 1
+                self.stats['messages_in'] += summary['messages']
+                if self.peer is None:
+                    self.peer = summary['peer']
+                self._transmit([self._ack_frame(ACK_FRAME, tid, summary['cursor'])])
+            except Exception as exc:
+                logger.exception('applying %s failed', path)
+                self.store.record_import(tid, error=str(exc))
+                self.stats['errors'] += 1
+            finally:
+                with self._lock:
+                    self._applying.discard(tid)
+                self.packages.task_done()
+
+    # -- outgoing deltas
+
+    def _pending_changes(self):
+        state = self.engine.peer_state(self.peer)
+        row = get_conn(self.engine.db_path).execute(
+            "SELECT 1 FROM changes WHERE seq>? AND (origin IS NULL OR origin<>?) LIMIT 1",
+            (state['acked_cursor'], self.peer),
+        ).fetchone()
+        return row is not None
+
+    def _queue_delta(self):
+        with self._lock:
+            if self._outgoing is not None or self._queued:
+                return
+        if not self._pending_changes():
+            return
+        with self._lock:
+            self._queued = True
+        self.scheduler.queue_packet(b'delta')
+
+    def _begin(self, _item):
+        """Export the delta and start sending it; ``LinkScheduler.send_fn``.
+
+        If this raises, the scheduler backs off and calls it again.
+        """
+        path = self.work_dir / f'out-{uuid.uuid4().hex}.zst'
+        summary = self.engine.export(output_path=str(path), peer=self.peer, format='pack')
+        tid = self.store.offer(str(path), chunk_size=RADIO_CHUNK_SIZE, peer=self.peer)['id']
+        sender = RadioSender(self.store, tid, self.mtu)
+        with self._lock:
+            self._outgoing = (sender, summary['cursor'], path, time.monotonic())
+            self._queued = False
+        self._transmit(sender.start())
+
+    def _resend_stalled(self):
+        with self._lock:
+            if self._outgoing is None:
+                return
+            sender, cursor, path, heard = self._outgoing
+            if time.monotonic() - heard < self.retry:
+                return
+            self._outgoing = (sender, cursor, path, time.monotonic())
+        if sender.done:
+            self._transmit([self._ack_frame(ACK_QUERY_FRAME, sender.tid, cursor)])
+        else:
+            self._transmit(sender.start())
+
+    def _link_loop(self):
+        while not self._stop.is_set():
+            try:
+                if self.peer is not None and time.monotonic() >= self._next_check:
+                    self._next_check = time.monotonic() + self.interval
+                    self._queue_delta()
+                self.scheduler.run_once()
+                self._resend_stalled()
+            except Exception:
+                logger.exception('gateway link step failed')
+                self.stats['errors'] += 1
+            self._stop.wait(POLL)
@@ -1,56 +1,204 @@
 from __future__ import annotations
 import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from cryptography.hazmat.primitives.asymmetric.ed25519 import (
     Ed25519PrivateKey,
     Ed25519PublicKey,
 )
+from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives import serialization
 
+from db import migrate
+
+# parsed keys kept per process, so each author's key is parsed once; also
+# the number of users whose current key (or lack of one) a store remembers
+KEY_CACHE_SIZE = 4096
+# messages per task when verification is spread over a process pool
+VERIFY_CHUNK = 500
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def load_public_key(raw: bytes) -> Ed25519PublicKey:
+    """Return the public key for 32 *raw* bytes, parsing each key once."""
+    return Ed25519PublicKey.from_public_bytes(raw)
+
 
 class KeyCache:
-    """Simple on-disk cache of public keys with version counters."""
+    """On-disk store of public keys with version counters and history.
+
+    Keys live in a SQLite database at *path*, indexed by user and version,
+    so opening the store reads nothing and a rotation writes one row.
+    Lookups go to the database the first time a user is asked for and are
+    then answered from memory, including for users with no key, for up to
+    :data:`KEY_CACHE_SIZE` recently asked-for users.  A *path* ending in ``.json`` names the
+    legacy format: the store is kept next to it with a ``.db`` suffix, and
+    an existing JSON file is imported once and renamed to ``.json.bak``.
+    """
 
     def __init__(self, path: str | Path):
-        self.path = Path(path)
-        self._cache: Dict[str, Dict[str, str | int]] = {}
-        self._load()
+        path = Path(path)
+        legacy = path.with_suffix(".json")
+        self.path = path.with_suffix(".db") if path.suffix == ".json" else path
+        self._raw: OrderedDict[str, Optional[Tuple[int, bytes]]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        migrate(self._conn, "keys", KEY_MIGRATIONS)
+        if legacy.exists() and legacy != self.path:
+            self._import_legacy(legacy)
 
-    def _load(self) -> None:
-        if not self.path.exists():
-            return
+    def _import_legacy(self, legacy: Path) -> None:
         try:
-            data = json.loads(self.path.read_text())
-        except Exception:
+            data = json.loads(legacy.read_text())
+        except ValueError:
             return
-        self._cache = {
-            k: {"version": v["version"], "key": v["key"]} for k, v in data.items()
-        }
-
-    def _save(self) -> None:
-        tmp = self.path.with_suffix(".tmp")
-        tmp.write_text(json.dumps(self._cache))
-        tmp.replace(self.path)
-
-    def get(self, user: str) -> Optional[Ed25519PublicKey]:
-        info = self._cache.get(user)
-        if not info:
+        self.bulk_import((user, v["version"], v["key"]) for user, v in data.items())
+        legacy.replace(legacy.with_suffix(".json.bak"))
+
+    def _current(self, user: str) -> Optional[Tuple[int, bytes]]:
+        with self._lock:
+            if user in self._raw:
+                self._raw.move_to_end(user)
+                return self._raw[user]
+            row = self._conn.execute(
+                "SELECT version, key FROM keys WHERE user=? ORDER BY version DESC LIMIT 1",
+                (user,),
+            ).fetchone()
+            # misses are remembered too; update() and bulk_import() drop them
+            current = self._raw[user] = (row[0], bytes(row[1])) if row else None
+            if len(self._raw) > KEY_CACHE_SIZE:
+                self._raw.popitem(last=False)
+            return current
+
+    def key_bytes(self, user: str) -> Optional[bytes]:
+        """Return the raw public key of *user*, or ``None`` if unknown."""
+        current = self._current(user)
+        return current[1] if current else None
+
+    def version(self, user: str) -> Optional[int]:
+        current = self._current(user)
+        return current[0] if current else None
+
+    def get(self, user: str, version: Optional[int] = None) -> Optional[Ed25519PublicKey]:
+        """Return the current key of *user*, or the one at *version*."""
+        if version is None:
+            raw = self.key_bytes(user)
+        else:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT key FROM keys WHERE user=? AND version=?", (user, version)
+                ).fetchone()
+            raw = bytes(row[0]) if row else None
+        return load_public_key(raw) if raw is not None else None
+
+    def history(self, user: str) -> List[Dict[str, str | int]]:
+        """Return every key recorded for *user*, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT version, key, added_at FROM keys WHERE user=? ORDER BY version",
+                (user,),
+            ).fetchall()
+        return [{"version": v, "key": bytes(k).hex(), "added_at": a} for v, k, a in rows]
+
+    def verify(self, user: str, payload: bytes, signature: bytes) -> Optional[bool]:
+        """Check *signature* by *user*; ``None`` if the user's key is unknown."""
+        raw = self.key_bytes(user)
+        if raw is None:
             return None
-        key_bytes = bytes.fromhex(info["key"])
-        return Ed25519PublicKey.from_public_bytes(key_bytes)
+        return verify_signature(raw, payload, signature)
 
     def update(self, user: str, version: int, key: Ed25519PublicKey) -> None:
-        hex_key = key.public_bytes(
+        raw = key.public_bytes(
             encoding=serialization.Encoding.Raw,
             format=serialization.PublicFormat.Raw,
-        ).hex()
-        cached = self._cache.get(user)
-        if cached and cached["version"] >= version:
-            return
-        self._cache[user] = {"version": version, "key": hex_key}
-        self._save()
+        )
+        with self._lock:
+            # the version check and insert happen under the write lock, so
+            # concurrent writers cannot both pass the check
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cached = self._conn.execute(
+                    "SELECT MAX(version) FROM keys WHERE user=?", (user,)
+                ).fetchone()[0]
+                if cached is None or cached < version:
+                    self._conn.execute(
+                        "INSERT INTO keys (user, version, key, added_at) VALUES (?,?,?,?)",
+                        (user, version, raw, datetime.utcnow().isoformat()),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._raw.pop(user, None)
+
+    def bulk_import(self, records: Iterable[Tuple[str, int, str | bytes]]) -> int:
+        """Add ``(user, version, key)`` records in one transaction.
+
+        *key* is raw bytes or hex.  Versions already recorded are left
+        alone, and older versions are kept as history rather than dropped,
+        so importing a directory dump in any order gives the same store.
+        Returns the number of keys added.
+        """
+        now = datetime.utcnow().isoformat()
+        rows = (
+            (user, int(version), bytes.fromhex(key) if isinstance(key, str) else key, now)
+            for user, version, key in records
+        )
+        with self._lock:
+            before = self._conn.total_changes
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO keys (user, version, key, added_at) VALUES (?,?,?,?)",
+                    rows,
+                )
+            added = self._conn.total_changes - before
+            self._raw.clear()
+        return added
+
+    def import_file(self, path: str | Path) -> int:
+        """Bulk-import a directory dump.
+
+        The dump is either JSON in the legacy ``{user: {"version", "key"}}``
+        layout or text lines of ``user version hexkey`` (commas also
+        accepted, ``#`` starts a comment).
+        """
+        text = Path(path).read_text()
+        if text.lstrip().startswith("{"):
+            data = json.loads(text)
+            return self.bulk_import((u, v["version"], v["key"]) for u, v in data.items())
+        records = []
+        for line in text.splitlines():
+            fields = line.split("#", 1)[0].replace(",", " ").split()
+            if fields:
+                user, version, key = fields
+                records.append((user, int(version), key))
+        return self.bulk_import(records)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def _keys_v1(conn, schema):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS keys (
+            user TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            key BLOB NOT NULL,
+            added_at TEXT,
+            PRIMARY KEY (user, version)
+        ) WITHOUT ROWID"""
+    )
+
+
+# schema steps for the key store; append, never reorder
+KEY_MIGRATIONS = [_keys_v1]
 
 
 def sign_checkpoint(private_key: Ed25519PrivateKey, root_hash: bytes) -> bytes:
@@ -67,3 +215,43 @@ def verify_checkpoint(
         return True
     except Exception:
         return False
+
+
+def message_payload(message: dict) -> bytes:
+    """Return the bytes an author signs for a sync message.
+
+    Covers what the author wrote and where; ``updated_at`` and the clock
+    stamp are left out because nodes rewrite them.
+    """
+    fields = {k: message.get(k) for k in ("id", "thread_id", "timestamp", "author", "body")}
+    return json.dumps(fields, sort_keys=True, separators=(",", ":")).encode()
+
+
+def sign_message(private_key: Ed25519PrivateKey, message: dict) -> str:
+    """Return the hex signature of *message* to store in ``messages.signature``."""
+    return private_key.sign(message_payload(message)).hex()
+
+
+def verify_signature(raw_key: bytes, payload: bytes, signature: bytes) -> bool:
+    try:
+        load_public_key(raw_key).verify(signature, payload)
+        return True
+    except (InvalidSignature, ValueError):
+        return False
+
+
+def _verify_many(items: List[Tuple[bytes, bytes, bytes]]) -> List[bool]:
+    return [verify_signature(*item) for item in items]
+
+
+def verify_batch(items: Iterable[Tuple[bytes, bytes, bytes]], executor=None) -> List[bool]:
+    """Verify ``(raw_key, payload, signature)`` triples, in order.
+
+    With a process pool *executor* the work is split into chunks of
+    :data:`VERIFY_CHUNK`; each worker keeps its own parsed-key cache.
+    """
+    items = list(items)
+    if executor is None or len(items) <= VERIFY_CHUNK:
+        return _verify_many(items)
+    chunks = [items[i : i + VERIFY_CHUNK] for i in range(0, len(items), VERIFY_CHUNK)]
+    return [ok for part in executor.map(_verify_many, chunks) for ok in part]
@@ -0,0 +1,230 @@
+"""Route outgoing frames over the best of several radio links.
+
+A :class:`LinkManager` knows every interface we can transmit on and the
+neighbour each one reaches.  For each link it keeps rolling estimates,
+as exponentially weighted moving averages, of the neighbour's SNR, the
+ACK round-trip time and the frame loss.  Each neighbour also has a *path*
+quality: how well it reaches the destination (``1.0`` when it is the
+destination, e.g. the BBS node, or whatever it last advertised if it
+would relay for us).
+
+A route's score is its link quality times its neighbour's path quality.
+:meth:`LinkManager.flush` sends each queued frame on the best-scoring
+route, directly or through a relay.  Every send counts as a delivered or
+lost frame in the link's loss average.  Frames are held when no route
+beats *min_score*, but a link below it is still tried as a last resort
+once every :data:`PROBE_INTERVAL` seconds, so it can earn its way back.
+Scores are computed once per flush, not per frame.  Queues are deques
+per priority, so taking a frame off and holding it back are both O(1).
+:meth:`LinkManager.report` lists the routing decisions and each link's
+utilisation, the share of time its frames spent on the air at the
+link's baud rate.
+"""
+from __future__ import annotations
+
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+# weight of a new observation in the moving averages
+ALPHA = 0.2
+# SNR (dB) mapped to 0..1 between these bounds
+SNR_FLOOR = -10.0
+SNR_CEILING = 20.0
+# an ACK round trip of this many seconds halves a link's quality
+RTT_HALF = 5.0
+# routing decisions kept for report()
+DECISION_LOG = 256
+# seconds between last-resort tries of a link scoring below min_score
+PROBE_INTERVAL = 60.0
+# bits per second assumed for a link added without a baud rate (AX.25 VHF)
+DEFAULT_BAUD = 1200.0
+
+
+def _ewma(old, value, alpha):
+    return value if old is None else old + alpha * (value - old)
+
+
+@dataclass
+class Link:
+    """One interface and the neighbour it reaches, with rolling estimates."""
+
+    name: str
+    send: Callable[[bytes], None]
+    peer: str
+    snr: Optional[float] = None
+    rtt: Optional[float] = None
+    loss: float = 0.0
+    frames: int = 0
+    failures: int = 0
+    bytes: int = 0
+    airtime: float = 0.0
+    baud: float = DEFAULT_BAUD
+    tried: Optional[float] = None
+    created: float = field(default_factory=time.monotonic)
+
+    def quality(self) -> float:
+        """Return 0..1: delivery rate, scaled by SNR and slowed by RTT."""
+        score = 1.0 - self.loss
+        if self.snr is not None:
+            span = SNR_CEILING - SNR_FLOOR
+            score *= 0.5 + 0.5 * min(max((self.snr - SNR_FLOOR) / span, 0.0), 1.0)
+        if self.rtt is not None:
+            score *= RTT_HALF / (RTT_HALF + self.rtt)
+        return score
+
+    def frame_airtime(self, size: int) -> float:
+        """Return the seconds a frame of *size* bytes takes on the air."""
+        return size * 8 / self.baud
+
+    def utilization(self, now=None) -> float:
+        """Return the fraction of time since the link was added spent sending."""
+        elapsed = (now or time.monotonic()) - self.created
+        return min(self.airtime / elapsed, 1.0) if elapsed > 0 else 0.0
+
+
+class LinkManager:
+    """Queue frames and send each over the best available route."""
+
+    def __init__(self, alpha: float = ALPHA, min_score: float = 0.05,
+                 clock: Callable[[], float] = time.monotonic,
+                 probe_interval: float = PROBE_INTERVAL):
+        self.alpha = alpha
+        self.min_score = min_score
+        self.probe_interval = probe_interval
+        self.clock = clock
+        self.links: dict[str, Link] = {}
+        self.paths: dict[str, float] = {}
+        self._queues: dict[int, deque] = {}
+        self.routed: Counter = Counter()
+        self.decisions: deque = deque(maxlen=DECISION_LOG)
+
+    # -- links and estimates
+
+    def add_link(self, name: str, send: Callable[[bytes], None], peer: str,
+                 path: Optional[float] = None, baud: float = DEFAULT_BAUD) -> Link:
+        """Register interface *name* reaching *peer* at *baud* bits per second.
+
+        *path* is as for :meth:`set_path`.
+        """
+        link = self.links[name] = Link(name, send, peer, baud=baud, created=self.clock())
+        if path is not None:
+            self.set_path(peer, path)
+        return link
+
+    def set_path(self, peer: str, quality: float) -> None:
+        """Record how well *peer* reaches the destination (``1.0``: it is it)."""
+        self.paths[peer] = quality
+
+    def observe(self, name: str, snr: Optional[float] = None, rtt: Optional[float] = None,
+                lost: Optional[bool] = None) -> None:
+        """Fold a measurement of link *name* into its moving averages."""
+        link = self.links[name]
+        if snr is not None:
+            link.snr = _ewma(link.snr, snr, self.alpha)
+        if rtt is not None:
+            link.rtt = _ewma(link.rtt, rtt, self.alpha)
+        if lost is not None:
+            link.loss = _ewma(link.loss, 1.0 if lost else 0.0, self.alpha)
+
+    def routes(self) -> list[tuple[float, Link]]:
+        """Return ``(score, link)`` for every link, best first."""
+        scored = [(link.quality() * self.paths.get(link.peer, 0.0), link)
+                  for link in self.links.values()]
+        return sorted(scored, key=lambda pair: pair[0], reverse=True)
+
+    # -- frames
+
+    def queue(self, frame: bytes, priority: int = 10) -> None:
+        """Queue *frame*; lower *priority* values are sent first."""
+        self._queues.setdefault(priority, deque()).append(frame)
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _decide(self, frame, outcome, link=None, score=None):
+        self.routed[outcome] += 1
+        self.decisions.append({
+            'at': self.clock(), 'size': len(frame), 'outcome': outcome,
+            'link': link.name if link else None, 'peer': link.peer if link else None,
+            'score': None if score is None else round(score, 3),
+        })
+
+    def _send(self, link, frame):
+        link.tried = self.clock()
+        # a failed send may still have keyed the transmitter
+        link.airtime += link.frame_airtime(len(frame))
+        try:
+            link.send(frame)
+        except Exception:
+            link.failures += 1
+            self.observe(link.name, lost=True)
+            return False
+        self.observe(link.name, lost=False)
+        link.frames += 1
+        link.bytes += len(frame)
+        return True
+
+    def flush(self) -> int:
+        """Send every queued frame over its best route; return how many went.
+
+        A link that fails a send is skipped for the rest of this flush and
+        the frame tries the next route.  Links scoring below *min_score*
+        come last, and only those not tried for *probe_interval* seconds.
+        Frames with no usable route stay queued, in order, for the next
+        flush.
+        """
+        now = self.clock()
+        routes = []
+        for s, link in self.routes():
+            if s >= self.min_score or (
+                self.paths.get(link.peer, 0.0) > 0
+                and (link.tried is None or now - link.tried >= self.probe_interval)
+            ):
+                routes.append((s, link))
+        down = set()
+        sent = 0
+        for priority in sorted(self._queues):
+            pending = self._queues[priority]
+            held = deque()
+            while pending:
+                frame = pending.popleft()
+                for score, link in routes:
+                    if link.name in down:
+                        continue
+                    if self._send(link, frame):
+                        outcome = 'direct' if self.paths.get(link.peer) == 1.0 else 'relay'
+                        self._decide(frame, outcome, link, score)
+                        sent += 1
+                        break
+                    down.add(link.name)
+                else:
+                    self._decide(frame, 'held')
+                    held.append(frame)
+            self._queues[priority] = held
+        return sent
+
+    def report(self) -> dict:
+        """Return routing counts, recent decisions and per-link estimates."""
+        now = self.clock()
+        return {
+            'routed': dict(self.routed),
+            'queued': len(self),
+            'links': {
+                name: {
+                    'peer': link.peer,
+                    'quality': round(link.quality(), 3),
+                    'path': self.paths.get(link.peer),
+                    'snr': link.snr,
+                    'rtt': link.rtt,
+                    'loss': round(link.loss, 3),
+                    'frames': link.frames,
+                    'bytes': link.bytes,
+                    'failures': link.failures,
+                    'utilization': round(link.utilization(now), 3),
+                }
+                for name, link in self.links.items()
+            },
+            'decisions': list(self.decisions),
+        }
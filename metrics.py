@@ -0,0 +1,316 @@
+"""In-process counters, gauges and histograms.
+
+Modules declare their metrics at import time::
+
+    FRAMES_SENT = metrics.counter('radio_frames_sent_total', 'KISS frames encoded')
+    FEC_SECONDS = metrics.histogram('radio_fec_seconds', 'Reed-Solomon time', ('op',),
+                                    buckets=metrics.FAST_BUCKETS)
+
+and update them on the hot path with ``FRAMES_SENT.inc()`` or
+``FEC_SECONDS.labels('encode').observe(dt)``.  Declaring a name twice
+returns the first metric, so modules can share one.  An update is a dict
+lookup and a locked add, cheap enough for per-frame KISS and ARQ work.
+
+:func:`snapshot` returns every metric as plain data.  :func:`prometheus`
+renders them in the Prometheus text format, which the web app serves at
+``/metrics``.  :func:`dump` writes a snapshot to a JSON file, which
+long-running commands do for ``bbs.py stats --file``.
+
+:func:`count_sql` is installed as the trace callback of pooled sqlite
+connections.  It counts statements in total and per thread, so
+:func:`sql_count` gives the statements a request or job issued.
+"""
+import json
+import math
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+PREFIX = 'hambbs_'
+# seconds: web requests, sync steps
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# seconds: per-frame work such as FEC
+FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+# seconds: whole sync packages
+SLOW_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+# things counted per request, e.g. SQL statements
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_registry = {}
+_registry_lock = threading.Lock()
+_local = threading.local()
+
+
+class _Timer:
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class _CounterValue:
+    __slots__ = ('lock', 'value')
+
+    def __init__(self, lock, _metric):
+        self.lock = lock
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class _GaugeValue(_CounterValue):
+    __slots__ = ()
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class _HistogramValue:
+    __slots__ = ('lock', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, lock, metric):
+        self.lock = lock
+        self.bounds = metric.buckets
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Return a context manager observing the seconds its block takes."""
+        return _Timer(self)
+
+    def sample(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, buckets = 0, []
+        for bound, n in zip(self.bounds + (math.inf,), counts):
+            cumulative += n
+            buckets.append([bound if bound != math.inf else '+Inf', cumulative])
+        return {'count': count, 'sum': total, 'buckets': buckets}
+
+
+class Metric:
+    """A named metric, with one value per combination of label values."""
+
+    kind = None
+    value_class = None
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(buckets) if buckets else None
+        self._lock = threading.Lock()
+        self._values = {}
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        """Return the value for the label *values*, in the declared order."""
+        value = self._values.get(values)
+        if value is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} takes labels {self.labelnames}')
+            with self._lock:
+                value = self._values.setdefault(values, self.value_class(self._lock, self))
+        return value
+
+    def samples(self):
+        return [
+            {'labels': dict(zip(self.labelnames, key)), 'value': value.sample()}
+            for key, value in list(self._values.items())
+        ]
+
+
+class Counter(Metric):
+    kind = 'counter'
+    value_class = _CounterValue
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+    value_class = _GaugeValue
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    value_class = _HistogramValue
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels, buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+
+def _declare(cls, name, help, labels, **kwargs):
+    metric = _registry.get(name)
+    if metric is None:
+        with _registry_lock:
+            metric = _registry.get(name)
+            if metric is None:
+                metric = _registry[name] = cls(name, help, labels, **kwargs)
+    if not isinstance(metric, cls) or metric.labelnames != tuple(labels):
+        raise ValueError(f'metric {name} is already declared differently')
+    return metric
+
+
+def counter(name, help, labels=()):
+    """Declare (or return) a counter, which only goes up."""
+    return _declare(Counter, name, help, labels)
+
+
+def gauge(name, help, labels=()):
+    """Declare (or return) a gauge, which is set to the current level."""
+    return _declare(Gauge, name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    """Declare (or return) a histogram counting observations per bucket."""
+    return _declare(Histogram, name, help, labels, buckets=buckets)
+
+
+# -- SQL statements
+
+SQL_STATEMENTS = counter('sql_statements_total', 'SQL statements executed')
+
+
+def count_sql(_statement=None):
+    """Count one SQL statement; a ``sqlite3`` trace callback."""
+    _local.sql = getattr(_local, 'sql', 0) + 1
+    SQL_STATEMENTS.inc()
+
+
+def sql_count():
+    """Return the statements counted so far on the calling thread."""
+    return getattr(_local, 'sql', 0)
+
+
+# -- output
+
+def snapshot():
+    """Return ``{name: {'type', 'help', 'samples'}}`` for every metric."""
+    return {
+        name: {'type': m.kind, 'help': m.help, 'samples': m.samples()}
+        for name, m in sorted(_registry.items())
+    }
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _series(name, labels, extra=None):
+    pairs = list(labels.items()) + ([extra] if extra else [])
+    if not pairs:
+        return name
+    return name + '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+def prometheus(data=None):
+    """Render *data* (default: a fresh :func:`snapshot`) as Prometheus text."""
+    lines = []
+    for name, metric in (data or snapshot()).items():
+        full = PREFIX + name
+        lines.append(f"# HELP {full} {metric['help']}")
+        lines.append(f"# TYPE {full} {metric['type']}")
+        for s in metric['samples']:
+            labels, value = s['labels'], s['value']
+            if metric['type'] != 'histogram':
+                lines.append(f'{_series(full, labels)} {_number(value)}')
+                continue
+            for bound, n in value['buckets']:
+                lines.append(f"{_series(full + '_bucket', labels, ('le', bound))} {n}")
+            lines.append(f"{_series(full + '_sum', labels)} {_number(value['sum'])}")
+            lines.append(f"{_series(full + '_count', labels)} {value['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+def dump(path):
+    """Write a :func:`snapshot` to *path* as JSON, replacing it atomically."""
+    path = Path(path)
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps({'at': time.time(), 'metrics': snapshot()}))
+    tmp.replace(path)
+
+
+def quantile(value, q):
+    """Estimate quantile *q* of a histogram sample from its buckets."""
+    total = value['count']
+    if not total:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0
+    for bound, cumulative in value['buckets']:
+        if cumulative >= rank:
+            if bound == '+Inf':
+                return lower
+            inside = cumulative - below
+            return lower + (bound - lower) * ((rank - below) / inside if inside else 0)
+        lower, below = bound, cumulative
+    return lower
+
+
+def format_snapshot(data):
+    """Return human-readable lines for a :func:`snapshot`."""
+    lines = []
+    for name, metric in data.items():
+        for s in metric['samples']:
+            series = _series(name, s['labels'])
+            value = s['value']
+            if metric['type'] != 'histogram':
+                lines.append(f'{series} {_number(value)}')
+                continue
+            if not value['count']:
+                continue
+            mean = value['sum'] / value['count']
+            p50, p95 = quantile(value, 0.5), quantile(value, 0.95)
+            lines.append(
+                f"{series} count={value['count']} mean={mean:.6g} p50={p50:.6g} p95={p95:.6g}"
+            )
+    return lines
@@ -2,10 +2,8 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from pathlib import Path
-from cryptography.fernet import Fernet
-from sqlalchemy import inspect, text
 
-from db import init_db
+from db import ensure_schema
 
 # Database instance
 DB_NAME = "openbbs.db"
@@ -14,17 +12,24 @@ login_manager = LoginManager()
 login_manager.login_view = "auth.login"
 
 
-def create_app():
+def create_app(config=None):
     app = Flask(__name__)
     app.config["SECRET_KEY"] = "change-this-secret-key"
-    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB_NAME}"
+    # the web tables and the sync tables share one database file
+    app.config["DB_PATH"] = str(Path(DB_NAME).resolve())
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     app.config["UPLOAD_FOLDER"] = str(Path("uploads"))
     app.config["ENCRYPTION_KEY_PATH"] = str(Path("encryption.key"))
+    app.config.update(config or {})
+    app.config.setdefault(
+        "SQLALCHEMY_DATABASE_URI", f"sqlite:///{app.config['DB_PATH']}"
+    )
 
     def load_enc_key(path: Path) -> bytes:
         if path.exists():
             return path.read_bytes()
+        from cryptography.fernet import Fernet
+
         key = Fernet.generate_key()
         path.write_bytes(key)
         return key
@@ -34,37 +39,23 @@ def create_app():
     db.init_app(app)
     login_manager.init_app(app)
 
-    from .models import User, Post, Forum, Attachment, Flag, PostVersion, ModNote
+    from .migrations import upgrade
 
     with app.app_context():
         Path(app.config["UPLOAD_FOLDER"]).mkdir(exist_ok=True)
-        db.drop_all()
-        db.create_all()
-        insp = inspect(db.engine)
-        if "created_at" not in [c["name"] for c in insp.get_columns("user")]:
-            db.session.execute(text("ALTER TABLE user ADD COLUMN created_at DATETIME"))
-            db.session.commit()
-        if "is_pinned" not in [c["name"] for c in insp.get_columns("post")]:
-            db.session.execute(
-                text("ALTER TABLE post ADD COLUMN is_pinned BOOLEAN DEFAULT 0")
-            )
-            db.session.commit()
-        if "is_locked" not in [c["name"] for c in insp.get_columns("post")]:
-            db.session.execute(
-                text("ALTER TABLE post ADD COLUMN is_locked BOOLEAN DEFAULT 0")
-            )
-            db.session.commit()
-        if "delete_reason" not in [c["name"] for c in insp.get_columns("post")]:
-            db.session.execute(
-                text("ALTER TABLE post ADD COLUMN delete_reason VARCHAR(255)")
-            )
-            db.session.commit()
-        init_db(DB_NAME)
+        ensure_schema(app.config["DB_PATH"])
+        upgrade()
 
     from .auth import auth_bp
     from .views import main_bp, generate_action_token
     from .forums import forums_bp
+    from .threads import threads_cli
+    from .counters import counters_cli
+    from .attachments import attachments_cli
+    from .rendering import post_html, render_cli, render_markdown
+    from . import monitoring
 
+    monitoring.init_app(app)
     app.register_blueprint(auth_bp)
     app.register_blueprint(main_bp)
     app.register_blueprint(forums_bp)
@@ -74,6 +65,12 @@ def create_app():
     from .api import api_bp
 
     app.register_blueprint(api_bp)
+    app.cli.add_command(threads_cli)
+    app.cli.add_command(counters_cli)
+    app.cli.add_command(attachments_cli)
+    app.cli.add_command(render_cli)
+    app.add_template_filter(post_html, "post_html")
+    app.add_template_filter(render_markdown, "markdown")
 
     @app.context_processor
     def inject_action_token():
@@ -1,17 +1,176 @@
-from flask import Blueprint, request, jsonify
-from pathlib import Path
-from db import connect, init_db
+"""JSON API used by the offline UI and other light clients.
+
+Thread reads are conditional: their strong ``ETag`` is the database's
+change sequence (see :func:`db.high_water`), which every thread or
+message write advances, so an unchanged ``If-None-Match`` gets a 304
+before any thread or message is read.  ``GET /api/threads/<tid>?since=N``
+returns only the messages changed after sequence *N* (the ``seq`` of an
+earlier response) and the ids of messages deleted since.  Larger bodies
+are compressed with zstd or gzip when the client accepts either.
+
+Writes are idempotent on the client-supplied ``id``: posting a thread or
+message that already exists changes nothing and reports it as such, so a
+client may replay its outbox after a dropped link.  A message may carry
+its author's ``signature`` (see :func:`keycache.sign_message`); with the
+author's key in ``SYNC_KEYS_PATH`` it must verify, and then the signed
+``timestamp`` is kept.  Without a key on record the signature is dropped
+and the message is stamped with the time it arrived.  ``POST /api/batch``
+applies many of them in one transaction, and ``GET /api/export`` streams
+threads and messages as NDJSON.
+"""
+from flask import Blueprint, current_app, request, jsonify, stream_with_context
+from db import get_pool, high_water, log_change
+import gzip
+import json
 import uuid
 from datetime import datetime
+from functools import lru_cache
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
-DB_PATH = Path('openbbs.db')
+
+# bodies smaller than this go out uncompressed
+MIN_COMPRESS = 512
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+# items accepted by one POST /api/batch
+MAX_BATCH = 5000
+# rows fetched at a time while streaming an export
+EXPORT_CHUNK = 500
 
 
 def get_conn():
-    init_db(DB_PATH)
-    conn = connect(DB_PATH)
-    return conn
+    return get_pool(current_app.config['DB_PATH']).get()
+
+
+@lru_cache(maxsize=None)
+def _keys_for(keys_path):
+    # cryptography is only loaded once a signed message arrives
+    from keycache import KeyCache
+
+    return KeyCache(keys_path)
+
+
+def get_keys():
+    """Return the author key store named by ``SYNC_KEYS_PATH``, if any."""
+    path = current_app.config.get('SYNC_KEYS_PATH')
+    return _keys_for(path) if path else None
+
+
+@api_bp.teardown_request
+def release_conn(exc):
+    get_pool(current_app.config['DB_PATH']).release()
+
+
+def _encoding():
+    """Return the content coding for this request's response body."""
+    accept = request.accept_encodings
+    if accept['zstd']:
+        return 'zstd'
+    if accept['gzip']:
+        return 'gzip'
+    return 'identity'
+
+
+def _not_modified(seq):
+    """Return a 304 if the client holds the representation at *seq*.
+
+    The tag names the coding too, since the encoded bytes differ.
+    """
+    etag = f'{seq}-{_encoding()}'
+    if request.if_none_match.contains(etag):
+        resp = current_app.response_class(status=304)
+        return _validators(resp, etag)
+    return None
+
+
+def _validators(resp, etag):
+    resp.set_etag(etag)
+    # clients may keep the body but must ask before using it
+    resp.cache_control.no_cache = True
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def _cached_json(payload, seq):
+    resp = jsonify(payload)
+    encoding = _encoding()
+    body = resp.get_data()
+    if encoding != 'identity' and len(body) >= MIN_COMPRESS:
+        if encoding == 'zstd':
+            import zstandard
+
+            body = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+        else:
+            body = gzip.compress(body, GZIP_LEVEL, mtime=0)
+        resp.set_data(body)
+        resp.headers['Content-Encoding'] = encoding
+    return _validators(resp, f'{seq}-{encoding}')
+
+
+def _insert_thread(conn, data, now):
+    """Insert the thread in *data* unless its id exists; return ``(id, created)``."""
+    tid = data.get('id') or str(uuid.uuid4())
+    created = conn.execute(
+        "INSERT INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?) ON CONFLICT(id) DO NOTHING",
+        (tid, data['title'], now, now),
+    ).rowcount
+    if created:
+        log_change(conn, 'thread', tid)
+    return tid, bool(created)
+
+
+def _insert_message(conn, tid, data, now):
+    """Insert the message in *data* unless its id exists; return ``(id, created)``.
+
+    The caller bumps the thread's ``updated_at`` and logs the thread.
+    """
+    mid = data.get('id') or str(uuid.uuid4())
+    body = data.get('body', '')
+    signature = _checked_signature(data, mid, tid, body)
+    # a signed message keeps the timestamp its author signed
+    ts = (data.get('timestamp') or now) if signature else now
+    created = conn.execute(
+        """INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body, signature)
+        VALUES (?,?,?,?,?,?,?) ON CONFLICT(id) DO NOTHING""",
+        (mid, tid, ts, now, data.get('author'), body, signature),
+    ).rowcount
+    if created:
+        log_change(conn, 'message', mid)
+    return mid, bool(created)
+
+
+def _checked_signature(data, mid, tid, body):
+    """Return the author signature of message *data* to store, or ``None``.
+
+    Raises ``ValueError`` if the author's key is on record and the
+    signature does not verify against it.
+    """
+    signature = data.get('signature')
+    keys = get_keys()
+    author = data.get('author')
+    if not signature or keys is None or not author:
+        return None
+    raw = keys.key_bytes(author)
+    if raw is None:
+        return None
+    from keycache import message_payload, verify_signature
+
+    message = {'id': mid, 'thread_id': tid, 'timestamp': data.get('timestamp'),
+               'author': author, 'body': body}
+    try:
+        valid = verify_signature(raw, message_payload(message), bytes.fromhex(signature))
+    except (TypeError, ValueError):
+        valid = False
+    if not valid:
+        raise ValueError('bad signature')
+    return signature
+
+
+def _touch_threads(conn, tids, now):
+    for tid in tids:
+        conn.execute("UPDATE threads SET updated_at=? WHERE id=?", (now, tid))
+        log_change(conn, 'thread', tid)
+
 
 @api_bp.route('/threads', methods=['GET', 'POST'])
 def threads():
@@ -19,46 +178,150 @@ def threads():
     cur = conn.cursor()
     if request.method == 'POST':
         data = request.get_json(force=True)
-        tid = data.get('id') or str(uuid.uuid4())
-        now = datetime.utcnow().isoformat()
-        cur.execute(
-            "INSERT INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
-            (tid, data['title'], now, now),
-        )
+        tid, _ = _insert_thread(conn, data, datetime.utcnow().isoformat())
         conn.commit()
-        conn.close()
         return jsonify({'id': tid})
+    seq = high_water(conn)
+    resp = _not_modified(seq)
+    if resp:
+        return resp
     rows = cur.execute("SELECT id, title, updated_at FROM threads ORDER BY updated_at DESC").fetchall()
-    conn.close()
-    return jsonify([dict(r) for r in rows])
+    return _cached_json([dict(r) for r in rows], seq)
 
 @api_bp.route('/threads/<tid>', methods=['GET'])
 def thread_detail(tid):
     conn = get_conn()
     cur = conn.cursor()
+    since = request.args.get('since', type=int)
+    seq = high_water(conn)
+    resp = _not_modified(seq)
+    if resp:
+        return resp
     thread = cur.execute("SELECT id, title, updated_at FROM threads WHERE id=?", (tid,)).fetchone()
     if not thread:
-        conn.close()
         return jsonify({'error': 'not found'}), 404
-    msgs = cur.execute("SELECT * FROM messages WHERE thread_id=? ORDER BY timestamp", (tid,)).fetchall()
-    conn.close()
-    return jsonify({'thread': dict(thread), 'messages': [dict(m) for m in msgs]})
+    if since is None:
+        msgs = cur.execute("SELECT * FROM messages WHERE thread_id=? ORDER BY timestamp", (tid,)).fetchall()
+        return _cached_json({'thread': dict(thread), 'messages': [dict(m) for m in msgs], 'seq': seq}, seq)
+    msgs = cur.execute(
+        """SELECT * FROM messages WHERE thread_id=? AND id IN (
+            SELECT entity_id FROM changes WHERE entity='message' AND seq>? AND seq<=?)
+        ORDER BY timestamp""",
+        (tid, since, seq),
+    ).fetchall()
+    # a deleted row no longer names its thread; the client ignores ids it lacks
+    deleted = cur.execute(
+        """SELECT DISTINCT entity_id FROM changes
+        WHERE entity='message' AND op='delete' AND seq>? AND seq<=?
+        AND entity_id NOT IN (SELECT id FROM messages)""",
+        (since, seq),
+    ).fetchall()
+    return _cached_json({
+        'thread': dict(thread),
+        'messages': [dict(m) for m in msgs],
+        'deleted': [r[0] for r in deleted],
+        'seq': seq,
+        'since': since,
+    }, seq)
 
 @api_bp.route('/threads/<tid>/messages', methods=['POST'])
 def post_message(tid):
     conn = get_conn()
-    cur = conn.cursor()
     data = request.get_json(force=True)
-    mid = data.get('id') or str(uuid.uuid4())
     now = datetime.utcnow().isoformat()
-    cur.execute(
-        "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
-        (mid, tid, now, now, data.get('author'), data.get('body', '')),
-    )
-    cur.execute(
-        "UPDATE threads SET updated_at=? WHERE id=?",
-        (now, tid),
-    )
+    try:
+        mid, created = _insert_message(conn, tid, data, now)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    if created:
+        _touch_threads(conn, [tid], now)
     conn.commit()
-    conn.close()
     return jsonify({'id': mid})
+
+
+@api_bp.route('/batch', methods=['POST'])
+def batch():
+    """Apply ``{"threads": [...], "messages": [...]}`` in one transaction.
+
+    Threads go first, so messages may name a thread from the same batch by
+    ``thread_id``.  Each item gets a result in the same position:
+    ``created``, ``exists`` (its id was already stored) or ``error``.
+    """
+    data = request.get_json(force=True)
+    threads_in = data.get('threads') or []
+    messages_in = data.get('messages') or []
+    if len(threads_in) + len(messages_in) > MAX_BATCH:
+        return jsonify({'error': f'at most {MAX_BATCH} items per batch'}), 413
+    conn = get_conn()
+    now = datetime.utcnow().isoformat()
+    results = {'threads': [], 'messages': []}
+    for item in threads_in:
+        if not isinstance(item, dict) or not item.get('title'):
+            results['threads'].append({'id': item.get('id') if isinstance(item, dict) else None,
+                                       'status': 'error', 'error': 'title required'})
+            continue
+        tid, created = _insert_thread(conn, item, now)
+        results['threads'].append({'id': tid, 'status': 'created' if created else 'exists'})
+    known = {}
+    touched = set()
+    for item in messages_in:
+        tid = item.get('thread_id') if isinstance(item, dict) else None
+        if tid not in known:
+            known[tid] = tid is not None and conn.execute(
+                "SELECT 1 FROM threads WHERE id=?", (tid,)
+            ).fetchone() is not None
+        if not known[tid]:
+            results['messages'].append({'id': item.get('id') if isinstance(item, dict) else None,
+                                        'status': 'error', 'error': 'unknown thread'})
+            continue
+        try:
+            mid, created = _insert_message(conn, tid, item, now)
+        except ValueError as exc:
+            results['messages'].append({'id': item.get('id'), 'status': 'error', 'error': str(exc)})
+            continue
+        if created:
+            touched.add(tid)
+        results['messages'].append({'id': mid, 'status': 'created' if created else 'exists'})
+    _touch_threads(conn, sorted(touched), now)
+    conn.commit()
+    return jsonify(results)
+
+
+@api_bp.route('/export', methods=['GET'])
+def export():
+    """Stream threads and then messages as NDJSON, one object per line.
+
+    The first line is ``{"type": "meta", "seq": N}``; pass *N* back as
+    ``?since=N`` to export only what changed afterwards.  The export reads
+    one snapshot, so concurrent writes do not tear it.
+    """
+    since = request.args.get('since', type=int)
+    conn = get_conn()
+    # hold one read snapshot for the whole stream
+    conn.execute("BEGIN")
+    seq = high_water(conn)
+    if since is None:
+        queries = [
+            ('thread', "SELECT * FROM threads ORDER BY id", ()),
+            ('message', "SELECT * FROM messages ORDER BY thread_id, timestamp", ()),
+        ]
+    else:
+        changed = "id IN (SELECT entity_id FROM changes WHERE entity=? AND seq>?)"
+        queries = [
+            ('thread', f"SELECT * FROM threads WHERE {changed} ORDER BY id", ('thread', since)),
+            ('message', f"SELECT * FROM messages WHERE {changed} ORDER BY thread_id, timestamp",
+             ('message', since)),
+        ]
+
+    def generate():
+        yield json.dumps({'type': 'meta', 'seq': seq, 'since': since}) + '\n'
+        for kind, sql, params in queries:
+            cur = conn.execute(sql, params)
+            while rows := cur.fetchmany(EXPORT_CHUNK):
+                yield ''.join(
+                    json.dumps(dict(r, type=kind), separators=(',', ':')) + '\n' for r in rows
+                )
+
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype='application/x-ndjson'
+    )
@@ -0,0 +1,178 @@
+"""Attachment storage and delivery.
+
+Uploads are hashed and gzip-compressed in fixed-size chunks into the
+content-addressed :class:`blobstore.BlobStore`, so a file posted in many
+threads is stored once; ``Attachment.sha256`` rows and the sync tables'
+``message_attachments`` rows act as its reference count, and ``flask
+attachments gc`` removes blobs neither refers to.
+
+Downloads never hold a whole file in memory: clients that accept gzip
+get the stored bytes as-is with ``Content-Encoding: gzip``, everyone
+else gets a chunked, stream-decompressed body.  Both paths honour
+``ETag`` and HTTP ``Range`` requests.
+"""
+
+import gzip
+import mimetypes
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Iterable
+
+import click
+from flask import current_app, request, send_file
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, select, text
+from werkzeug.wsgi import wrap_file
+
+from blobstore import BlobStore
+
+from . import db
+from .models import Attachment
+
+CHUNK_SIZE = 64 * 1024
+
+attachments_cli = AppGroup("attachments", help="Maintain stored attachment data.")
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def get_store() -> BlobStore:
+    return BlobStore(Path(current_app.config["UPLOAD_FOLDER"]) / "blobs")
+
+
+def store_upload(stream: BinaryIO) -> tuple[str, int]:
+    """Hash and gzip *stream* into the blob store; return ``(digest, size)``."""
+    return get_store().put(stream)
+
+
+def gzip_length(path: Path) -> int:
+    """Return the uncompressed size recorded in the gzip trailer of *path*.
+
+    The trailer stores the size modulo 2**32, which is exact for everything
+    the upload form accepts.
+    """
+    with open(path, "rb") as f:
+        f.seek(-4, 2)
+        return struct.unpack("<I", f.read(4))[0]
+
+
+def _etag(path: Path, encoding: str, digest: str | None) -> str:
+    if digest:
+        return f"{digest}-{encoding}"
+    st = path.stat()
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}-{encoding}"
+
+
+def send_attachment(
+    path: Path, download_name: str, digest: str | None = None, size: int | None = None
+):
+    """Return a conditional, range-capable response for a stored attachment."""
+    # stored paths are relative to the working directory, not the app root
+    path = Path(path).resolve()
+    mimetype = mimetypes.guess_type(download_name)[0] or "application/octet-stream"
+    if request.accept_encodings["gzip"]:
+        resp = send_file(
+            path,
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=download_name,
+            etag=_etag(path, "gzip", digest),
+            max_age=0,
+        )
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        body = wrap_file(request.environ, gzip.open(path, "rb"), CHUNK_SIZE)
+        resp = current_app.response_class(
+            body, mimetype=mimetype, direct_passthrough=True
+        )
+        resp.headers.set("Content-Disposition", "attachment", filename=download_name)
+        resp.set_etag(_etag(path, "identity", digest))
+        resp.make_conditional(
+            request,
+            accept_ranges=True,
+            complete_length=size if size is not None else gzip_length(path),
+        )
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+
+def _unlink_all(paths: list[str]) -> None:
+    for p in paths:
+        try:
+            Path(p).unlink(missing_ok=True)
+        except Exception:
+            pass
+
+
+def release_attachments(rows: Iterable[tuple[str, str | None]]):
+    """Drop files of deleted ``(filename, sha256)`` attachment rows.
+
+    Blobs are only removed once no remaining ``Attachment`` or
+    ``message_attachments`` row refers to their digest; files from before
+    the blob store are removed directly.  Call after the deleting
+    transaction has committed.
+    """
+    files, digests = [], set()
+    for filename, digest in rows:
+        if digest:
+            digests.add(digest)
+        else:
+            files.append(filename)
+    if digests:
+        unused = sorted(digests - referenced_digests(digests))
+        if unused:
+            _submit(_delete_blobs, get_store(), unused)
+    return unlink_later(files)
+
+
+def referenced_digests(digests: Iterable[str] | None = None) -> set[str]:
+    """Return the digests, of *digests* or of all, that any post or message uses."""
+    posts = select(Attachment.sha256).where(Attachment.sha256 != None).distinct()
+    messages = "SELECT DISTINCT sha256 FROM message_attachments"
+    params = {}
+    if digests is not None:
+        digests = list(digests)
+        posts = posts.where(Attachment.sha256.in_(digests))
+        messages += " WHERE sha256 IN :digests"
+        params["digests"] = digests
+    stmt = text(messages)
+    if params:
+        stmt = stmt.bindparams(bindparam("digests", expanding=True))
+    return set(db.session.scalars(posts)) | set(db.session.scalars(stmt, params))
+
+
+def _delete_blobs(store: BlobStore, digests: list[str]) -> None:
+    for digest in digests:
+        try:
+            store.delete(digest)
+        except Exception:
+            pass
+
+
+def _submit(fn, *args):
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="unlink")
+    return _executor.submit(fn, *args)
+
+
+def unlink_later(paths: Iterable[str]):
+    """Remove attachment files on a background worker.
+
+    Call this only after the transaction that deleted the rows has committed
+    so a rollback never leaves rows pointing at missing files.  Returns the
+    future of the queued job, or ``None`` when there is nothing to remove.
+    """
+    paths = list(paths)
+    if not paths:
+        return None
+    return _submit(_unlink_all, paths)
+
+
+@attachments_cli.command("gc")
+@click.option("--grace", default=60.0, help="Keep blobs written in the last N seconds.")
+def gc_command(grace):
+    """Remove stored blobs that no post or synced message refers to."""
+    removed = get_store().collect(referenced_digests(), grace=grace)
+    click.echo(f"removed {len(removed)} blobs")
@@ -0,0 +1,222 @@
+"""Denormalized post counters for forums and users.
+
+Each forum and user carries ``thread_count`` (visible root posts),
+``reply_count`` (visible replies) and ``last_post_at``; forums also keep
+``last_post_id`` so the index page can show the newest post without
+walking any.  Soft-deleted posts do not count.
+
+ORM writes (new posts, restoring a post, re-parenting one) are picked up
+by a flush hook, so they are counted in the transaction that makes them.
+The set-based helpers in :mod:`openbbs.threads` bypass the ORM and wrap
+their statements in :func:`recount`.  ``flask counters reconcile``
+recomputes everything from the post table and repairs any drift.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, func, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from . import db
+from .models import Forum, Post, User
+
+counters_cli = AppGroup("counters", help="Maintain forum and user post counters.")
+
+# post attributes that move a post between counters
+_TRACKED = ("deleted", "parent_id", "forum_id", "user_id")
+_COUNTERS = ("thread_count", "reply_count")
+
+
+def _tally(session, ids) -> dict[tuple, int]:
+    """Count the visible posts in *ids* by ``(forum_id, user_id, is_root)``."""
+    if not ids:
+        return {}
+    rows = session.execute(
+        select(Post.forum_id, Post.user_id, Post.parent_id.is_(None), func.count())
+        .where(Post.id.in_(ids), Post.deleted == False)
+        .group_by(Post.forum_id, Post.user_id, Post.parent_id.is_(None))
+    )
+    return {(f, u, bool(root)): n for f, u, root, n in rows}
+
+
+def _apply(conn, deltas: dict[tuple, int]) -> None:
+    """Add *deltas* (as returned by :func:`_tally`) and refresh last posts."""
+    forums: dict[int, list[int]] = defaultdict(lambda: [0, 0])
+    users: dict[int, list[int]] = defaultdict(lambda: [0, 0])
+    for (forum_id, user_id, root), n in deltas.items():
+        forums[forum_id][0 if root else 1] += n
+        users[user_id][0 if root else 1] += n
+    for model, changes in ((Forum, forums), (User, users)):
+        table = model.__table__
+        for key, (threads, replies) in changes.items():
+            if threads or replies:
+                conn.execute(
+                    update(table)
+                    .where(table.c.id == key)
+                    .values(
+                        thread_count=func.coalesce(table.c.thread_count, 0) + threads,
+                        reply_count=func.coalesce(table.c.reply_count, 0) + replies,
+                    )
+                )
+    _refresh_last(conn, list(forums), list(users))
+
+
+def _newest(owner_column, owner_id_column):
+    post = Post.__table__
+    return (
+        select(post.c.id, post.c.timestamp)
+        .where(owner_column == owner_id_column, post.c.deleted == False)
+        .order_by(post.c.timestamp.desc(), post.c.id.desc())
+        .limit(1)
+    )
+
+
+def _refresh_last(conn, forum_ids, user_ids) -> None:
+    post, forum, user = Post.__table__, Forum.__table__, User.__table__
+    if forum_ids:
+        newest = _newest(post.c.forum_id, forum.c.id)
+        conn.execute(
+            update(forum)
+            .where(forum.c.id.in_(forum_ids))
+            .values(
+                last_post_id=newest.with_only_columns(post.c.id).scalar_subquery(),
+                last_post_at=newest.with_only_columns(post.c.timestamp).scalar_subquery(),
+            )
+        )
+    if user_ids:
+        newest = _newest(post.c.user_id, user.c.id)
+        conn.execute(
+            update(user)
+            .where(user.c.id.in_(user_ids))
+            .values(last_post_at=newest.with_only_columns(post.c.timestamp).scalar_subquery())
+        )
+
+
+@contextmanager
+def recount(ids, session=None):
+    """Keep counters right across a set-based change to the posts in *ids*.
+
+    *ids* (a list or a SELECT) is resolved up front, so the change may
+    move, re-root or delete the posts.  The caller commits.
+    """
+    session = session or db.session
+    ids = list(session.scalars(ids)) if not isinstance(ids, list) else ids
+    before = _tally(session, ids)
+    yield
+    after = _tally(session, ids)
+    deltas = {k: after.get(k, 0) - before.get(k, 0) for k in before.keys() | after.keys()}
+    if any(deltas.values()):
+        _apply(session.connection(), deltas)
+
+
+def _state(obj, old: bool):
+    """Return ``(forum_id, user_id, is_root)`` of *obj* if visible, else ``None``."""
+    values = {}
+    for key in _TRACKED:
+        hist = get_history(obj, key)
+        if old and hist.deleted:
+            values[key] = hist.deleted[0]
+        elif old and hist.unchanged:
+            values[key] = hist.unchanged[0]
+        else:
+            values[key] = getattr(obj, key)
+    if values["deleted"]:
+        return None
+    return values["forum_id"], values["user_id"], values["parent_id"] is None
+
+
+@event.listens_for(Session, "after_flush")
+def _count_flushed(session, flush_context):
+    deltas: dict[tuple, int] = defaultdict(int)
+    for obj in session.new:
+        if isinstance(obj, Post) and (state := _state(obj, old=False)):
+            deltas[state] += 1
+    for obj in session.dirty:
+        if isinstance(obj, Post) and any(
+            get_history(obj, key).has_changes() for key in _TRACKED
+        ):
+            if old := _state(obj, old=True):
+                deltas[old] -= 1
+            if new := _state(obj, old=False):
+                deltas[new] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Post) and (state := _state(obj, old=True)):
+            deltas[state] -= 1
+    if any(deltas.values()):
+        _apply(session.connection(), deltas)
+
+
+def _expected() -> tuple[dict, dict]:
+    """Compute every forum's and user's counters from the post table."""
+    forums = {
+        f: {"thread_count": 0, "reply_count": 0, "last_post_id": None, "last_post_at": None}
+        for f in db.session.scalars(select(Forum.id))
+    }
+    users = {
+        u: {"thread_count": 0, "reply_count": 0, "last_post_at": None}
+        for u in db.session.scalars(select(User.id))
+    }
+    rows = db.session.execute(
+        select(Post.id, Post.forum_id, Post.user_id, Post.parent_id, Post.timestamp)
+        .where(Post.deleted == False)
+        .order_by(Post.timestamp, Post.id)
+    )
+    for r in rows:
+        key = "thread_count" if r.parent_id is None else "reply_count"
+        # ascending order, so the last row seen is the newest
+        if r.forum_id in forums:
+            forums[r.forum_id][key] += 1
+            forums[r.forum_id].update(last_post_id=r.id, last_post_at=r.timestamp)
+        if r.user_id in users:
+            users[r.user_id][key] += 1
+            users[r.user_id]["last_post_at"] = r.timestamp
+    return forums, users
+
+
+def _drift() -> list[tuple[type, int, dict]]:
+    forums, users = _expected()
+    drifted = []
+    for model, expected in ((Forum, forums), (User, users)):
+        columns = [getattr(model, c) for c in next(iter(expected.values()), {})]
+        for row in db.session.execute(select(model.id, *columns)):
+            want = expected[row.id]
+            if any(getattr(row, k) != v for k, v in want.items()):
+                drifted.append((model, row.id, want))
+    return drifted
+
+
+def verify_counters() -> list[str]:
+    """Return ``forum <id>`` / ``user <id>`` for every drifted row."""
+    return [f"{model.__tablename__} {key}" for model, key, _ in _drift()]
+
+
+def reconcile_counters() -> int:
+    """Recompute drifted counters, commit, and return how many rows changed."""
+    drifted = _drift()
+    for model in (Forum, User):
+        rows = [dict(want, id=key) for m, key, want in drifted if m is model]
+        if rows:
+            db.session.execute(update(model), rows)
+    db.session.commit()
+    return len(drifted)
+
+
+@counters_cli.command("reconcile")
+def reconcile_command():
+    """Recompute forum and user counters from the posts."""
+    count = reconcile_counters()
+    click.echo(f"repaired {count} rows")
+
+
+@counters_cli.command("verify")
+def verify_command():
+    """Report forums and users whose counters disagree with the posts."""
+    bad = verify_counters()
+    if bad:
+        click.echo(f"{len(bad)} rows out of date: {', '.join(bad[:20])}")
+        raise SystemExit(1)
+    click.echo("ok")
@@ -1,6 +1,7 @@
 from flask import Blueprint, render_template, request, redirect, url_for
 from functools import lru_cache
 from flask_login import login_required
+from sqlalchemy.orm import joinedload
 from .models import Forum, Post
 from . import db
 
@@ -10,8 +11,14 @@ forums_bp = Blueprint('forums', __name__, url_prefix='/forums')
 @forums_bp.route('/')
 @login_required
 def list_forums():
-    forums = Forum.query.all()
-    return render_template('forums.html', forums=forums)
+    return render_template('forums.html', forums=forum_index())
+
+
+def forum_index():
+    """Return every forum with its last post and author loaded in one query."""
+    return Forum.query.options(
+        joinedload(Forum.last_post).joinedload(Post.author)
+    ).order_by(Forum.id).all()
 
 
 @forums_bp.route('/create', methods=['GET', 'POST'])
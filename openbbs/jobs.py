@@ -0,0 +1,113 @@
+"""Background jobs for work too slow to do inside a request.
+
+A :class:`JobRunner` runs callables on a bounded thread pool and keeps
+their status, progress and result under a job id.  Jobs submitted with the
+same *key* while an earlier one is queued, running or finished and not yet
+expired share that job, so concurrent identical requests do the work once.
+Finished jobs are dropped after *ttl* seconds, together with the files
+they produced.
+"""
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+class Job:
+    def __init__(self, kind: str, key=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.state = "queued"
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.path: Path | None = None
+        self.created = time.time()
+        self.finished: float | None = None
+
+    def update(self, done, total=None) -> None:
+        """Record progress; passed to :meth:`SyncEngine.export` and ``push``."""
+        self.progress = {"done": done, "total": total}
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "state": self.state,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobRunner:
+    def __init__(self, max_workers: int = 2, ttl: float = 3600.0):
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs: dict[str, Job] = {}
+        self._by_key: dict = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, fn, key=None, cleanup=None) -> Job:
+        """Run ``fn(job)`` in the pool; its return value becomes ``job.result``.
+
+        *fn* may set ``job.path`` to a file it produced, which is deleted
+        when the job expires.  *cleanup* runs after *fn* whether or not it
+        succeeded, and also when the job is answered from the dedupe map
+        instead of running.
+        """
+        self.expire()
+        with self._lock:
+            job = self._by_key.get(key) if key is not None else None
+            if job is not None and job.state != "failed":
+                if cleanup:
+                    cleanup()
+                return job
+            job = Job(kind, key)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._by_key[key] = job
+        self._executor.submit(self._run, job, fn, cleanup)
+        return job
+
+    def _run(self, job: Job, fn, cleanup) -> None:
+        job.state = "running"
+        failed = False
+        try:
+            job.result = fn(job)
+        except Exception as exc:
+            failed = True
+            job.error = str(exc)
+            if job.path is not None:
+                job.path.unlink(missing_ok=True)
+                job.path = None
+        finally:
+            if cleanup:
+                cleanup()
+        # publish the outcome only once temporary files are gone
+        job.state = "failed" if failed else "done"
+        job.finished = time.time()
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def expire(self, now: float | None = None) -> None:
+        """Forget jobs finished more than ``ttl`` seconds ago and delete their files."""
+        now = time.time() if now is None else now
+        with self._lock:
+            stale = [
+                j for j in self._jobs.values() if j.finished and now - j.finished > self.ttl
+            ]
+            for job in stale:
+                del self._jobs[job.id]
+                if self._by_key.get(job.key) is job:
+                    del self._by_key[job.key]
+        for job in stale:
+            if job.path is not None:
+                job.path.unlink(missing_ok=True)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
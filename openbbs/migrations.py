@@ -0,0 +1,136 @@
+"""Versioned schema steps for the web application's tables.
+
+The steps run through :func:`db.migrate` under the ``web`` component, next
+to the ``core`` steps that own the sync tables, so both halves of the
+database are versioned in the same ``schema_version`` table.  Append new
+steps to :data:`WEB_MIGRATIONS`; never edit or reorder existing ones.
+"""
+
+import uuid
+
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from db import add_column, migrate
+
+from . import db
+from .models import (
+    Attachment,
+    Flag,
+    Forum,
+    ModNote,
+    Post,
+    PostVersion,
+    RenderedPost,
+    User,
+)
+
+
+def _create_tables(conn, schema, tables):
+    dialect = db.engine.dialect
+    for table in tables:
+        if table.name not in schema:
+            conn.execute(str(CreateTable(table).compile(dialect=dialect)))
+            schema[table.name] = {c.name for c in table.columns}
+        _create_indexes(conn, schema, table)
+
+
+def _create_indexes(conn, schema, table):
+    dialect = db.engine.dialect
+    present = schema.get(table.name, set())
+    for index in table.indexes:
+        # indexes on columns a later step adds are created by that step
+        if not {c.name for c in index.columns} <= present:
+            continue
+        conn.execute(str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect)))
+
+
+def _baseline(conn, schema):
+    _create_tables(
+        conn,
+        schema,
+        [
+            t.__table__
+            for t in (User, Forum, Post, Attachment, Flag, PostVersion, ModNote)
+        ],
+    )
+    # columns that older databases were patched with at startup
+    add_column(conn, schema, "user", "created_at", "DATETIME")
+    add_column(conn, schema, "post", "is_pinned", "BOOLEAN DEFAULT 0")
+    add_column(conn, schema, "post", "is_locked", "BOOLEAN DEFAULT 0")
+    add_column(conn, schema, "post", "delete_reason", "VARCHAR(255)")
+
+
+def _thread_paths(conn, schema):
+    add_column(conn, schema, "post", "path", "TEXT")
+    add_column(conn, schema, "post", "root_id", "INTEGER")
+    add_column(conn, schema, "post", "depth", "INTEGER DEFAULT 0")
+    add_column(conn, schema, "post", "reply_count", "INTEGER DEFAULT 0")
+    add_column(conn, schema, "post", "last_activity", "DATETIME")
+    _create_indexes(conn, schema, Post.__table__)
+
+
+def _attachment_digests(conn, schema):
+    add_column(conn, schema, "attachment", "sha256", "VARCHAR(64)")
+    add_column(conn, schema, "attachment", "size", "INTEGER")
+    _create_indexes(conn, schema, Attachment.__table__)
+
+
+def _post_uids(conn, schema):
+    add_column(conn, schema, "post", "uid", "VARCHAR(36)")
+    ids = [r[0] for r in conn.execute("SELECT id FROM post WHERE uid IS NULL")]
+    conn.executemany(
+        "UPDATE post SET uid=? WHERE id=?", [(str(uuid.uuid4()), i) for i in ids]
+    )
+    _create_indexes(conn, schema, Post.__table__)
+
+
+def _counters(conn, schema):
+    for table in ("forum", "user"):
+        add_column(conn, schema, table, "thread_count", "INTEGER DEFAULT 0")
+        add_column(conn, schema, table, "reply_count", "INTEGER DEFAULT 0")
+        add_column(conn, schema, table, "last_post_at", "DATETIME")
+    add_column(conn, schema, "forum", "last_post_id", "INTEGER")
+    _create_indexes(conn, schema, Post.__table__)
+
+
+def _rendered_posts(conn, schema):
+    _create_tables(conn, schema, [RenderedPost.__table__])
+
+
+WEB_MIGRATIONS = [
+    _baseline,
+    _thread_paths,
+    _attachment_digests,
+    _post_uids,
+    _counters,
+    _rendered_posts,
+]
+
+# steps after which the materialized thread columns must be recomputed
+_REBUILD_THREADS = {2}
+# steps after which existing posts must be copied into the sync tables
+_MIRROR_POSTS = {4}
+# steps after which forum and user counters must be recomputed
+_RECOUNT = {5}
+
+
+def upgrade() -> list[int]:
+    """Bring the web tables up to date; return the versions applied."""
+    raw = db.engine.raw_connection()
+    try:
+        applied = migrate(raw.driver_connection, "web", WEB_MIGRATIONS)
+    finally:
+        raw.close()
+    if _REBUILD_THREADS.intersection(applied):
+        from .threads import rebuild_threads
+
+        rebuild_threads()
+    if _MIRROR_POSTS.intersection(applied):
+        from .mirror import mirror_all
+
+        mirror_all()
+    if _RECOUNT.intersection(applied):
+        from .counters import reconcile_counters
+
+        reconcile_counters()
+    return applied
@@ -0,0 +1,124 @@
+"""Mirror web posts into the sync ``threads``/``messages`` tables.
+
+Every post is a message keyed by its ``uid``; a root post is also the
+thread, which shares its uid.  The mirror is written on the session's own
+sqlite connection from a flush hook, so the sync rows and their
+``changes`` entries commit or roll back together with the post.  Bulk
+operations in :mod:`openbbs.threads` bypass the hook and call
+:func:`mirror_posts` / :func:`forget_posts` themselves.
+"""
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.orm.attributes import get_history
+
+from db import log_change
+
+from . import db
+from .models import Post, User
+
+# post attributes that change what the sync tables hold
+_TRACKED = ("title", "body", "deleted", "parent_id", "edited_at")
+
+
+def _raw(session):
+    return session.connection().connection.driver_connection
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def mirror_posts(ids, session=None) -> None:
+    """Write the sync rows for the posts in *ids* (a list or a SELECT)."""
+    session = session or db.session
+    root = aliased(Post)
+    rows = session.execute(
+        select(
+            Post.uid,
+            Post.title,
+            Post.body,
+            Post.timestamp,
+            Post.edited_at,
+            Post.deleted,
+            Post.parent_id,
+            Post.last_activity,
+            root.uid.label("thread_uid"),
+            User.username,
+        )
+        .join(root, root.id == Post.root_id)
+        .join(User, User.id == Post.user_id)
+        .where(Post.id.in_(ids))
+    ).all()
+    if not rows:
+        return
+    conn = _raw(session)
+    threads = set()
+    for r in rows:
+        if r.deleted:
+            conn.execute("DELETE FROM messages WHERE id=?", (r.uid,))
+            log_change(conn, 'message', r.uid, 'delete')
+            if r.parent_id is None:
+                conn.execute("DELETE FROM threads WHERE id=?", (r.uid,))
+                log_change(conn, 'thread', r.uid, 'delete')
+            continue
+        conn.execute(
+            """INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body)
+            VALUES (?,?,?,?,?,?)
+            ON CONFLICT(id) DO UPDATE SET thread_id=excluded.thread_id,
+                updated_at=excluded.updated_at, author=excluded.author, body=excluded.body""",
+            (
+                r.uid,
+                r.thread_uid,
+                _iso(r.timestamp),
+                _iso(r.edited_at or r.timestamp),
+                r.username,
+                r.body,
+            ),
+        )
+        log_change(conn, 'message', r.uid)
+        threads.add(r.thread_uid)
+    for r in session.execute(
+        select(Post.uid, Post.title, Post.timestamp, Post.last_activity).where(
+            Post.uid.in_(threads), Post.deleted == False
+        )
+    ):
+        conn.execute(
+            """INSERT INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)
+            ON CONFLICT(id) DO UPDATE SET title=excluded.title, updated_at=excluded.updated_at""",
+            (r.uid, r.title, _iso(r.timestamp), _iso(r.last_activity)),
+        )
+        log_change(conn, 'thread', r.uid)
+
+
+def forget_posts(uids, session=None) -> None:
+    """Remove the sync rows of hard-deleted posts with *uids*."""
+    session = session or db.session
+    conn = _raw(session)
+    for uid in uids:
+        conn.execute("DELETE FROM messages WHERE id=?", (uid,))
+        log_change(conn, 'message', uid, 'delete')
+        if conn.execute("DELETE FROM threads WHERE id=?", (uid,)).rowcount:
+            log_change(conn, 'thread', uid, 'delete')
+
+
+def mirror_all() -> None:
+    """Mirror every post; used once when the mirror is introduced."""
+    mirror_posts(select(Post.id))
+    db.session.commit()
+
+
+@event.listens_for(Session, "after_flush")
+def _mirror_flushed(session, flush_context):
+    ids = [obj.id for obj in session.new if isinstance(obj, Post)]
+    ids += [
+        obj.id
+        for obj in session.dirty
+        if isinstance(obj, Post)
+        and any(get_history(obj, key).has_changes() for key in _TRACKED)
+    ]
+    gone = [obj.uid for obj in session.deleted if isinstance(obj, Post)]
+    if ids:
+        mirror_posts(ids, session)
+    if gone:
+        forget_posts(gone, session)
@@ -1,6 +1,7 @@
 from . import db, login_manager
 from flask_login import UserMixin
 from datetime import datetime
+import uuid
 
 
 class User(db.Model, UserMixin):
@@ -11,6 +12,10 @@ class User(db.Model, UserMixin):
     reputation = db.Column(db.Integer, default=0)
     is_moderator = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # denormalized, maintained by openbbs.counters
+    thread_count = db.Column(db.Integer, default=0)
+    reply_count = db.Column(db.Integer, default=0)
+    last_post_at = db.Column(db.DateTime)
     posts = db.relationship("Post", backref="author", lazy=True)
     flags = db.relationship("Flag", backref="reporter", lazy=True)
     received_notes = db.relationship(
@@ -25,11 +30,29 @@ class Forum(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), unique=True, nullable=False)
     description = db.Column(db.Text, default="")
+    # denormalized, maintained by openbbs.counters
+    thread_count = db.Column(db.Integer, default=0)
+    reply_count = db.Column(db.Integer, default=0)
+    last_post_id = db.Column(db.Integer)
+    last_post_at = db.Column(db.DateTime)
     posts = db.relationship("Post", backref="forum", lazy=True)
+    last_post = db.relationship(
+        "Post", primaryjoin="foreign(Forum.last_post_id) == Post.id", viewonly=True
+    )
 
 
 class Post(db.Model):
+    __table_args__ = (
+        # newest visible post per forum and per user, see openbbs.counters
+        db.Index("ix_post_forum_timestamp", "forum_id", "timestamp"),
+        db.Index("ix_post_user_timestamp", "user_id", "timestamp"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
+    # stable id of the mirrored sync message (and thread, for roots)
+    uid = db.Column(
+        db.String(36), unique=True, index=True, default=lambda: str(uuid.uuid4())
+    )
     title = db.Column(db.String(255), nullable=False)
     body = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -42,6 +65,12 @@ class Post(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     forum_id = db.Column(db.Integer, db.ForeignKey("forum.id"), nullable=False)
     parent_id = db.Column(db.Integer, db.ForeignKey("post.id"))
+    # materialized thread position, maintained by openbbs.threads
+    path = db.Column(db.Text, index=True)
+    root_id = db.Column(db.Integer, index=True)
+    depth = db.Column(db.Integer, default=0)
+    reply_count = db.Column(db.Integer, default=0, index=True)
+    last_activity = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     children = db.relationship(
         "Post", backref=db.backref("parent", remote_side=[id]), lazy=True
     )
@@ -59,6 +88,8 @@ class Attachment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     original_name = db.Column(db.String(255), nullable=False)
+    sha256 = db.Column(db.String(64), index=True)
+    size = db.Column(db.Integer)
     post_id = db.Column(db.Integer, db.ForeignKey("post.id"), nullable=False)
 
 
@@ -79,6 +110,14 @@ class PostVersion(db.Model):
     post_id = db.Column(db.Integer, db.ForeignKey("post.id"), nullable=False)
 
 
+class RenderedPost(db.Model):
+    """Cached HTML of a post body, see openbbs.rendering."""
+
+    post_id = db.Column(db.Integer, db.ForeignKey("post.id"), primary_key=True)
+    digest = db.Column(db.String(40), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+
+
 class ModNote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.Text, nullable=False)
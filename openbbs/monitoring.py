@@ -0,0 +1,84 @@
+"""Request metrics and the ``/metrics`` endpoint.
+
+Every request is timed and its SQL statements counted, both per
+endpoint.  Statements go through the SQLAlchemy engine or the pooled
+sqlite connections of :mod:`db`, and both are counted by
+:func:`metrics.count_sql`.  ``GET /metrics`` serves every metric of the
+process in the Prometheus text format.  ``?format=json`` gives the
+snapshot that ``bbs.py stats`` reads.  Only clients whose address is in
+``METRICS_ALLOW`` (by default this host) and logged-in moderators may
+read it.
+"""
+
+import time
+
+from flask import Blueprint, Response, abort, current_app, g, jsonify, request
+from flask_login import current_user
+from sqlalchemy import event
+
+import metrics
+
+from . import db
+
+monitoring_bp = Blueprint("monitoring", __name__)
+
+# client addresses that may read /metrics unless METRICS_ALLOW says otherwise
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+# methods labelled by name; any other verb a client sends counts as "other"
+METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+
+REQUESTS = metrics.counter(
+    "http_requests_total", "HTTP requests answered", ("endpoint", "method", "status")
+)
+REQUEST_SECONDS = metrics.histogram(
+    "http_request_seconds", "Time to answer a request", ("endpoint", "method")
+)
+REQUEST_SQL = metrics.histogram(
+    "http_request_sql_statements",
+    "SQL statements issued per request",
+    ("endpoint",),
+    buckets=metrics.COUNT_BUCKETS,
+)
+
+
+def _start():
+    g.metrics_start = (time.perf_counter(), metrics.sql_count())
+
+
+def _finish(response):
+    started = g.pop("metrics_start", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started[0]
+    # unmatched URLs share one label so scanners cannot grow the registry
+    endpoint = request.endpoint or "unmatched"
+    method = request.method if request.method in METHODS else "other"
+    REQUESTS.labels(endpoint, method, str(response.status_code)).inc()
+    REQUEST_SECONDS.labels(endpoint, method).observe(elapsed)
+    REQUEST_SQL.labels(endpoint).observe(metrics.sql_count() - started[1])
+    return response
+
+
+def _count_statement(*_args):
+    metrics.count_sql()
+
+
+def init_app(app):
+    """Time *app*'s requests, count its SQL and serve ``/metrics``."""
+    app.before_request(_start)
+    app.after_request(_finish)
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", _count_statement)
+    app.register_blueprint(monitoring_bp)
+
+
+@monitoring_bp.route("/metrics")
+def metrics_view():
+    allowed = current_app.config.get("METRICS_ALLOW", LOCAL_ADDRESSES)
+    if request.remote_addr not in allowed and not (
+        current_user.is_authenticated and current_user.is_moderator
+    ):
+        abort(403)
+    if request.args.get("format") == "json":
+        return jsonify(metrics.snapshot())
+    return Response(metrics.prometheus(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,219 @@
+"""Markdown rendering of post bodies, cached per post version.
+
+Bodies are rendered with raw HTML escaped and links limited to safe
+schemes.  The HTML of each post is stored in the ``rendered_post`` side
+table under a digest of its body (and :data:`RENDER_VERSION`), so a post
+is rendered once per edit rather than once per view, by whichever
+process sees it first.  A bounded in-process LRU keyed by post id sits in
+front of the table.  Because the digest is part of the key, a stale entry
+can never be served; :func:`invalidate` drops the old HTML on edit and
+revert so the table does not keep it.  ``flask render prewarm`` fills the
+cache for the most active threads.
+
+Cache rows are written on a connection of their own, so storing them
+never commits the request's session.  While that session holds
+uncommitted writes, and with them SQLite's write lock, rows wait until
+its transaction ends instead of blocking on the lock.
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from html import unescape
+from urllib.parse import urlparse
+
+import click
+from flask.cli import AppGroup
+from markupsafe import Markup
+from sqlalchemy import delete, event, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import Post, RenderedPost
+
+render_cli = AppGroup("render", help="Maintain the rendered post cache.")
+
+# bump when rendering changes so every cached body is rendered again
+RENDER_VERSION = 2
+# posts whose HTML each process keeps in memory
+LRU_SIZE = 2048
+_SAFE_SCHEMES = {"", "http", "https", "mailto", "ftp"}
+_CONTROL = re.compile(r"[\x00-\x20\x7f]+")
+
+# Session.info keys: the session has written in its transaction, and the
+# cache rows waiting for that transaction to end
+_WROTE = "rendering_wrote"
+_PENDING = "rendering_pending"
+
+_local = threading.local()
+_lru: OrderedDict[int, tuple[str, str]] = OrderedDict()
+_lru_lock = threading.Lock()
+
+
+def _scheme(url: str) -> str:
+    # browsers decode entities and drop tabs, newlines and other control
+    # characters before reading the scheme, so "java&#x09;script:" counts
+    plain = _CONTROL.sub("", unescape(url))
+    return urlparse(plain).scheme.lower()
+
+
+def _safe_links(root) -> None:
+    for el in root.iter():
+        for attr in ("href", "src"):
+            value = el.get(attr)
+            if value is not None and _scheme(value) not in _SAFE_SCHEMES:
+                el.set(attr, "#")
+
+
+def _markdown():
+    # Markdown instances keep per-document state; one per thread.  The
+    # import is deferred so web workers start without it.
+    md = getattr(_local, "md", None)
+    if md is None:
+        import markdown
+        from markdown.treeprocessors import Treeprocessor
+
+        class SafeLinks(Treeprocessor):
+            def run(self, root):
+                _safe_links(root)
+
+        md = markdown.Markdown()
+        md.preprocessors.deregister("html_block")
+        md.inlinePatterns.deregister("html")
+        md.treeprocessors.register(SafeLinks(md), "safe_links", 0)
+        _local.md = md
+    return md
+
+
+def render_markdown(text: str | None) -> Markup:
+    """Render *text* to HTML, uncached; also the ``markdown`` template filter."""
+    return Markup(_markdown().reset().convert(text or ""))
+
+
+def _digest(body: str | None) -> str:
+    return hashlib.sha1(f"{RENDER_VERSION}:{body or ''}".encode()).hexdigest()
+
+
+def _remember(post_id: int, digest: str, html: str) -> None:
+    with _lru_lock:
+        _lru[post_id] = (digest, html)
+        _lru.move_to_end(post_id)
+        while len(_lru) > LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+def _write(rows: list[dict]) -> None:
+    # written on a connection of its own: rendering happens while a page is
+    # being built, and committing the request's session would expire it
+    stmt = insert(RenderedPost.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["post_id"],
+        set_={"digest": stmt.excluded.digest, "html": stmt.excluded.html},
+    )
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(stmt, rows)
+    except OperationalError:
+        # the cache is best effort; a busy database just means no entry
+        pass
+
+
+def _store(rows: list[dict]) -> None:
+    session = db.session()
+    if session.info.get(_WROTE):
+        # our own session holds the write lock; wait for it to let go
+        session.info.setdefault(_PENDING, []).extend(rows)
+    else:
+        _write(rows)
+
+
+@event.listens_for(Session, "after_flush")
+def _flushed(session, flush_context):
+    session.info[_WROTE] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _executed(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info[_WROTE] = True
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _store_pending(session, transaction):
+    if transaction.parent is not None:
+        return
+    session.info.pop(_WROTE, None)
+    rows = session.info.pop(_PENDING, None)
+    if rows:
+        # the write lock went with the transaction
+        _write(rows)
+
+
+def post_html(post: Post) -> Markup:
+    """Return the rendered body of *post*; the ``post_html`` template filter."""
+    digest = _digest(post.body)
+    cached = _lru.get(post.id)
+    if cached and cached[0] == digest:
+        return Markup(cached[1])
+    html = db.session.scalar(
+        select(RenderedPost.html).where(
+            RenderedPost.post_id == post.id, RenderedPost.digest == digest
+        )
+    )
+    if html is None:
+        html = str(render_markdown(post.body))
+        _store([{"post_id": post.id, "digest": digest, "html": html}])
+    _remember(post.id, digest, html)
+    return Markup(html)
+
+
+def invalidate(post_id: int) -> None:
+    """Forget the rendered HTML of *post_id*, within the caller's transaction."""
+    db.session.execute(delete(RenderedPost).where(RenderedPost.post_id == post_id))
+    with _lru_lock:
+        _lru.pop(post_id, None)
+
+
+@lru_cache(maxsize=256)
+def preview_html(text: str) -> str:
+    """Render a draft for ``/preview``; repeated previews are not re-rendered."""
+    return str(render_markdown(text))
+
+
+def prewarm(threads: int = 50) -> int:
+    """Render the posts of the *threads* most active threads; return how many."""
+    roots = (
+        select(Post.id)
+        .where(Post.parent_id == None, Post.deleted == False)
+        .order_by(Post.last_activity.desc())
+        .limit(threads)
+    )
+    posts = db.session.execute(
+        select(Post.id, Post.body).where(Post.root_id.in_(roots), Post.deleted == False)
+    ).all()
+    have = dict(
+        db.session.execute(
+            select(RenderedPost.post_id, RenderedPost.digest).where(
+                RenderedPost.post_id.in_([p.id for p in posts])
+            )
+        ).all()
+    )
+    rows = []
+    for p in posts:
+        digest = _digest(p.body)
+        if have.get(p.id) != digest:
+            rows.append({"post_id": p.id, "digest": digest, "html": str(render_markdown(p.body))})
+    if rows:
+        _store(rows)
+    return len(rows)
+
+
+@render_cli.command("prewarm")
+@click.option("--threads", default=50, show_default=True, help="Most active threads to render.")
+def prewarm_command(threads):
+    """Render the posts of the most active threads ahead of their readers."""
+    click.echo(f"rendered {prewarm(threads)} posts")
@@ -42,19 +42,40 @@
     const area = form.querySelector('textarea[name="body"]');
     const box = form.querySelector('.preview');
     if(!btn || !area || !box) return;
+    let shown = null;
+    let ctrl;
+    let timer;
+    const render = async () => {
+      const text = area.value;
+      if(text === shown) return;
+      if(ctrl) ctrl.abort();
+      ctrl = new AbortController();
+      try{
+        const resp = await fetch('/preview', {
+          method:'POST',
+          headers:{'Content-Type':'application/json'},
+          body: JSON.stringify({text}),
+          signal: ctrl.signal
+        });
+        const data = await resp.json();
+        box.innerHTML = data.html;
+        shown = text;
+      }catch(e){}
+    };
+    // while the preview is open, follow typing once it pauses
+    area.addEventListener('input', () => {
+      if(box.classList.contains('d-none')) return;
+      clearTimeout(timer);
+      timer = setTimeout(render, 400);
+    });
     btn.addEventListener('click', async () => {
       if(!box.classList.contains('d-none')){
         box.classList.add('d-none');
         btn.textContent = 'Preview';
+        clearTimeout(timer);
         return;
       }
-      const resp = await fetch('/preview', {
-        method:'POST',
-        headers:{'Content-Type':'application/json'},
-        body: JSON.stringify({text: area.value})
-      });
-      const data = await resp.json();
-      box.innerHTML = data.html;
+      await render();
       box.classList.remove('d-none');
       btn.textContent = 'Hide Preview';
     });
@@ -1,48 +1,288 @@
+import hashlib
 import json
 import tempfile
-from flask import Blueprint, request, send_file, jsonify
+import threading
+from flask import Blueprint, current_app, request, send_file, jsonify
 from pathlib import Path
 from . import db as sqldb  # SQLAlchemy instance not used but required for models
-from sync import SyncEngine
-from db import init_db
 from functools import lru_cache
 
 sync_bp = Blueprint('sync_api', __name__, url_prefix='/api/sync')
+_jobs_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def _engine_for(db_path, keys_path=None, require_signatures=False):
+    # sync pulls in zstandard; web workers that never sync skip the import
+    from sync import SyncEngine
+
+    keys = None
+    if keys_path:
+        from keycache import KeyCache
+
+        keys = KeyCache(keys_path)
+    return SyncEngine(db_path, keys=keys, require_signatures=require_signatures)
+
 
-@lru_cache(maxsize=1)
 def get_engine():
-    db_path = Path('openbbs.db').resolve()
-    init_db(db_path)
-    return SyncEngine(str(db_path))
+    config = current_app.config
+    return _engine_for(
+        config['DB_PATH'], config.get('SYNC_KEYS_PATH'), bool(config.get('SYNC_REQUIRE_SIGNATURES'))
+    )
+
+
+@lru_cache(maxsize=None)
+def _transfers_for(db_path, root, max_size):
+    from transfer import TransferStore
+
+    return TransferStore(db_path, root, max_size)
+
+
+def get_transfers():
+    from transfer import MAX_PACKAGE_SIZE
+
+    root = Path(current_app.config['UPLOAD_FOLDER']) / 'transfers'
+    max_size = current_app.config.get('SYNC_MAX_PACKAGE', MAX_PACKAGE_SIZE)
+    return _transfers_for(current_app.config['DB_PATH'], str(root), max_size)
+
+
+def _export(engine, data, path, progress=None):
+    """Build a package at *path* from a pull request body."""
+    cursor = data.get('cursor')
+    peer = data.get('peer')
+    if peer and data.get('ack') is not None:
+        engine.acknowledge(peer, data['ack'])
+    return engine.export(since=data.get('since'), thread_ids=data.get('threads'), output_path=path,
+                         known_blobs=data.get('known_blobs'),
+                         cursor=int(cursor) if cursor is not None else None,
+                         peer=peer, format=data.get('format', 'tar'), progress=progress)
+
+def get_jobs():
+    """Return the app's sync job runner, creating it on first use."""
+    from .jobs import JobRunner
+
+    with _jobs_lock:
+        runner = current_app.extensions.get('sync_jobs')
+        if runner is None:
+            runner = current_app.extensions['sync_jobs'] = JobRunner(
+                current_app.config.get('SYNC_JOB_WORKERS', 2),
+                current_app.config.get('SYNC_JOB_TTL', 3600),
+            )
+    return runner
+
+
+def _jobs_dir():
+    path = Path(current_app.config['UPLOAD_FOLDER']) / 'jobs'
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _accepted(job):
+    resp = jsonify(job.to_dict())
+    resp.status_code = 202
+    resp.headers['Location'] = f'/api/sync/jobs/{job.id}'
+    return resp
+
+def _pull_key(kind, engine, data):
+    """Apply the ``ack`` of pull body *data* and return its job dedupe key."""
+    from db import get_conn, high_water
+
+    peer = data.get('peer')
+    if peer and data.get('ack') is not None:
+        engine.acknowledge(peer, data.pop('ack'))
+    cursor = data.get('cursor')
+    if cursor is None and peer:
+        cursor = engine.peer_state(peer)['acked_cursor']
+    threads = data.get('threads')
+    # the high-water mark makes a cached package stale once anything changes
+    return json.dumps([
+        kind, high_water(get_conn(engine.db_path)), cursor,
+        sorted(threads) if threads else None, data.get('since'), peer,
+        data.get('format', 'tar'), sorted(data.get('known_blobs') or []),
+        data.get('chunk_size'),
+    ])
 
 @sync_bp.route('/pull', methods=['POST'])
 def pull_route():
+    """Queue a package build; identical pulls share one job and package."""
     data = request.get_json(force=True, silent=True) or {}
-    since = data.get('since')
-    threads = data.get('threads')
-    with tempfile.NamedTemporaryFile(suffix='.tar.zst', delete=False) as tmp:
-        path = tmp.name
     engine = get_engine()
-    engine.pull(since=since, thread_ids=threads, output_path=path)
-    return send_file(path, as_attachment=True, download_name='sync.tar.zst')
+    key = _pull_key('pull', engine, data)
+    jobs_dir = _jobs_dir()
+
+    def build(job):
+        job.path = jobs_dir / f'{job.id}.zst'
+        summary = _export(engine, data, str(job.path), progress=job.update)
+        summary.pop('path')
+        return summary
+
+    return _accepted(get_jobs().submit('pull', build, key=key))
 
 @sync_bp.route('/push', methods=['POST'])
 def push_route():
+    """Queue the import of an uploaded package (``file`` field or raw body)."""
     file = request.files.get('file')
-    if file:
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        file.save(tmp)
-        tmp.close()
-        engine = get_engine()
-        summary = engine.push(tmp.name)
-        Path(tmp.name).unlink(missing_ok=True)
-        return jsonify(summary)
-    if request.data:
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        tmp.write(request.data)
-        tmp.close()
-        engine = get_engine()
-        summary = engine.push(tmp.name)
-        Path(tmp.name).unlink(missing_ok=True)
-        return jsonify(summary)
-    return jsonify({'error': 'no file provided'}), 400
+    if not file and not request.data:
+        return jsonify({'error': 'no file provided'}), 400
+    tmp = tempfile.NamedTemporaryFile(dir=_jobs_dir(), suffix='.upload', delete=False)
+    digest = hashlib.sha256()
+    with tmp:
+        if file:
+            for chunk in iter(lambda: file.stream.read(64 * 1024), b''):
+                digest.update(chunk)
+                tmp.write(chunk)
+        else:
+            digest.update(request.data)
+            tmp.write(request.data)
+    peer = request.values.get('peer')
+    engine = get_engine()
+
+    def apply(job):
+        return engine.push(tmp.name, peer=peer, progress=job.update)
+
+    job = get_jobs().submit(
+        'push', apply, key=json.dumps(['push', digest.hexdigest(), peer]),
+        cleanup=lambda: Path(tmp.name).unlink(missing_ok=True),
+    )
+    return _accepted(job)
+
+@sync_bp.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_jobs().get(job_id)
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(job.to_dict())
+
+@sync_bp.route('/jobs/<job_id>/package', methods=['GET'])
+def job_package(job_id):
+    job = get_jobs().get(job_id)
+    if job is None or job.kind != 'pull':
+        return jsonify({'error': 'unknown job'}), 404
+    if job.state != 'done':
+        return jsonify(job.to_dict()), 409
+    resp = send_file(job.path, as_attachment=True, download_name='sync.tar.zst')
+    # pass back as "cursor" on the next pull to receive only the delta
+    resp.headers['X-Sync-Cursor'] = str(job.result['cursor'])
+    return resp
+
+
+# ---- chunked, resumable transfers (see transfer.py) ----
+
+@sync_bp.route('/downloads', methods=['POST'])
+def create_download():
+    """Queue a package build for a chunked download.
+
+    The finished job's result is the transfer manifest plus the package
+    ``cursor``.
+    """
+    from transfer import CHUNK_SIZE
+
+    data = request.get_json(force=True, silent=True) or {}
+    engine = get_engine()
+    key = _pull_key('download', engine, data)
+    store = get_transfers()
+    store.expire(current_app.config.get('SYNC_JOB_TTL', 3600))
+    store.root.mkdir(parents=True, exist_ok=True)
+
+    def build(job):
+        # the transfer store owns the package and expires it, not the job
+        with tempfile.NamedTemporaryFile(dir=store.root, suffix='.zst', delete=False) as tmp:
+            path = tmp.name
+        try:
+            summary = _export(engine, data, path, progress=job.update)
+            manifest = store.offer(path, int(data.get('chunk_size') or CHUNK_SIZE), data.get('peer'))
+        except BaseException:
+            Path(path).unlink(missing_ok=True)
+            raise
+        return dict(manifest, cursor=summary['cursor'])
+
+    return _accepted(get_jobs().submit('download', build, key=key))
+
+@sync_bp.route('/downloads/<tid>/manifest', methods=['GET'])
+def download_manifest(tid):
+    try:
+        return jsonify(get_transfers().manifest(tid))
+    except KeyError:
+        return jsonify({'error': 'unknown transfer'}), 404
+
+@sync_bp.route('/downloads/<tid>', methods=['GET'])
+def download_data(tid):
+    store = get_transfers()
+    try:
+        manifest = store.manifest(tid)
+        path = store.source(tid)
+    except KeyError:
+        return jsonify({'error': 'unknown transfer'}), 404
+    # send_file answers Range requests with 206 partial content
+    resp = send_file(path, mimetype='application/octet-stream', conditional=True, etag=tid)
+    resp.headers['X-Chunk-Size'] = str(manifest['chunk_size'])
+    return resp
+
+def _finish_upload(store, tid):
+    """Answer with the status of upload *tid*, queueing its import once it is complete.
+
+    The import runs as a job, returned under ``job`` with ``202 Accepted``.
+    Its outcome is recorded on the transfer, so an upload whose import
+    failed is imported again the next time the sender resumes it.
+    """
+    status = store.status(tid)
+    if not status['complete'] or status['imported']:
+        return jsonify(status)
+    engine = get_engine()
+
+    def apply(job):
+        try:
+            summary = engine.push(str(store.path(tid)), peer=status['peer'], progress=job.update)
+        except Exception as exc:
+            store.record_import(tid, error=str(exc))
+            raise
+        store.record_import(tid, summary)
+        return summary
+
+    job = get_jobs().submit('import', apply, key=json.dumps(['import', tid]))
+    resp = jsonify(dict(status, job=job.to_dict()))
+    resp.status_code = 202
+    resp.headers['Location'] = f'/api/sync/jobs/{job.id}'
+    return resp
+
+@sync_bp.route('/uploads', methods=['POST'])
+def create_upload():
+    data = request.get_json(force=True, silent=True) or {}
+    store = get_transfers()
+    store.expire(current_app.config.get('SYNC_UPLOAD_TTL', 86400), 'in')
+    try:
+        store.begin(data, peer=data.get('peer'))
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    return _finish_upload(store, data['id'])
+
+@sync_bp.route('/uploads/<tid>', methods=['GET', 'PUT'])
+def upload_chunk(tid):
+    store = get_transfers()
+    try:
+        status = store.status(tid)
+    except KeyError:
+        return jsonify({'error': 'unknown transfer'}), 404
+    if request.method == 'GET':
+        return jsonify(status)
+    manifest = store.manifest(tid, 'in')
+    try:
+        unit, _, spec = request.headers['Content-Range'].partition(' ')
+        span, _, total = spec.partition('/')
+        start, end = (int(v) for v in span.split('-'))
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Content-Range required'}), 400
+    if (request.content_length or 0) > manifest['chunk_size']:
+        return jsonify({'error': 'chunk larger than the manifest allows'}), 413
+    data = request.get_data()
+    if (
+        unit != 'bytes'
+        or total not in ('*', str(manifest['size']))
+        or start % manifest['chunk_size']
+        or end - start + 1 != len(data)
+    ):
+        return jsonify({'error': 'range is not a whole chunk'}), 416
+    try:
+        store.write_chunk(tid, start // manifest['chunk_size'], data)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 422
+    return _finish_upload(store, tid)
@@ -0,0 +1,301 @@
+"""Thread structure maintenance and bulk operations on thread subtrees.
+
+Every post carries a materialized ``path`` made of fixed-width id segments
+(``0000000001/0000000007/``) together with denormalized ``root_id``,
+``depth``, ``reply_count`` (number of visible descendants) and
+``last_activity`` (newest visible post in the subtree, or the post
+itself).  Soft-deleted posts do not count, as in :mod:`openbbs.counters`.
+Inserts are handled by a mapper event, and a flush hook catches posts
+deleted or restored through the ORM, so every write path keeps them
+current.  Delete, move and split go through the helpers below, which
+apply their change with set-based statements instead of walking
+``Post.children`` one lazy load at a time, and keep the forum and user
+counters of :mod:`openbbs.counters` in step.  The caller owns the
+transaction and commits.
+"""
+
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import Text, delete, event, func, or_, select, update
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+
+from . import db
+from .counters import recount
+from .mirror import forget_posts, mirror_posts
+from .models import Attachment, Flag, Post, PostVersion, RenderedPost
+
+threads_cli = AppGroup("threads", help="Maintain materialized thread data.")
+
+
+def _segment(post_id: int) -> str:
+    return f"{post_id:010d}/"
+
+
+def _ancestors(path: str) -> list[int]:
+    """Return the ids of all posts above the last segment of *path*."""
+    return [int(seg) for seg in path.split("/")[:-2]]
+
+
+def _subtree_cte(root_id: int):
+    tree = select(Post.id).where(Post.id == root_id).cte("subtree", recursive=True)
+    tree = tree.union_all(
+        select(Post.id).join(tree, Post.parent_id == tree.c.id)
+    )
+    return select(tree.c.id)
+
+
+def subtree_ids(root_id: int):
+    """Return a SELECT of *root_id* and the ids of all its descendants."""
+    prefix = db.session.scalar(select(Post.path).where(Post.id == root_id))
+    if not prefix:
+        # rows written before paths existed; run ``flask threads rebuild``
+        return _subtree_cte(root_id)
+    # "/" sorts directly before "0", so this is an index range scan
+    return select(Post.id).where(Post.path >= prefix, Post.path < prefix[:-1] + "0")
+
+
+def _execute(stmt):
+    # "fetch" keeps already-loaded instances in step with the bulk change
+    return db.session.execute(stmt.execution_options(synchronize_session="fetch"))
+
+
+def _refresh_statement(ids):
+    """Return an UPDATE recomputing the reply counters of the posts in *ids*."""
+    inner = aliased(Post)
+    upper = func.substr(Post.path, 1, func.length(Post.path) - 1, type_=Text) + "0"
+    below = (inner.path > Post.path, inner.path < upper, inner.deleted == False)
+    replies = select(func.count()).where(*below).scalar_subquery()
+    newest = (
+        select(func.max(inner.timestamp))
+        .where(inner.path >= Post.path, inner.path < upper)
+        .where(or_(inner.id == Post.id, inner.deleted == False))
+        .scalar_subquery()
+    )
+    return (
+        update(Post)
+        .where(Post.id.in_(ids))
+        .values(reply_count=replies, last_activity=func.coalesce(newest, Post.last_activity))
+    )
+
+
+def _refresh(ids) -> None:
+    """Recompute ``reply_count`` and ``last_activity`` of the posts in *ids*."""
+    if isinstance(ids, list) and not ids:
+        return
+    _execute(_refresh_statement(ids))
+
+
+@event.listens_for(Post, "after_insert")
+def _place_new_post(mapper, connection, target):
+    table = Post.__table__
+    now = target.timestamp or datetime.utcnow()
+    parent = None
+    if target.parent_id is not None:
+        parent = connection.execute(
+            select(table.c.path, table.c.root_id, table.c.depth).where(
+                table.c.id == target.parent_id
+            )
+        ).first()
+    if parent is not None and parent.path:
+        path = parent.path + _segment(target.id)
+        root_id, depth = parent.root_id, parent.depth + 1
+        if not target.deleted:
+            connection.execute(
+                update(table)
+                .where(table.c.id.in_(_ancestors(path)))
+                .values(reply_count=table.c.reply_count + 1, last_activity=now)
+            )
+    else:
+        path, root_id, depth = _segment(target.id), target.id, 0
+    connection.execute(
+        update(table)
+        .where(table.c.id == target.id)
+        .values(path=path, root_id=root_id, depth=depth, reply_count=0, last_activity=now)
+    )
+    for key, value in (
+        ("path", path),
+        ("root_id", root_id),
+        ("depth", depth),
+        ("reply_count", 0),
+        ("last_activity", now),
+    ):
+        set_committed_value(target, key, value)
+
+
+@event.listens_for(Session, "after_flush")
+def _recount_toggled(session, flush_context):
+    """Refresh the ancestors of posts deleted or restored through the ORM."""
+    ids = set()
+    for obj in session.dirty:
+        if isinstance(obj, Post) and obj.path and get_history(obj, "deleted").has_changes():
+            ids.update(_ancestors(obj.path))
+    if ids:
+        session.connection().execute(_refresh_statement(sorted(ids)))
+
+
+def move_subtree(root_id: int, forum_id: int) -> None:
+    """Move *root_id* and all of its replies to *forum_id*."""
+    with recount(subtree_ids(root_id)):
+        _execute(
+            update(Post)
+            .where(Post.id.in_(subtree_ids(root_id)))
+            .values(forum_id=forum_id)
+        )
+
+
+def split_subtree(post_id: int) -> None:
+    """Re-root the subtree under *post_id* as a thread of its own.
+
+    Only the materialized columns are touched; the caller clears
+    ``parent_id`` on the post itself.
+    """
+    post = db.session.get(Post, post_id)
+    old = post.path
+    if not old:
+        return
+    _execute(
+        update(Post)
+        .where(Post.id.in_(subtree_ids(post_id)))
+        .values(
+            path=_segment(post_id) + func.substr(Post.path, len(old) + 1, type_=Text),
+            root_id=post_id,
+            depth=Post.depth - post.depth,
+        )
+    )
+    _refresh(_ancestors(old))
+    mirror_posts(subtree_ids(post_id))
+
+
+def soft_delete_subtree(root_id: int) -> None:
+    """Mark *root_id* and all of its replies as deleted."""
+    path = db.session.scalar(select(Post.path).where(Post.id == root_id))
+    with recount(subtree_ids(root_id)):
+        _execute(
+            update(Post).where(Post.id.in_(subtree_ids(root_id))).values(deleted=True)
+        )
+    _refresh(subtree_ids(root_id))
+    if path:
+        _refresh(_ancestors(path))
+    mirror_posts(subtree_ids(root_id))
+
+
+def hard_delete_subtree(root_id: int) -> list[tuple[str, str | None]]:
+    """Delete *root_id*, its replies and their attachments, flags, versions and HTML.
+
+    Returns the ``(filename, sha256)`` pairs of the deleted attachments so
+    the caller can release their files once the transaction has committed.
+    """
+    db.session.flush()
+    files = [
+        tuple(row)
+        for row in db.session.execute(
+            select(Attachment.filename, Attachment.sha256).where(
+                Attachment.post_id.in_(subtree_ids(root_id))
+            )
+        )
+    ]
+    path = db.session.scalar(select(Post.path).where(Post.id == root_id))
+    uids = list(db.session.scalars(select(Post.uid).where(Post.id.in_(subtree_ids(root_id)))))
+    with recount(subtree_ids(root_id)):
+        for model in (Attachment, Flag, PostVersion, RenderedPost):
+            _execute(delete(model).where(model.post_id.in_(subtree_ids(root_id))))
+        _execute(delete(Post).where(Post.id.in_(subtree_ids(root_id))))
+    if path:
+        _refresh(_ancestors(path))
+    forget_posts(uids)
+    return files
+
+
+def _expected_structure() -> dict[int, dict]:
+    """Compute the materialized columns for every post from ``parent_id``."""
+    rows = db.session.execute(
+        select(Post.id, Post.parent_id, Post.timestamp, Post.deleted)
+    ).all()
+    known = {r.id for r in rows}
+    children: dict[int | None, list] = {}
+    for r in rows:
+        parent = r.parent_id if r.parent_id in known else None
+        children.setdefault(parent, []).append(r)
+    expected: dict[int, dict] = {}
+    # newest visible post in each subtree, which is what ancestors see
+    visible: dict[int, datetime | None] = {}
+    order = []
+    stack = [(r, "", None, 0) for r in children.get(None, [])]
+    while stack:
+        row, prefix, root, depth = stack.pop()
+        path = prefix + _segment(row.id)
+        root = root or row.id
+        expected[row.id] = {
+            "id": row.id,
+            "path": path,
+            "root_id": root,
+            "depth": depth,
+            "reply_count": 0,
+            "last_activity": row.timestamp,
+        }
+        visible[row.id] = None if row.deleted else row.timestamp
+        order.append(row)
+        stack.extend((c, path, root, depth + 1) for c in children.get(row.id, []))
+    # children are always visited after their parent, so fold bottom-up
+    for row in reversed(order):
+        parent = row.parent_id if row.parent_id in known else None
+        if parent is None:
+            continue
+        node, up = expected[row.id], expected[parent]
+        up["reply_count"] += node["reply_count"] + (0 if row.deleted else 1)
+        newest = visible[row.id]
+        if newest and (up["last_activity"] is None or newest > up["last_activity"]):
+            up["last_activity"] = newest
+        if newest and (visible[parent] is None or newest > visible[parent]):
+            visible[parent] = newest
+    return expected
+
+
+def verify_threads() -> list[int]:
+    """Return ids of posts whose materialized columns have drifted."""
+    expected = _expected_structure()
+    stored = db.session.execute(
+        select(
+            Post.id,
+            Post.path,
+            Post.root_id,
+            Post.depth,
+            Post.reply_count,
+            Post.last_activity,
+        )
+    ).all()
+    bad = []
+    for row in stored:
+        want = expected.get(row.id)
+        if want is None or any(getattr(row, k) != v for k, v in want.items()):
+            bad.append(row.id)
+    return bad
+
+
+def rebuild_threads() -> int:
+    """Recompute the materialized columns for every post and commit."""
+    expected = _expected_structure()
+    if expected:
+        db.session.execute(update(Post), list(expected.values()))
+    db.session.commit()
+    return len(expected)
+
+
+@threads_cli.command("rebuild")
+def rebuild_command():
+    """Recompute thread paths and reply counters from parent links."""
+    count = rebuild_threads()
+    click.echo(f"rebuilt {count} posts")
+
+
+@threads_cli.command("verify")
+def verify_command():
+    """Report posts whose thread data disagrees with parent links."""
+    bad = verify_threads()
+    if bad:
+        click.echo(f"{len(bad)} posts out of date: {', '.join(map(str, bad[:20]))}")
+        raise SystemExit(1)
+    click.echo("ok")
@@ -6,20 +6,29 @@ from flask import (
     url_for,
     current_app,
     send_from_directory,
-    send_file,
 )
 import gzip
-import tempfile
-import io
 from flask_login import login_required, current_user
 from datetime import datetime
 import hmac
 import hashlib
 from .models import Post, Forum, Attachment, User, Flag, PostVersion, ModNote
 from . import db
+from .attachments import (
+    get_store,
+    release_attachments,
+    send_attachment,
+    store_upload,
+)
+from .rendering import invalidate, preview_html
+from .threads import (
+    hard_delete_subtree,
+    move_subtree,
+    soft_delete_subtree,
+    split_subtree,
+)
 from werkzeug.utils import secure_filename
 from pathlib import Path
-import markdown
 from functools import lru_cache
 
 main_bp = Blueprint("main", __name__)
@@ -103,15 +112,15 @@ def clear_suggest_cache() -> None:
 def preview_markdown():
     """Return HTML preview for provided markdown text."""
     text = request.get_json(force=True).get("text", "")
-    html = markdown.markdown(text)
-    return {"html": html}
+    return {"html": preview_html(text)}
 
 
 @main_bp.route("/")
 @login_required
 def index():
-    forums = Forum.query.all()
-    return render_template("forums.html", forums=forums)
+    from .forums import forum_index
+
+    return render_template("forums.html", forums=forum_index())
 
 
 @main_bp.route("/post", methods=["POST"])
@@ -136,13 +145,14 @@ def create_post():
         file = request.files.get("attachment")
         if file and file.filename:
             filename = secure_filename(file.filename)
-            upload_folder = Path(current_app.config["UPLOAD_FOLDER"])
-            dest = upload_folder / f"{post.id}_{filename}.gz"
-            data = file.read()
-            comp = encrypt_attachment(data)
-            with open(dest, "wb") as f:
-                f.write(comp)
-            att = Attachment(filename=str(dest), original_name=filename, post=post)
+            digest, size = store_upload(file.stream)
+            att = Attachment(
+                filename=str(get_store().path(digest)),
+                original_name=filename,
+                sha256=digest,
+                size=size,
+                post=post,
+            )
             db.session.add(att)
         db.session.commit()
         try:
@@ -175,6 +185,7 @@ def edit_post(post_id):
             post.title = title
             post.body = body
             post.edited_at = datetime.utcnow()
+            invalidate(post.id)
             db.session.commit()
             try:
                 from .forums import get_forum_posts
@@ -198,22 +209,7 @@ def delete_post(post_id):
     if not verify_action_token(post.id, token):
         return redirect(url_for("forums.view_forum", forum_id=post.forum_id))
     reason = request.form.get("reason") if current_user.is_moderator else None
-
-    def _delete_recursive(p: Post, hard: bool):
-        for child in list(p.children):
-            _delete_recursive(child, hard)
-        if hard:
-            for att in list(p.attachments):
-                try:
-                    Path(att.filename).unlink(missing_ok=True)
-                except Exception:
-                    pass
-                db.session.delete(att)
-            db.session.delete(p)
-        else:
-            p.deleted = True
-            if p is post and reason:
-                p.delete_reason = reason
+    forum_id = post.forum_id
 
     if reason and current_user.is_moderator:
         note = ModNote(
@@ -223,8 +219,15 @@ def delete_post(post_id):
             post_id=post.id,
         )
         db.session.add(note)
-    _delete_recursive(post, current_user.is_moderator)
+    files = []
+    if current_user.is_moderator:
+        files = hard_delete_subtree(post.id)
+    else:
+        soft_delete_subtree(post.id)
+        if reason:
+            post.delete_reason = reason
     db.session.commit()
+    release_attachments(files)
     try:
         from .forums import get_forum_posts
 
@@ -232,7 +235,7 @@ def delete_post(post_id):
         clear_suggest_cache()
     except Exception:
         pass
-    return redirect(url_for("forums.view_forum", forum_id=post.forum_id))
+    return redirect(url_for("forums.view_forum", forum_id=forum_id))
 
 
 @main_bp.route("/post/<int:post_id>/restore", methods=["POST"])
@@ -289,6 +292,7 @@ def revert_post(post_id, ver_id):
     post.title = ver.title
     post.body = ver.body
     post.edited_at = datetime.utcnow()
+    invalidate(post.id)
     db.session.commit()
     try:
         from .forums import get_forum_posts
@@ -423,13 +427,7 @@ def move_post(post_id):
         forum_id = request.form.get("forum_id", type=int)
         forum = Forum.query.get(forum_id)
         if forum:
-
-            def _move_recursive(p: Post):
-                p.forum_id = forum_id
-                for child in p.children:
-                    _move_recursive(child)
-
-            _move_recursive(post)
+            move_subtree(post.id, forum_id)
             db.session.commit()
             try:
                 from .forums import get_forum_posts
@@ -461,13 +459,8 @@ def split_post(post_id):
         forum_id = request.form.get("forum_id", type=int)
         forum = Forum.query.get(forum_id)
         if forum:
-
-            def _move_recursive(p: Post):
-                p.forum_id = forum_id
-                for child in p.children:
-                    _move_recursive(child)
-
-            _move_recursive(post)
+            move_subtree(post.id, forum_id)
+            split_subtree(post.id)
             post.parent_id = None
             post.owner_token = generate_owner_token(post.id, post.user_id)
             db.session.commit()
@@ -491,11 +484,7 @@ def get_attachment(att_id):
     att = Attachment.query.get_or_404(att_id)
     path = Path(att.filename)
     if path.suffix == ".gz":
-        with gzip.open(path, "rb") as f:
-            data = f.read()
-        return send_file(
-            io.BytesIO(data), as_attachment=True, download_name=att.original_name
-        )
+        return send_attachment(path, att.original_name, att.sha256, att.size)
     return send_from_directory(
         path.parent, path.name, as_attachment=True, download_name=att.original_name
     )
@@ -615,23 +604,10 @@ def delete_flagged_post(flag_id):
             post_id=flg.post.id,
         )
         db.session.add(note)
-
-    def _del_recursive(p: Post):
-        for ch in list(p.children):
-            _del_recursive(ch)
-        for att in list(p.attachments):
-            try:
-                Path(att.filename).unlink(missing_ok=True)
-            except Exception:
-                pass
-            db.session.delete(att)
-        for fl in list(p.flags):
-            db.session.delete(fl)
-        db.session.delete(p)
-
-    _del_recursive(flg.post)
-    db.session.delete(flg)
+    # the flag itself belongs to the subtree and goes with it
+    files = hard_delete_subtree(flg.post_id)
     db.session.commit()
+    release_attachments(files)
     try:
         from .forums import get_forum_posts
 
@@ -688,13 +664,9 @@ def search():
         if sort == "oldest":
             q = q.order_by(Post.timestamp.asc())
         elif sort == "replies":
-            from sqlalchemy import func
-
-            q = (
-                q.outerjoin(Post.children)
-                .group_by(Post.id)
-                .order_by(func.count(Post.id).desc())
-            )
+            q = q.order_by(Post.reply_count.desc(), Post.timestamp.desc())
+        elif sort == "activity":
+            q = q.order_by(Post.last_activity.desc())
         else:
             q = q.order_by(Post.timestamp.desc())
         results = q.all()
@@ -0,0 +1,294 @@
+"""Deliver queued posts from the ``outbox`` table in batched sync packages.
+
+``bbs.py queue post`` stores a message in ``outbox`` while the node is
+offline.  :class:`OutboxFlusher` claims the oldest pending rows in
+``queued_at`` order, writes them as one binary sync package (see
+:mod:`syncpack`) and hands it to a link:
+
+* :class:`HttpLink` uploads the package to a node with
+  :func:`transfer.upload`.  The node imports it before answering, and the
+  batch is acknowledged only once the answer carries the import summary.
+* :class:`RadioLink` queues the package on a :class:`scheduler.LinkScheduler`,
+  which keeps to the channel's duty cycle.  The batch is acknowledged when
+  the scheduler reports the package sent, e.g. by :func:`radio_sender`
+  once the receiving station holds every chunk.
+
+A claimed row is ``in_flight`` until acknowledged (``acked``).  A failed
+batch goes back to ``pending`` with exponential backoff.  A batch that is
+never acknowledged is claimed again after :data:`IN_FLIGHT_TIMEOUT`.
+Message ids are the outbox ids, so a batch delivered twice is imported
+once.
+"""
+import io
+import logging
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import zstandard
+
+import metrics
+from db import get_conn, node_id
+from syncpack import PackReader, PackWriter
+
+# rows and body bytes per package; the first row always goes
+BATCH_SIZE = 100
+BATCH_BYTES = 64 * 1024
+# retry delay after the first failure, doubling up to RETRY_MAX
+RETRY_BASE = 30.0
+RETRY_MAX = 3600.0
+# an unacknowledged batch is sent again after this many seconds
+IN_FLIGHT_TIMEOUT = 600.0
+# packages are small and often cross the radio, so squeeze hard
+PACKAGE_LEVEL = 19
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+ACKED = 'acked'
+
+logger = logging.getLogger('outbox')
+
+
+def backoff(attempts):
+    """Return the delay before retrying a row that failed *attempts* times."""
+    return min(RETRY_BASE * 2 ** max(attempts - 1, 0), RETRY_MAX)
+
+
+def build_package(conn, batch_id, rows):
+    """Return a zstd-compressed binary package holding the outbox *rows*."""
+    buf = io.BytesIO()
+    writer = PackWriter(buf)
+    writer.manifest({'node': node_id(conn), 'outbox': batch_id})
+    for r in rows:
+        writer.message({
+            'id': r['id'],
+            'thread_id': r['thread_id'],
+            'timestamp': r['queued_at'],
+            'updated_at': r['queued_at'],
+            'author': r['author'],
+            'body': r['body'],
+        })
+    writer.close()
+    return zstandard.ZstdCompressor(level=PACKAGE_LEVEL).compress(buf.getvalue())
+
+
+def package_batch(package):
+    """Return the outbox batch id recorded in *package*, or ``None``."""
+    data = zstandard.ZstdDecompressor().decompress(package)
+    for kind, value in PackReader(io.BytesIO(data)):
+        return value.get('outbox') if kind == 'manifest' else None
+    return None
+
+
+class HttpLink:
+    """Upload packages to the node at *base_url*, acknowledged synchronously."""
+
+    def __init__(self, base_url, peer=None):
+        self.base_url = base_url
+        self.peer = peer
+
+    def send(self, package):
+        from transfer import upload
+
+        with tempfile.NamedTemporaryFile(suffix='.zst') as f:
+            f.write(package)
+            f.flush()
+            status = upload(self.base_url, f.name, peer=self.peer)
+        if not status.get('imported') or status.get('import') is None:
+            # received is not imported; let the batch back off and retry
+            raise IOError(status.get('import_error') or 'package not imported')
+        return True
+
+    def poll(self):
+        return False
+
+
+class RadioLink:
+    """Queue packages on a :class:`scheduler.LinkScheduler`.
+
+    The flusher is told of delivery through the scheduler's ``on_sent``
+    callback, so :meth:`send` returns ``None``.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def send(self, package):
+        self.scheduler.queue_packet(package)
+        return None
+
+    def poll(self):
+        """Give the scheduler a turn; return True while packages wait."""
+        self.scheduler.run_once()
+        return bool(len(self.scheduler.queue))
+
+
+def radio_sender(arq, store, directory, timeout=60.0):
+    """Return a ``send_fn`` that delivers packages with :func:`transfer.radio_send`.
+
+    Packages are written to *directory* and offered in *store* so that an
+    interrupted transfer resumes; a package that is not delivered raises
+    ``IOError`` and the scheduler backs off.
+    """
+    from transfer import RADIO_CHUNK_SIZE, radio_send
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    def send(package):
+        path = directory / f'{package_batch(package)}.zst'
+        path.write_bytes(package)
+        tid = store.offer(str(path), chunk_size=RADIO_CHUNK_SIZE)['id']
+        if not radio_send(arq, store, tid, timeout=timeout):
+            raise IOError(f'transfer {tid} interrupted')
+        path.unlink(missing_ok=True)
+
+    return send
+
+
+class OutboxFlusher:
+    """Drain the outbox of *db_path* through *link* in batches.
+
+    ``stats`` counts the batches sent and the messages acknowledged or
+    failed since the flusher was created; :meth:`rate` gives the
+    acknowledged messages per minute.
+    """
+
+    def __init__(self, db_path, link, batch_size=BATCH_SIZE, batch_bytes=BATCH_BYTES,
+                 clock=time.time):
+        self.db_path = db_path
+        self.link = link
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.clock = clock
+        self.started = clock()
+        self.stats = {'batches': 0, 'acked': 0, 'failed': 0}
+        scheduler = getattr(link, 'scheduler', None)
+        if scheduler is not None:
+            scheduler.on_sent = self._package_sent
+
+    def _conn(self):
+        return get_conn(self.db_path)
+
+    def claim(self):
+        """Mark the next batch of due rows in flight; return ``(batch_id, rows)``."""
+        conn = self._conn()
+        now = self.clock()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            candidates = conn.execute(
+                """SELECT id, thread_id, author, body, queued_at FROM outbox
+                WHERE (state=? AND next_attempt<=?) OR (state=? AND sent_at<?)
+                ORDER BY queued_at LIMIT ?""",
+                (PENDING, now, IN_FLIGHT, now - IN_FLIGHT_TIMEOUT, self.batch_size),
+            ).fetchall()
+            rows, size = [], 0
+            for r in candidates:
+                size += len(r['body'] or '')
+                if rows and size > self.batch_bytes:
+                    break
+                rows.append(r)
+            batch_id = uuid.uuid4().hex if rows else None
+            conn.executemany(
+                """UPDATE outbox SET state=?, batch_id=?, sent_at=?, attempts=attempts+1
+                WHERE id=?""",
+                [(IN_FLIGHT, batch_id, now, r['id']) for r in rows],
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return batch_id, rows
+
+    def ack(self, batch_id):
+        """Mark the rows of *batch_id* delivered; return how many there were."""
+        conn = self._conn()
+        count = conn.execute(
+            "UPDATE outbox SET state=?, acked_at=?, last_error=NULL WHERE batch_id=? AND state=?",
+            (ACKED, datetime.utcnow().isoformat(), batch_id, IN_FLIGHT),
+        ).rowcount
+        conn.commit()
+        self.stats['acked'] += count
+        return count
+
+    def fail(self, batch_id, error):
+        """Return the rows of *batch_id* to the queue, each with its backoff."""
+        conn = self._conn()
+        now = self.clock()
+        rows = conn.execute(
+            "SELECT id, attempts FROM outbox WHERE batch_id=? AND state=?", (batch_id, IN_FLIGHT)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE outbox SET state=?, next_attempt=?, last_error=? WHERE id=?",
+            [(PENDING, now + backoff(r['attempts']), str(error), r['id']) for r in rows],
+        )
+        conn.commit()
+        self.stats['failed'] += len(rows)
+        return len(rows)
+
+    def _package_sent(self, package):
+        batch_id = package_batch(package)
+        if batch_id:
+            self.ack(batch_id)
+
+    def flush_once(self):
+        """Send one batch; return the number of rows it held (0 when idle)."""
+        batch_id, rows = self.claim()
+        if not rows:
+            return 0
+        package = build_package(self._conn(), batch_id, rows)
+        self.stats['batches'] += 1
+        try:
+            delivered = self.link.send(package)
+        except Exception as exc:
+            logger.warning('outbox batch %s failed: %s', batch_id, exc)
+            self.fail(batch_id, exc)
+            return len(rows)
+        if delivered:
+            self.ack(batch_id)
+        elif delivered is not None:
+            self.fail(batch_id, 'not acknowledged')
+        return len(rows)
+
+    def flush(self, timeout=None):
+        """Send every due row, and wait for queued packages up to *timeout* seconds."""
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            sent = self.flush_once()
+            waiting = self.link.poll()
+            if not sent and not waiting:
+                break
+            if deadline is not None and self.clock() >= deadline:
+                break
+            if not sent:
+                time.sleep(1)
+        return self.stats
+
+    def run(self, interval=30.0, stop=None, metrics_file=None):
+        """Flush every *interval* seconds until the *stop* event is set.
+
+        A metrics snapshot is written to *metrics_file*, if given, after
+        each round.
+        """
+        while stop is None or not stop.is_set():
+            self.flush(timeout=interval)
+            logger.info('outbox: %s, %.1f msg/min', self.stats, self.rate())
+            if metrics_file:
+                metrics.dump(metrics_file)
+            if stop is not None:
+                stop.wait(interval)
+            else:
+                time.sleep(interval)
+
+    def rate(self):
+        """Return acknowledged messages per minute since the flusher started."""
+        elapsed = max(self.clock() - self.started, 1e-9)
+        return self.stats['acked'] * 60.0 / elapsed
+
+    def pending(self):
+        """Return ``{state: count}`` for the rows in the outbox."""
+        rows = self._conn().execute("SELECT state, COUNT(*) FROM outbox GROUP BY state")
+        return {state: n for state, n in rows}
+
@@ -3,11 +3,14 @@ import serial
 import socket
 import threading
 import time
-from typing import Iterable, List, Callable
+from typing import Iterable, List, Callable, Optional
 
 import crcmod.predefined
+import zstandard as zstd
 from reedsolo import RSCodec
 
+import metrics
+
 FEND = 0xC0
 FESC = 0xDB
 TFEND = 0xDC
@@ -95,6 +98,23 @@ class RadioInterface:
             self._hb_thread.join(timeout=1)
 
 
+FRAMES_SENT = metrics.counter("radio_frames_sent_total", "KISS frames encoded for sending")
+FRAMES_RECEIVED = metrics.counter("radio_frames_received_total", "KISS frames decoded")
+FRAME_BYTES = metrics.counter("radio_frame_bytes_total", "KISS frame bytes", ("direction",))
+CRC_FAILURES = metrics.counter("radio_crc_failures_total", "Frames failing their CRC-16")
+FEC_SECONDS = metrics.histogram(
+    "radio_fec_seconds", "Reed-Solomon encode and decode time", ("op",),
+    buckets=metrics.FAST_BUCKETS,
+)
+FEC_FAILURES = metrics.counter("radio_fec_failures_total", "Frames Reed-Solomon could not repair")
+ARQ_UNACKED = metrics.gauge("radio_arq_unacked", "ARQ frames sent and not yet acknowledged")
+ARQ_TIMEOUTS = metrics.counter("radio_arq_ack_timeouts_total", "ARQ waits that heard no ACK")
+_sent_bytes = FRAME_BYTES.labels("out")
+_received_bytes = FRAME_BYTES.labels("in")
+_fec_encode_seconds = FEC_SECONDS.labels("encode")
+_fec_decode_seconds = FEC_SECONDS.labels("decode")
+
+
 def kiss_encode(payload: bytes) -> bytes:
     """Encode raw bytes into a KISS frame."""
     frame = bytearray([FEND, 0x00])  # port 0
@@ -106,6 +126,8 @@ def kiss_encode(payload: bytes) -> bytes:
         else:
             frame.append(b)
     frame.append(FEND)
+    FRAMES_SENT.inc()
+    _sent_bytes.inc(len(frame))
     return bytes(frame)
 
 
@@ -131,6 +153,8 @@ def kiss_decode(frame: bytes) -> bytes:
         if b == FEND:
             break
         payload.append(b)
+    FRAMES_RECEIVED.inc()
+    _received_bytes.inc(len(frame))
     return bytes(payload)
 
 
@@ -176,12 +200,18 @@ crc16 = crcmod.predefined.mkCrcFun("crc-16")
 
 def fec_encode(data: bytes) -> bytes:
     """Encode *data* with Reed-Solomon FEC."""
-    return bytes(rsc.encode(data))
+    with _fec_encode_seconds.time():
+        return bytes(rsc.encode(data))
 
 
 def fec_decode(data: bytes) -> bytes:
     """Decode Reed-Solomon encoded *data*. Raises ``ValueError`` on failure."""
-    decoded, _, _ = rsc.decode(data)
+    try:
+        with _fec_decode_seconds.time():
+            decoded, _, _ = rsc.decode(data)
+    except Exception:
+        FEC_FAILURES.inc()
+        raise
     return bytes(decoded)
 
 
@@ -194,9 +224,11 @@ def add_crc(data: bytes) -> bytes:
 def verify_crc(frame: bytes) -> bytes:
     """Return payload if CRC matches, else raise ``ValueError``."""
     if len(frame) < 2:
+        CRC_FAILURES.inc()
         raise ValueError("frame too short for CRC")
     data, chk = frame[:-2], frame[-2:]
     if crc16(data) != int.from_bytes(chk, "big"):
+        CRC_FAILURES.inc()
         raise ValueError("CRC mismatch")
     return data
 
@@ -230,18 +262,70 @@ def deinterleave(data: bytes, block: int = 4) -> bytes:
     return out.rstrip(b"\x00")
 
 
+# ---- Payload compression ----
+
+FRAME_RAW = 0
+FRAME_ZSTD = 1
+
+
+def compress_frame(payload: bytes, zdict=None, level: int = 19) -> bytes:
+    """Prefix *payload* with a codec byte, zstd-compressing it if that is smaller.
+
+    With a trained dictionary (see ``compression.py``) even a single short
+    message shrinks; its id travels in the zstd frame header.
+    """
+    packed = zstd.ZstdCompressor(level=level, dict_data=zdict).compress(payload)
+    if len(packed) < len(payload):
+        return bytes([FRAME_ZSTD]) + packed
+    return bytes([FRAME_RAW]) + payload
+
+
+def decompress_frame(frame: bytes, dictionaries: dict | None = None) -> bytes:
+    """Reverse :func:`compress_frame`; *dictionaries* maps dict id to dictionary."""
+    if not frame:
+        raise ValueError("empty frame")
+    codec, body = frame[0], frame[1:]
+    if codec == FRAME_RAW:
+        return body
+    if codec != FRAME_ZSTD:
+        raise ValueError(f"unknown frame codec {codec}")
+    dict_id = zstd.get_frame_parameters(body).dict_id
+    zdict = (dictionaries or {}).get(dict_id) if dict_id else None
+    if dict_id and zdict is None:
+        raise ValueError(f"unknown zstd dictionary {dict_id}")
+    return zstd.ZstdDecompressor(dict_data=zdict).decompress(body)
+
+
 def chunk_data(data: bytes, size: int = 256) -> List[bytes]:
     """Split *data* into MTU-sized chunks."""
     return [data[i : i + size] for i in range(0, len(data), size)]
 
 
 class SlidingWindowARQ:
-    """Very small sliding-window ARQ helper."""
+    """Very small sliding-window ARQ helper.
 
-    def __init__(self, tnc: KISSTnc, window: int = 4, timeout: float = 2.0):
+    With ``compress=True`` every chunk is sent through :func:`compress_frame`
+    using *zdict*; *dictionaries* lists the dictionaries the receiver can
+    decode with (by default just *zdict*).  Both ends must agree on it.
+    """
+
+    def __init__(
+        self,
+        tnc: KISSTnc,
+        window: int = 4,
+        timeout: float = 2.0,
+        compress: bool = False,
+        zdict=None,
+        dictionaries: dict | None = None,
+    ):
         self.tnc = tnc
         self.window = window
         self.timeout = timeout
+        self.compress = compress
+        self.zdict = zdict
+        if dictionaries is None and zdict is not None:
+            dictionaries = {zdict.dict_id(): zdict}
+        self.dictionaries = dictionaries or {}
         self._seq = 0
         self._unacked: dict[int, bytes] = {}
 
@@ -253,11 +337,14 @@ class SlidingWindowARQ:
         while len(self._unacked) >= self.window:
             self._wait_for_ack()
         seq = self._seq
+        if self.compress:
+            chunk = compress_frame(chunk, self.zdict)
         frame = bytes([seq])
         frame = fec_encode(frame + chunk)
         frame = add_crc(frame)
         self.tnc.send_packet(frame)
         self._unacked[seq] = frame
+        ARQ_UNACKED.set(len(self._unacked))
         self._seq = (self._seq + 1) % 256
 
     def _wait_for_ack(self) -> None:
@@ -274,7 +361,9 @@ class SlidingWindowARQ:
             if payload.startswith(b"A"):
                 ack = payload[1]
                 self._unacked.pop(ack, None)
+                ARQ_UNACKED.set(len(self._unacked))
                 return
+        ARQ_TIMEOUTS.inc()
 
     def receive(self) -> bytes:
         data = self.tnc.receive_packet()
@@ -287,6 +376,8 @@ class SlidingWindowARQ:
             return b""
         seq = payload[0]
         self.tnc.send_packet(add_crc(fec_encode(b"A" + bytes([seq]))))
+        if self.compress:
+            return decompress_frame(payload[1:], self.dictionaries)
         return payload[1:]
 
 
@@ -377,11 +468,16 @@ class SimulatedVaraHF(VaraHFClient):
         super().__init__(*args, **kwargs)
         self._incoming: list[bytes] = []
         self.sent: list[bytes] = []
+        self.peer: SimulatedVaraHF | None = None
 
     def feed(self, data: bytes) -> None:
         """Provide data that will be returned by :meth:`receive`."""
         self._incoming.append(data)
 
+    def connect(self, other: "SimulatedVaraHF") -> None:
+        """Wire this modem and *other* back to back, like two stations on air."""
+        self.peer, other.peer = other, self
+
     def open(self):
         """Simulated open -- no external resources are used."""
         self.sock = True  # sentinel so methods think we are connected
@@ -393,6 +489,8 @@ class SimulatedVaraHF(VaraHFClient):
         if not self.sock:
             self.open()
         self.sent.append(data)
+        if self.peer is not None:
+            self.peer.feed(data)
 
     def receive(self, size=1024) -> bytes:
         if not self.sock:
@@ -419,16 +517,19 @@ def opportunistic_relay(
     server and our own path respectively.  Frames are forwarded only when the
     peer's metric exceeds ours.  If either callable is ``None`` the frame is
     forwarded unconditionally.  Frames that fail to send remain in *queue* so
-    they may be retried later.
+    they may be retried later, in their original order.  The metrics are
+    read once per call; :class:`links.LinkManager` routes over several links
+    with rolling estimates.
     """
 
-    for frame in list(queue):
+    if peer_quality and own_quality and peer_quality() <= own_quality():
+        return
+    kept = []
+    for frame in queue:
         try:
-            if peer_quality and own_quality:
-                if peer_quality() <= own_quality():
-                    continue
             forward_fn(frame)
-            queue.remove(frame)
         except Exception:
             # if forwarding fails, leave the frame in the queue
-            pass
+            kept.append(frame)
+    queue.clear()
+    queue.extend(kept)
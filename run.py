@@ -1,25 +1,33 @@
+import os
 import sys
 
-MISSING = []
-for pkg in [
-    "flask",
-    "flask_sqlalchemy",
-    "flask_login",
-    "werkzeug",
-    "zstandard",
-    "pyserial",
-    "reedsolo",
-    "crcmod",
-    "cryptography",
-    "markdown",
-]:
-    try:
-        __import__(pkg.replace("-", "_"))
-    except ImportError:
-        MISSING.append(pkg)
+# pip name -> import name
+REQUIREMENTS = {
+    "flask": "flask",
+    "flask_sqlalchemy": "flask_sqlalchemy",
+    "flask_login": "flask_login",
+    "werkzeug": "werkzeug",
+    "zstandard": "zstandard",
+    "pyserial": "serial",
+    "reedsolo": "reedsolo",
+    "crcmod": "crcmod",
+    "cryptography": "cryptography",
+    "markdown": "markdown",
+}
+
+
+def missing_packages():
+    """Return requirements that cannot be found, without importing them."""
+    from importlib.util import find_spec
+
+    return [pkg for pkg, module in REQUIREMENTS.items() if find_spec(module) is None]
 
-if MISSING:
-    missing_list = ", ".join(MISSING)
+
+def check_dependencies():
+    missing = missing_packages()
+    if not missing:
+        return
+    missing_list = ", ".join(missing)
     print(
         f"Missing required packages detected: {missing_list}.\n"
         "Attempting to install from requirements.txt..."
@@ -34,31 +42,19 @@ if MISSING:
         sys.exit(
             "Automatic installation failed. Please run 'pip install -r requirements.txt'"
         )
-    # re-check imports after installation
-    REMAINING = []
-    for pkg in [
-        "flask",
-        "flask_sqlalchemy",
-        "flask_login",
-        "werkzeug",
-        "zstandard",
-        "pyserial",
-        "reedsolo",
-        "crcmod",
-        "cryptography",
-        "markdown",
-    ]:
-        try:
-            __import__(pkg.replace("-", "_"))
-        except ImportError:
-            REMAINING.append(pkg)
-    if REMAINING:
-        remaining_list = ", ".join(REMAINING)
+    remaining = missing_packages()
+    if remaining:
+        remaining_list = ", ".join(remaining)
         sys.exit(
             f"Failed to install required packages: {remaining_list}.\n"
             "Please install them manually using 'pip install -r requirements.txt'."
         )
 
+
+# the probe is opt-in so cold starts do not pay for it on every boot
+if "--check-deps" in sys.argv or os.environ.get("OPENBBS_CHECK_DEPS"):
+    check_dependencies()
+
 from openbbs import create_app
 
 app = create_app()
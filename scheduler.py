@@ -8,6 +8,14 @@ from pathlib import Path
 import json
 import base64
 
+import metrics
+
+QUEUE_DEPTH = metrics.gauge("radio_queue_depth", "Items waiting in a radio queue", ("queue",))
+PACKETS = metrics.counter(
+    "radio_scheduler_packets_total", "Scheduler send attempts by outcome", ("outcome",)
+)
+_depth = QUEUE_DEPTH.labels("scheduler")
+
 
 @dataclass(order=True)
 class PrioritizedItem:
@@ -26,13 +34,27 @@ class PrioritySyncQueue:
     def push(self, item: Any, priority: int = 10) -> None:
         heapq.heappush(self._heap, PrioritizedItem(priority, item))
 
+    def requeue(self, entry: PrioritizedItem) -> None:
+        """Put a popped *entry* back, keeping its attempts and next attempt."""
+        heapq.heappush(self._heap, entry)
+
     def pop(self) -> Optional[PrioritizedItem]:
         if not self._heap:
             return None
         top = self._heap[0]
         if top.next_attempt <= time.time():
             return heapq.heappop(self._heap)
-        return None
+        # an entry backing off must not hold up the ones behind it
+        now = time.time()
+        due = [i for i, entry in enumerate(self._heap) if entry.next_attempt <= now]
+        if not due:
+            return None
+        i = min(due, key=lambda i: self._heap[i])
+        entry = self._heap[i]
+        self._heap[i] = self._heap[-1]
+        self._heap.pop()
+        heapq.heapify(self._heap)
+        return entry
 
     def __len__(self) -> int:
         return len(self._heap)
@@ -78,6 +100,10 @@ class PersistentSyncQueue(PrioritySyncQueue):
         super().push(item, priority)
         self._save()
 
+    def requeue(self, entry: PrioritizedItem) -> None:
+        super().requeue(entry)
+        self._save()
+
     def pop(self) -> Optional[PrioritizedItem]:
         itm = super().pop()
         if itm:
@@ -86,7 +112,11 @@ class PersistentSyncQueue(PrioritySyncQueue):
 
 
 class LinkScheduler:
-    """Schedule periodic sync jobs respecting duty-cycle limits."""
+    """Schedule periodic sync jobs respecting duty-cycle limits.
+
+    *on_sent*, if given, is called with each packet once ``send_fn``
+    returns without raising.
+    """
 
     def __init__(
         self,
@@ -94,10 +124,12 @@ class LinkScheduler:
         window: float = 60.0,
         busy_check: Optional[Callable[[], bool]] = None,
         queue_path: Optional[str | Path] = None,
+        on_sent: Optional[Callable[[bytes], None]] = None,
     ) -> None:
         self.send_fn = send_fn
         self.window = window
         self.busy_check = busy_check
+        self.on_sent = on_sent
         if queue_path:
             self.queue: PrioritySyncQueue = PersistentSyncQueue(queue_path)
         else:
@@ -106,6 +138,7 @@ class LinkScheduler:
 
     def queue_packet(self, packet: bytes, priority: int = 10) -> None:
         self.queue.push(packet, priority)
+        _depth.set(len(self.queue))
 
     def run_once(self) -> None:
         if not len(self.queue):
@@ -116,12 +149,14 @@ class LinkScheduler:
         if self.busy_check and self.busy_check():
             # channel busy, try again later
             item.next_attempt = time.time() + 5
-            self.queue.push(item.item, item.priority)
+            self.queue.requeue(item)
+            PACKETS.labels("busy").inc()
             return
         if time.time() - self._last_tx < self.window:
             # not within allowed window yet
             item.next_attempt = time.time() + self.window
-            self.queue.push(item.item, item.priority)
+            self.queue.requeue(item)
+            PACKETS.labels("deferred").inc()
             return
         try:
             self.send_fn(item.item)
@@ -130,4 +165,11 @@ class LinkScheduler:
             item.attempts += 1
             # simple exponential backoff
             item.next_attempt = time.time() + min(60 * (2**item.attempts), 3600)
-            self.queue.push(item.item, item.priority)
+            self.queue.requeue(item)
+            PACKETS.labels("failed").inc()
+            return
+        finally:
+            _depth.set(len(self.queue))
+        PACKETS.labels("sent").inc()
+        if self.on_sent:
+            self.on_sent(item.item)
@@ -1,49 +1,518 @@
+import hashlib
 import json
 import logging
+import os
+import shutil
 import sqlite3
 import tarfile
 import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
-import zstandard as zstd
+from blobstore import BlobStore
+from compression import DEFAULT_LEVEL, compressor, decompressor, get_dictionary
+from keycache import (
+    VERIFY_CHUNK, load_public_key, message_payload, sign_checkpoint, verify_batch, verify_checkpoint,
+)
+import metrics
+from merkle import merkle_root
+from syncpack import MAGIC, PackReader, PackWriter
+from db import (
+    ENTITY_TABLES, ensure_schema, get_conn, high_water, log_change, node_id, record_sync,
+)
 
-from db import connect, init_db, record_sync
+# messages per batch handed to a worker in a parallel export, and per
+# batch of signatures checked on import
+PARALLEL_BATCH = 5000
+
+SYNC_SECONDS = metrics.histogram(
+    'sync_seconds', 'Time to export or import a package', ('direction',),
+    buckets=metrics.SLOW_BUCKETS,
+)
+SYNC_BYTES = metrics.counter('sync_bytes_total', 'Package bytes written or read', ('direction',))
+SYNC_ROWS = metrics.counter(
+    'sync_rows_total', 'Threads, messages and tombstones exported or imported', ('direction', 'kind'),
+)
 
 logger = logging.getLogger('sync')
 logger.setLevel(logging.INFO)
 
+# HAMBBS_SYNC_LOG moves the log file; set it empty to log to stderr only
+SYNC_LOG = os.environ.get('HAMBBS_SYNC_LOG', 'sync.log')
+
 if not logger.handlers:
-    fh = logging.FileHandler('sync.log')
-    fh.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
+    if SYNC_LOG:
+        fh = logging.FileHandler(SYNC_LOG)
+        fh.setLevel(logging.INFO)
+        formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
+        fh.setFormatter(formatter)
+        logger.addHandler(fh)
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
     logger.addHandler(ch)
 
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _touch_peer(conn, peer):
+    conn.execute("INSERT OR IGNORE INTO sync_peers (peer_id) VALUES (?)", (peer,))
+    conn.execute(
+        "UPDATE sync_peers SET last_sync=? WHERE peer_id=?",
+        (datetime.utcnow().isoformat(), peer)
+    )
+
+
+def _record_package(conn, peer, direction, path, cursor, size):
+    _touch_peer(conn, peer)
+    conn.execute(
+        """INSERT OR REPLACE INTO sync_packages
+        (sha256, peer_id, direction, cursor, size, created_at) VALUES (?,?,?,?,?,?)""",
+        (_file_sha256(path), peer, direction, cursor, size, datetime.utcnow().isoformat())
+    )
+
+
+def _leaf(record):
+    """Digest of one record as covered by a tar package's signature."""
+    return hashlib.sha256(json.dumps(record, sort_keys=True, separators=(',', ':')).encode()).digest()
+
+
+def _encode_threads(batch):
+    """Serialise ``(thread_id, messages)`` pairs; runs in a worker process."""
+    return [(tid, json.dumps(msgs).encode()) for tid, msgs in batch]
+
+
+def _normalise(info):
+    # identical input gives an identical archive, whoever builds it and when
+    info.mtime = 0
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    return info
+
+
+class _TarSink:
+    """Collect a package as JSON files and tar them up on :meth:`finish`.
+
+    With more than one *worker*, batches of threads are serialised in a
+    process pool while the caller keeps reading; results are written in
+    submission order, so the package does not depend on the worker count.
+
+    With a *signing_key*, the manifest gets a ``signature`` over the Merkle
+    root of the manifest and every thread, message and tombstone, in the
+    order :meth:`SyncEngine.push` reads them back.
+    """
+
+    def __init__(self, output_path, cctx, manifest, workers=1, signing_key=None):
+        self.output_path = output_path
+        self.cctx = cctx
+        self.manifest = manifest
+        self.signing_key = signing_key
+        self.leaves = [] if signing_key else None
+        self.base = Path(tempfile.mkdtemp())
+        (self.base / 'threads').mkdir()
+        self.index = []
+        self.pool = ProcessPoolExecutor(workers) if workers > 1 else None
+        self.workers = workers
+        self.pending = deque()
+        self.batch = []
+        self.batch_size = 0
+
+    def thread(self, t, msgs):
+        self.index.append(t)
+        if self.leaves is not None:
+            self.leaves.append(_leaf(t))
+            self.leaves.extend(_leaf(m) for m in msgs)
+        if self.pool is None:
+            # json.dumps uses the C encoder, json.dump does not
+            self._write([(t['id'], json.dumps(msgs).encode())])
+            return
+        self.batch.append((t['id'], msgs))
+        self.batch_size += len(msgs) + 1
+        if self.batch_size >= PARALLEL_BATCH:
+            self._submit()
+
+    def _submit(self):
+        if self.batch:
+            self.pending.append(self.pool.submit(_encode_threads, self.batch))
+            self.batch = []
+            self.batch_size = 0
+        # bound the rows held in flight
+        while len(self.pending) > 2 * self.workers:
+            self._write(self.pending.popleft().result())
+
+    def _write(self, encoded):
+        for tid, data in encoded:
+            with open(self.base / 'threads' / f'{tid}.json', 'wb') as f:
+                f.write(data)
+
+    def finish(self, blobs):
+        if self.pool is not None:
+            try:
+                self._submit()
+                while self.pending:
+                    self._write(self.pending.popleft().result())
+            finally:
+                self.pool.shutdown()
+        base = self.base
+        if self.signing_key is not None:
+            self._sign()
+        with open(base / 'index.json', 'w') as f:
+            json.dump(self.index, f)
+        with open(base / 'manifest.json', 'w') as f:
+            json.dump(self.manifest, f)
+        tar_path = base / 'package.tar'
+        try:
+            with tarfile.open(tar_path, 'w') as tar:
+                tar.add(base / 'manifest.json', arcname='manifest.json', filter=_normalise)
+                tar.add(base / 'index.json', arcname='index.json', filter=_normalise)
+                tar.add(base / 'threads', arcname='threads', filter=_normalise)
+                for digest, path in blobs:
+                    tar.add(path, arcname=f'blobs/{digest}.gz', filter=_normalise)
+            with open(tar_path, 'rb') as f_in, open(self.output_path, 'wb') as f_out:
+                self.cctx.copy_stream(f_in, f_out, size=tar_path.stat().st_size)
+        finally:
+            shutil.rmtree(base, ignore_errors=True)
+
+    def _sign(self):
+        from cryptography.hazmat.primitives import serialization
+
+        manifest = self.manifest
+        root = merkle_root([_leaf(manifest)] + self.leaves)
+        public = self.signing_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw
+        )
+        manifest['signature'] = {
+            'key': public.hex(),
+            'root': root.hex(),
+            'sig': sign_checkpoint(self.signing_key, root).hex(),
+        }
+
+    def abort(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        shutil.rmtree(self.base, ignore_errors=True)
+
+
+class _PackSink:
+    """Stream a package in the binary format straight into *output_path*."""
+
+    def __init__(self, output_path, cctx, manifest, signing_key=None):
+        self.file = open(output_path, 'wb')
+        self.stream = cctx.stream_writer(self.file, closefd=False)
+        self.writer = PackWriter(self.stream, signing_key)
+        self.writer.manifest(manifest)
+        self.tombstones = manifest['tombstones']
+
+    def thread(self, t, msgs):
+        self.writer.thread(t)
+        for m in msgs:
+            self.writer.message(m)
+
+    def finish(self, blobs):
+        try:
+            for tomb in self.tombstones:
+                self.writer.tombstone(tomb)
+            for digest, path in blobs:
+                with open(path, 'rb') as f:
+                    self.writer.blob(digest, f, path.stat().st_size)
+            self.writer.close()
+            self.stream.close()
+        finally:
+            self.file.close()
+
+    def abort(self):
+        self.file.close()
+        Path(self.file.name).unlink(missing_ok=True)
+
+
+def _newer(incoming, existing):
+    """Return True if the *incoming* message supersedes the *existing* row.
+
+    Clock stamps decide when both sides have one; rows from peers that
+    predate the clock fall back to comparing ``updated_at``.
+    """
+    if incoming.get('hlc') and existing['hlc']:
+        return incoming['hlc'] > existing['hlc']
+    updated = incoming.get('updated_at', incoming['timestamp'])
+    return not (existing['updated_at'] and existing['updated_at'] >= updated)
+
+
+class _Verifier:
+    """Check author signatures on incoming messages against a key cache.
+
+    A message passes if its signature verifies against the author's key.
+    An unsigned message from an author whose key is on record fails, since
+    stripping the signature would otherwise let anyone rewrite it.
+    Messages from authors with no key in *keys* pass unless *require* is
+    set.  Batches larger than one pool task are spread over *workers*
+    processes (-1 for one per CPU), started on first use.
+    """
+
+    def __init__(self, keys, require=False, workers=1):
+        self.keys = keys
+        self.require = require
+        self.workers = (os.cpu_count() or 1) if workers < 0 else workers
+        self.pool = None
+
+    def check(self, messages):
+        results = [not self.require] * len(messages)
+        items, where = [], []
+        for i, m in enumerate(messages):
+            raw = self.keys.key_bytes(m['author']) if self.keys and m.get('author') else None
+            if raw is None:
+                continue
+            if not m.get('signature'):
+                results[i] = False
+                continue
+            try:
+                signature = bytes.fromhex(m['signature'])
+            except ValueError:
+                results[i] = False
+                continue
+            items.append((raw, message_payload(m), signature))
+            where.append(i)
+        if self.pool is None and self.workers > 1 and len(items) > VERIFY_CHUNK:
+            self.pool = ProcessPoolExecutor(self.workers)
+        for i, ok in zip(where, verify_batch(items, self.pool)):
+            results[i] = ok
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
 class SyncEngine:
-    def __init__(self, db_path='openbbs.db'):
+    """Export and import sync packages for the database at *db_path*.
+
+    With a :class:`keycache.KeyCache` as *keys*, :meth:`push` checks the
+    author signatures on incoming messages and drops those that fail, and
+    rejects signed packages whose signing key is not the sending node's
+    key on record.  *require_signatures* also drops unsigned messages and
+    refuses unsigned packages.  *verify_workers* processes share the
+    signature checks of large packages.
+    """
+
+    def __init__(self, db_path='openbbs.db', blob_root=None, keys=None,
+                 require_signatures=False, verify_workers=1):
         self.db_path = db_path
-        init_db(db_path)
+        self.blobs = BlobStore(blob_root or Path('uploads') / 'blobs')
+        self.keys = keys
+        self.require_signatures = require_signatures
+        self.verify_workers = verify_workers
+        ensure_schema(db_path)
 
     def _conn(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+        return get_conn(self.db_path)
+
+    def pull(self, since=None, thread_ids=None, output_path='sync.tar.zst', known_blobs=None,
+             cursor=None, peer=None, **options):
+        """Export a package and return its path; see :meth:`export`."""
+        return self.export(
+            since=since, thread_ids=thread_ids, output_path=output_path,
+            known_blobs=known_blobs, cursor=cursor, peer=peer, **options,
+        )['path']
+
+    def peer_state(self, peer):
+        """Return the ``sync_peers`` row for *peer* as a dict (zeros if new)."""
+        row = self._conn().execute("SELECT * FROM sync_peers WHERE peer_id=?", (peer,)).fetchone()
+        if row is None:
+            return {
+                'peer_id': peer, 'acked_cursor': 0, 'sent_cursor': 0, 'received_cursor': 0,
+                'bytes_sent': 0, 'bytes_received': 0, 'last_sync': None,
+            }
+        return dict(row)
+
+    def acknowledge(self, peer, cursor):
+        """Record that *peer* has applied our changes up to *cursor*."""
+        conn = self._conn()
+        _touch_peer(conn, peer)
+        conn.execute(
+            "UPDATE sync_peers SET acked_cursor=MAX(acked_cursor, ?) WHERE peer_id=?",
+            (int(cursor), peer)
+        )
+        conn.commit()
 
-    def pull(self, since=None, thread_ids=None, output_path='sync.tar.zst'):
-        """Export threads/messages newer than *since* to a compressed package."""
+    def export(self, since=None, thread_ids=None, output_path='sync.tar.zst', known_blobs=None,
+               cursor=None, peer=None, level=DEFAULT_LEVEL, dict_id=None, long_distance=False,
+               format='tar', signing_key=None, workers=1, progress=None):
+        """Export threads/messages newer than *since* to a compressed package.
+
+        With *cursor*, only rows recorded in ``changes`` after that sequence
+        number are exported instead, independent of timestamps, together
+        with tombstones for rows deleted since.  Every package carries the
+        high-water mark in ``manifest.json``; pass it back as the next
+        *cursor* to receive strictly the delta.
+
+        Attachment blobs are shipped once per digest under ``blobs/`` and
+        referenced from messages by hash; digests in *known_blobs* are
+        assumed to exist on the receiving side and are left out.
+
+        For a *peer*, the cursor defaults to the last one that peer
+        acknowledged (0, i.e. everything, before the first ack), changes
+        imported from that peer are left out, and the package and its size
+        are recorded in ``sync_packages``/``sync_peers``.  The manifest also
+        acknowledges the changes we have received from the peer.
+
+        The package is compressed at zstd *level*, with the stored
+        dictionary *dict_id* (small deltas) or long-distance matching
+        (large archives) if requested; :meth:`push` detects both.
+
+        *format* is ``'tar'`` (JSON files in a tar archive) or ``'pack'``,
+        the compact binary format of :mod:`syncpack`, which is streamed
+        straight to *output_path*.  Either can be signed with *signing_key*
+        (an Ed25519 private key): tar packages carry one signature over all
+        their records, binary packages one per record.
+
+        With *workers* other than 1 (-1 for one per CPU), tar packages are
+        serialised in that many processes and zstd compresses on all cores.
+        The output is the same for any worker count, though not byte for
+        byte the same as a single-threaded export.
+
+        *progress*, if given, is called as ``progress(done, total)`` after
+        each thread.
+
+        Returns a summary with the package ``path``, the new ``cursor`` and
+        the number of threads, messages and tombstones exported.
+        """
         logger.info('Starting pull operation')
-        record_sync(self.db_path, 'pull', f'since={since}')
+        started = time.perf_counter()
+        state = self.peer_state(peer) if peer else None
+        if state and cursor is None:
+            cursor = state['acked_cursor']
+        record_sync(self.db_path, 'pull', f'since={since} cursor={cursor} peer={peer}')
         conn = self._conn()
         cur = conn.cursor()
+        # hold one read snapshot so the high-water mark matches the rows
+        cur.execute('BEGIN')
+        sink = None
+        try:
+            hw = high_water(conn)
+            window = "seq>? AND seq<=?"
+            window_params = [cursor, hw]
+            if peer:
+                window += " AND (origin IS NULL OR origin<>?)"
+                window_params.append(peer)
+            threads, tombstones = self._select(
+                cur, since, thread_ids, cursor, hw, window, window_params
+            )
+            manifest = {'cursor': hw, 'node': node_id(conn), 'tombstones': tombstones}
+            if state:
+                manifest['peer'] = peer
+                manifest['ack'] = state['received_cursor']
+            zdict = get_dictionary(str(self.db_path), dict_id) if dict_id else None
+            if workers < 0:
+                workers = os.cpu_count() or 1
+            # zstd's multithreaded frames differ from single-threaded ones,
+            # so any parallel export uses them to stay reproducible
+            cctx = compressor(level, zdict, long_distance, threads=-1 if workers != 1 else 0)
+            if format == 'pack':
+                sink = _PackSink(output_path, cctx, manifest, signing_key)
+            else:
+                sink = _TarSink(output_path, cctx, manifest, workers, signing_key)
+            blobs = set()
+            exported_threads = exported_msgs = 0
+            for t in threads:
+                msg_query = "SELECT * FROM messages WHERE thread_id=?"
+                msg_params = [t['id']]
+                if since:
+                    msg_query += " AND updated_at>=?"
+                    msg_params.append(since)
+                if cursor is not None:
+                    msg_query += (
+                        " AND id IN (SELECT entity_id FROM changes"
+                        f" WHERE entity='message' AND op='upsert' AND {window})"
+                    )
+                    msg_params.extend(window_params)
+                # timestamp order keeps the pack format's time deltas small
+                msg_query += " ORDER BY timestamp, id"
+                msgs = cur.execute(msg_query, msg_params).fetchall()
+                msgs_data = [dict(m) for m in msgs]
+                # one lookup per thread rather than per message
+                atts = {}
+                for a in cur.execute(
+                    """SELECT a.message_id, a.sha256, a.name, a.size FROM message_attachments a
+                    JOIN messages m ON m.id=a.message_id WHERE m.thread_id=?
+                    ORDER BY a.message_id, a.sha256""",
+                    (t['id'],)
+                ):
+                    atts.setdefault(a['message_id'], []).append(
+                        {'sha256': a['sha256'], 'name': a['name'], 'size': a['size']}
+                    )
+                for m in msgs_data:
+                    if m['id'] in atts:
+                        m['attachments'] = atts[m['id']]
+                        blobs.update(a['sha256'] for a in atts[m['id']])
+                sink.thread({
+                    'id': t['id'],
+                    'title': t['title'],
+                    'created_at': t['created_at'],
+                    'updated_at': t['updated_at'],
+                    'hlc': t['hlc'],
+                }, msgs_data)
+                exported_threads += 1
+                exported_msgs += len(msgs_data)
+                if progress:
+                    progress(exported_threads, len(threads))
+        except Exception:
+            if sink is not None:
+                sink.abort()
+            raise
+        finally:
+            conn.rollback()
+        sink.finish([
+            (digest, self.blobs.path(digest))
+            for digest in sorted(blobs - set(known_blobs or ()))
+            if self.blobs.exists(digest)
+        ])
+        size = Path(output_path).stat().st_size
+        if peer:
+            _record_package(conn, peer, 'out', output_path, hw, size)
+            conn.execute(
+                "UPDATE sync_peers SET sent_cursor=?, bytes_sent=bytes_sent+? WHERE peer_id=?",
+                (hw, size, peer)
+            )
+            conn.commit()
+        SYNC_SECONDS.labels('out').observe(time.perf_counter() - started)
+        SYNC_BYTES.labels('out').inc(size)
+        SYNC_ROWS.labels('out', 'threads').inc(exported_threads)
+        SYNC_ROWS.labels('out', 'messages').inc(exported_msgs)
+        SYNC_ROWS.labels('out', 'tombstones').inc(len(tombstones))
+        logger.info('Pull completed: %s (cursor %d, %d bytes, %.2fs)',
+                    output_path, hw, size, time.perf_counter() - started)
+        return {
+            'path': output_path,
+            'size': size,
+            'cursor': hw,
+            'threads': exported_threads,
+            'messages': exported_msgs,
+            'tombstones': len(tombstones),
+        }
+
+    def _select(self, cur, since, thread_ids, cursor, hw, window, window_params):
+        """Return the threads to export and, for a cursor, the tombstones.
+
+        *window* is the SQL condition selecting the exported ``changes``.
+        """
         params = []
         query = "SELECT * FROM threads"
         conditions = []
         if since:
             conditions.append("updated_at >= ?")
             params.append(since)
+        if cursor is not None:
+            conditions.append(
+                f"id IN (SELECT entity_id FROM changes WHERE entity='thread' AND op='upsert' AND {window}"
+                " UNION SELECT m.thread_id FROM changes c JOIN messages m ON m.id=c.entity_id"
+                f" WHERE c.entity='message' AND c.op='upsert' AND {window})"
+            )
+            params.extend(window_params * 2)
         if thread_ids:
             placeholders = ','.join('?' for _ in thread_ids)
             conditions.append(f"id IN ({placeholders})")
@@ -51,94 +520,326 @@ class SyncEngine:
         if conditions:
             query += " WHERE " + " AND ".join(conditions)
         threads = cur.execute(query, params).fetchall()
-        base = Path(tempfile.mkdtemp())
-        (base / 'threads').mkdir()
-        index = []
-        for t in threads:
-            index.append({
-                'id': t['id'],
-                'title': t['title'],
-                'created_at': t['created_at'],
-                'updated_at': t['updated_at'],
-            })
-            msgs = cur.execute(
-                "SELECT * FROM messages WHERE thread_id=?" + (" AND updated_at>=?" if since else ""),
-                [t['id']] + ([since] if since else [])
-            ).fetchall()
-            msgs_data = [dict(m) for m in msgs]
-            with open(base / 'threads' / f"{t['id']}.json", 'w') as f:
-                json.dump(msgs_data, f)
-        with open(base / 'index.json', 'w') as f:
-            json.dump(index, f)
-        tar_path = base / 'package.tar'
-        with tarfile.open(tar_path, 'w') as tar:
-            tar.add(base / 'index.json', arcname='index.json')
-            tar.add(base / 'threads', arcname='threads')
-        compressor = zstd.ZstdCompressor()
-        with open(tar_path, 'rb') as f_in, open(output_path, 'wb') as f_out:
-            f_out.write(compressor.compress(f_in.read()))
-        logger.info('Pull completed: %s', output_path)
-        return output_path
-
-    def push(self, package_path):
+        if cursor is None:
+            return threads, []
+        # the latest change per entity decides whether it is gone
+        rows = cur.execute(
+            f"""SELECT c.entity, c.entity_id, c.hlc FROM changes c
+            WHERE c.op='delete' AND {window} AND c.seq=(
+                SELECT MAX(seq) FROM changes
+                WHERE entity=c.entity AND entity_id=c.entity_id AND seq<=?)""",
+            window_params + [hw]
+        ).fetchall()
+        tombstones = [
+            {'entity': r['entity'], 'id': r['entity_id'], 'hlc': r['hlc']}
+            for r in rows if not thread_ids or r['entity'] == 'message' or r['entity_id'] in thread_ids
+        ]
+        return threads, tombstones
+
+    def push(self, package_path, peer=None, progress=None):
+        """Import a package; changes are attributed to *peer*.
+
+        Tar and binary (:mod:`syncpack`) packages are told apart by their
+        first bytes.  *peer* defaults to the sending node's id from the
+        manifest.  The returned ``cursor`` is what the sender should be
+        acknowledged with.  *progress* is called as ``progress(done,
+        total)`` as each thread is reached; *total* is ``None`` for binary
+        packages, which are read as a stream.
+
+        Signatures are checked as described for :class:`SyncEngine`; a
+        package signature that fails raises ``ValueError`` and nothing is
+        imported, while messages failing their author's signature are
+        skipped and counted as ``rejected``.
+        """
         logger.info('Starting push operation')
+        started = time.perf_counter()
         record_sync(self.db_path, 'push', package_path)
+        verifier = None
+        if self.keys is not None or self.require_signatures:
+            verifier = _Verifier(self.keys, self.require_signatures, self.verify_workers)
+        try:
+            with open(package_path, 'rb') as f_in:
+                # raises KeyError if the package needs a dictionary we lack
+                dctx = decompressor(self.db_path, f_in.read(18))
+                f_in.seek(0)
+                with dctx.stream_reader(f_in) as reader:
+                    head = reader.read(len(MAGIC))
+                    if head == MAGIC:
+                        importer = self._push_pack(PackReader(reader, head), peer, progress, verifier)
+                    else:
+                        importer = self._push_tar(head, reader, peer, progress, verifier)
+            importer.finish(package_path)
+        finally:
+            if verifier is not None:
+                verifier.close()
+        summary = importer.summary()
+        SYNC_SECONDS.labels('in').observe(time.perf_counter() - started)
+        SYNC_BYTES.labels('in').inc(Path(package_path).stat().st_size)
+        for kind in ('threads', 'messages', 'deleted', 'rejected'):
+            SYNC_ROWS.labels('in', kind).inc(summary[kind])
+        return summary
+
+    def _check_signer(self, manifest, key):
+        """Reject a package signed by a key other than its node's.
+
+        When signatures are required, unsigned packages and packages from
+        a node with no key on record are rejected as well.
+        """
+        if key is None:
+            if self.require_signatures:
+                raise ValueError('package is not signed')
+            return
+        known = self.keys.key_bytes(manifest.get('node')) if self.keys and manifest.get('node') else None
+        if known is None and self.require_signatures:
+            raise ValueError(f"package is signed by unknown node {manifest.get('node')}")
+        if known is not None and known != key:
+            raise ValueError(f"package is not signed by node {manifest['node']}")
+
+    def _import_blob(self, digest, fh):
+        if self.blobs.exists(digest):
+            return
+        try:
+            self.blobs.put_compressed(digest, fh)
+        except ValueError:
+            logger.warning('Blob %s failed verification, skipping', digest)
+
+    def _push_tar(self, head, reader, peer, progress=None, verifier=None):
         base = Path(tempfile.mkdtemp())
+        try:
+            return self._import_tar(base, head, reader, peer, progress, verifier)
+        finally:
+            shutil.rmtree(base, ignore_errors=True)
+
+    def _import_tar(self, base, head, reader, peer, progress, verifier):
         tar_path = base / 'package.tar'
-        decompressor = zstd.ZstdDecompressor()
-        with open(package_path, 'rb') as f_in, open(tar_path, 'wb') as f_out:
-            f_out.write(decompressor.decompress(f_in.read()))
+        with open(tar_path, 'wb') as f_out:
+            f_out.write(head)
+            shutil.copyfileobj(reader, f_out)
         with tarfile.open(tar_path, 'r') as tar:
             tar.extractall(base)
         with open(base / 'index.json') as f:
             index = json.load(f)
+        for blob in sorted((base / 'blobs').glob('*.gz')):
+            with open(blob, 'rb') as bf:
+                self._import_blob(blob.name[:-3], bf)
+        manifest_path = base / 'manifest.json'
+        manifest = {}
+        if manifest_path.exists():
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        signature = manifest.pop('signature', None)
+        self._check_signer(manifest, bytes.fromhex(signature['key']) if signature else None)
+        leaves = [_leaf(manifest)] if signature else None
         conn = self._conn()
-        cur = conn.cursor()
-        imported_threads = 0
-        imported_msgs = 0
-        thread_updates = {}
-        for t in index:
-            try:
+        importer = _Importer(conn, manifest, peer, progress, len(index), verifier)
+        try:
+            for t in index:
+                importer.thread(t)
+                if leaves is not None:
+                    leaves.append(_leaf(t))
+                msgs_path = base / 'threads' / f"{t['id']}.json"
+                if msgs_path.exists():
+                    with open(msgs_path) as mf:
+                        for m in json.load(mf):
+                            if leaves is not None:
+                                leaves.append(_leaf(m))
+                            importer.message(m, t['id'])
+            for tomb in manifest.get('tombstones', []):
+                importer.tombstone(tomb)
+            importer.flush()
+            if signature and not verify_checkpoint(
+                load_public_key(bytes.fromhex(signature['key'])), merkle_root(leaves),
+                bytes.fromhex(signature['sig'])
+            ):
+                raise ValueError('bad package signature')
+        except Exception:
+            conn.rollback()
+            raise
+        return importer
+
+    def _push_pack(self, pack, peer, progress=None, verifier=None):
+        # records are applied as they arrive; a bad signature or a
+        # truncated stream part way through discards everything
+        conn = self._conn()
+        importer = None
+        try:
+            for kind, value in pack:
+                if kind == 'manifest':
+                    self._check_signer(value, pack.public_key)
+                    importer = _Importer(conn, value, peer, progress, verifier=verifier)
+                    continue
+                if importer is None:
+                    raise ValueError('package does not start with a manifest')
+                if kind == 'thread':
+                    importer.thread(value)
+                elif kind == 'message':
+                    importer.message(value, value['thread_id'])
+                elif kind == 'tombstone':
+                    importer.tombstone(value)
+                elif kind == 'blob':
+                    self._import_blob(*value)
+            if importer is not None:
+                importer.flush()
+        except Exception:
+            conn.rollback()
+            raise
+        if importer is None:
+            raise ValueError('empty package')
+        return importer
+
+
+class _Importer:
+    """Apply the records of one package inside a single transaction."""
+
+    def __init__(self, conn, manifest, peer, progress=None, total=None, verifier=None):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.manifest = manifest
+        self.peer = peer or manifest.get('node')
+        self.threads = 0
+        self.messages = 0
+        self.deleted = 0
+        self.rejected = 0
+        self.thread_updates = {}
+        self.progress = progress
+        self.total = total
+        self.seen = 0
+        # messages wait here so their signatures are checked in batches
+        self.verifier = verifier
+        self.pending = []
+
+    def thread(self, t):
+        self.flush()
+        conn, cur, peer = self.conn, self.cur, self.peer
+        try:
+            cur.execute(
+                "INSERT OR IGNORE INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
+                (t['id'], t['title'], t['created_at'], t['updated_at'])
+            )
+            if cur.rowcount:
+                self.threads += 1
+                log_change(conn, 'thread', t['id'], hlc=t.get('hlc'), origin=peer)
+            elif t.get('hlc'):
                 cur.execute(
-                    "INSERT OR IGNORE INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
-                    (t['id'], t['title'], t['created_at'], t['updated_at'])
+                    "UPDATE threads SET title=? WHERE id=? AND (hlc IS NULL OR hlc<?)",
+                    (t['title'], t['id'], t['hlc'])
                 )
                 if cur.rowcount:
-                    imported_threads += 1
-            except sqlite3.IntegrityError:
-                logger.warning('Thread %s already exists, skipping', t['id'])
-            msgs_path = base / 'threads' / f"{t['id']}.json"
-            if msgs_path.exists():
-                with open(msgs_path) as mf:
-                    msgs = json.load(mf)
-                max_upd = t['updated_at']
-                for m in msgs:
-                    existing = cur.execute("SELECT updated_at FROM messages WHERE id=?", (m['id'],)).fetchone()
-                    if existing:
-                        if existing['updated_at'] and existing['updated_at'] >= m.get('updated_at', m['timestamp']):
-                            continue
-                        cur.execute(
-                            "UPDATE messages SET thread_id=?, timestamp=?, updated_at=?, author=?, body=? WHERE id=?",
-                            (m['thread_id'], m['timestamp'], m.get('updated_at', m['timestamp']), m.get('author'), m['body'], m['id'])
-                        )
-                    else:
-                        cur.execute(
-                            "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
-                            (m['id'], m['thread_id'], m['timestamp'], m.get('updated_at', m['timestamp']), m.get('author'), m['body'])
-                        )
-                    imported_msgs += 1
-                    m_upd = m.get('updated_at', m['timestamp'])
-                    if m_upd > max_upd:
-                        max_upd = m_upd
-                thread_updates[t['id']] = max_upd
+                    log_change(conn, 'thread', t['id'], hlc=t['hlc'], origin=peer)
+        except sqlite3.IntegrityError:
+            logger.warning('Thread %s already exists, skipping', t['id'])
+        self.thread_updates.setdefault(t['id'], t['updated_at'])
+        self.seen += 1
+        if self.progress:
+            self.progress(self.seen, self.total)
+
+    def message(self, m, thread_id):
+        if self.verifier is None:
+            self._apply(m, thread_id)
+            return
+        self.pending.append((m, thread_id))
+        if len(self.pending) >= PARALLEL_BATCH:
+            self.flush()
+
+    def flush(self):
+        """Apply the pending messages whose signatures check out."""
+        if not self.pending:
+            return
+        # copies we already hold would be dropped anyway; verifying costs
+        # far more than the lookup, so only check what will be applied
+        cur = self.cur
+        fresh = []
+        for m, thread_id in self.pending:
+            existing = cur.execute("SELECT updated_at, hlc FROM messages WHERE id=?", (m['id'],)).fetchone()
+            if existing is None or _newer(m, existing):
+                fresh.append((m, thread_id))
+        results = self.verifier.check([m for m, _ in fresh])
+        for (m, thread_id), ok in zip(fresh, results):
+            if ok:
+                self._apply(m, thread_id)
             else:
-                thread_updates.setdefault(t['id'], t['updated_at'])
-        for tid, ts in thread_updates.items():
+                logger.warning('Message %s failed signature check, skipping', m['id'])
+                self.rejected += 1
+        self.pending = []
+
+    def _apply(self, m, thread_id):
+        conn, cur = self.conn, self.cur
+        for a in m.get('attachments', []):
+            cur.execute(
+                "INSERT OR IGNORE INTO message_attachments (message_id, sha256, name, size) VALUES (?,?,?,?)",
+                (m['id'], a['sha256'], a.get('name'), a.get('size'))
+            )
+        existing = cur.execute("SELECT updated_at, hlc FROM messages WHERE id=?", (m['id'],)).fetchone()
+        if existing:
+            if not _newer(m, existing):
+                return
+            cur.execute(
+                "UPDATE messages SET thread_id=?, timestamp=?, updated_at=?, author=?, body=?, signature=? WHERE id=?",
+                (m['thread_id'], m['timestamp'], m.get('updated_at', m['timestamp']), m.get('author'), m['body'],
+                 m.get('signature'), m['id'])
+            )
+        else:
+            cur.execute(
+                """INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body, signature)
+                VALUES (?,?,?,?,?,?,?)""",
+                (m['id'], m['thread_id'], m['timestamp'], m.get('updated_at', m['timestamp']), m.get('author'), m['body'],
+                 m.get('signature'))
+            )
+        log_change(conn, 'message', m['id'], hlc=m.get('hlc'), origin=self.peer)
+        self.messages += 1
+        m_upd = m.get('updated_at', m['timestamp'])
+        if m_upd > (self.thread_updates.get(thread_id) or ''):
+            self.thread_updates[thread_id] = m_upd
+
+    def tombstone(self, tomb):
+        self.flush()
+        table = ENTITY_TABLES.get(tomb['entity'])
+        if table is None:
+            return
+        cur = self.cur
+        # a row written after the delete (by clock order) survives it
+        cur.execute(
+            f"DELETE FROM {table} WHERE id=? AND (hlc IS NULL OR hlc<=?)",
+            (tomb['id'], tomb['hlc'] or '')
+        )
+        if cur.rowcount:
+            if table == 'messages':
+                cur.execute("DELETE FROM message_attachments WHERE message_id=?", (tomb['id'],))
+            log_change(self.conn, tomb['entity'], tomb['id'], 'delete', hlc=tomb['hlc'], origin=self.peer)
+            self.deleted += 1
+
+    def finish(self, package_path):
+        self.flush()
+        conn, cur, peer, manifest = self.conn, self.cur, self.peer, self.manifest
+        for tid, ts in self.thread_updates.items():
             cur.execute(
                 "UPDATE threads SET updated_at=? WHERE id=? AND updated_at<?",
                 (ts, tid, ts)
             )
+        if peer:
+            size = Path(package_path).stat().st_size
+            _record_package(conn, peer, 'in', package_path, manifest.get('cursor'), size)
+            conn.execute(
+                """UPDATE sync_peers SET bytes_received=bytes_received+?,
+                received_cursor=MAX(received_cursor, ?) WHERE peer_id=?""",
+                (size, manifest.get('cursor') or 0, peer)
+            )
+            # the sender piggybacks its ack of what we sent it
+            if manifest.get('ack') is not None:
+                conn.execute(
+                    "UPDATE sync_peers SET acked_cursor=MAX(acked_cursor, ?) WHERE peer_id=?",
+                    (manifest['ack'], peer)
+                )
         conn.commit()
-        conn.close()
-        logger.info('Push completed: %d threads, %d messages', imported_threads, imported_msgs)
-        return {'threads': imported_threads, 'messages': imported_msgs}
+        logger.info('Push completed: %d threads, %d messages, %d deleted, %d rejected',
+                    self.threads, self.messages, self.deleted, self.rejected)
+
+    def summary(self):
+        return {
+            'threads': self.threads,
+            'messages': self.messages,
+            'deleted': self.deleted,
+            'rejected': self.rejected,
+            'cursor': self.manifest.get('cursor'),
+            'peer': self.peer,
+        }
@@ -0,0 +1,419 @@
+"""Compact binary sync package format.
+
+A package is a header followed by length-prefixed records, written and
+read strictly front to back so neither side ever holds the whole package::
+
+    header  = b'HBSP' version:u8 flags:u8 [public key:32 if signed]
+    record  = length:varint type:u8 payload
+
+Strings that repeat (thread ids, authors) are sent once as ``STRING``
+records and then referenced by index.  Timestamps that round-trip through
+``datetime.isoformat`` travel as the varint difference in microseconds from
+the previous timestamp in the package, which is small for a thread's
+messages; anything else falls back to a string reference.
+
+When the package is signed, every record except blobs is followed by a
+``SIGNATURE`` record holding the Ed25519 signature of a running SHA-256
+chain over the header and every signed record so far, end marker
+included, so records cannot be dropped, reordered or injected without
+breaking a signature.  That matters because records refer back to
+earlier strings and timestamps.  The reader only yields a record once
+its signature has been checked.  Blobs are covered by the SHA-256
+digests the signed messages carry.
+
+Independently of that, a message may carry its author's signature (see
+:func:`keycache.sign_message`) as the last 64 bytes of its record.
+
+:class:`SyncEngine` wraps packages in a zstd frame; ``push`` tells them
+apart from tar packages by :data:`MAGIC`.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+
+MAGIC = b'HBSP'
+VERSION = 2
+FLAG_SIGNED = 0x01
+
+STRING = 0x01
+MANIFEST = 0x02
+THREAD = 0x03
+MESSAGE = 0x04
+TOMBSTONE = 0x05
+BLOB = 0x06
+SIGNATURE = 0x07
+END = 0x00
+
+ENTITIES = ('thread', 'message')
+EPOCH = datetime(1970, 1, 1)
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def _read_exact(fh, size):
+    data = fh.read(size)
+    while len(data) < size:
+        more = fh.read(size - len(data))
+        if not more:
+            raise ValueError('truncated package')
+        data += more
+    return data
+
+
+def _read_varint(fh):
+    shift = value = 0
+    while True:
+        byte = fh.read(1)
+        if not byte:
+            return None
+        value |= (byte[0] & 0x7F) << shift
+        if not byte[0] & 0x80:
+            return value
+        shift += 7
+
+
+class _Cursor:
+    """Sequential decoder over one record's payload."""
+
+    def __init__(self, data, owner):
+        self.data = data
+        self.pos = 0
+        self.owner = owner
+        self.strings = owner.strings
+
+    def varint(self):
+        shift = value = 0
+        while True:
+            if self.pos >= len(self.data):
+                raise ValueError('truncated record')
+            byte = self.data[self.pos]
+            self.pos += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+    def raw(self, size):
+        chunk = self.data[self.pos:self.pos + size]
+        if len(chunk) != size:
+            raise ValueError('truncated record')
+        self.pos += size
+        return bytes(chunk)
+
+    def text(self):
+        return self.raw(self.varint()).decode('utf-8')
+
+    def opt_text(self):
+        size = self.varint()
+        return None if size == 0 else self.raw(size - 1).decode('utf-8')
+
+    def string(self, index):
+        if not 0 < index <= len(self.strings):
+            raise ValueError(f'string reference {index} out of range')
+        return self.strings[index - 1]
+
+    def ref(self):
+        index = self.varint()
+        return None if index == 0 else self.string(index)
+
+    def time(self):
+        value = self.varint()
+        if value == 0:
+            return None
+        if value & 1:
+            return self.string(value >> 1)
+        self.owner.last_time += _unzigzag((value >> 1) - 1)
+        return (EPOCH + timedelta(microseconds=self.owner.last_time)).isoformat()
+
+
+class PackWriter:
+    """Write a package to the binary file object *fh*.
+
+    With an Ed25519 *signing_key* (a ``cryptography`` private key) every
+    record is signed.  Call :meth:`close` to write the end marker; the
+    caller owns *fh*.
+    """
+
+    def __init__(self, fh, signing_key=None):
+        self.fh = fh
+        self.signing_key = signing_key
+        self.strings = {}
+        self.last_time = 0
+        flags = FLAG_SIGNED if signing_key else 0
+        header = MAGIC + bytes([VERSION, flags])
+        if signing_key:
+            from cryptography.hazmat.primitives import serialization
+
+            header += signing_key.public_key().public_bytes(
+                serialization.Encoding.Raw, serialization.PublicFormat.Raw
+            )
+        fh.write(header)
+        self.chain = hashlib.sha256(header).digest()
+
+    def _record(self, kind, payload):
+        body = bytes([kind]) + payload
+        self.fh.write(_varint(len(body)) + body)
+        if self.signing_key:
+            self.chain = hashlib.sha256(self.chain + body).digest()
+            sig = bytes([SIGNATURE]) + self.signing_key.sign(self.chain)
+            self.fh.write(_varint(len(sig)) + sig)
+
+    def _text(self, value):
+        data = value.encode('utf-8')
+        return _varint(len(data)) + data
+
+    def _opt_text(self, value):
+        if value is None:
+            return _varint(0)
+        data = value.encode('utf-8')
+        return _varint(len(data) + 1) + data
+
+    def _intern(self, value):
+        index = self.strings.get(value)
+        if index is None:
+            self._record(STRING, self._text(value))
+            index = self.strings[value] = len(self.strings) + 1
+        return index
+
+    def _ref(self, value):
+        return _varint(0 if value is None else self._intern(value))
+
+    def _time(self, value):
+        if value is None:
+            return _varint(0)
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            parsed = None
+        if (
+            parsed is not None
+            and parsed.tzinfo is None
+            and parsed >= EPOCH
+            and parsed.isoformat() == value
+        ):
+            micros = (parsed - EPOCH) // timedelta(microseconds=1)
+            delta, self.last_time = micros - self.last_time, micros
+            return _varint((_zigzag(delta) + 1) << 1)
+        return _varint((self._intern(value) << 1) | 1)
+
+    def manifest(self, manifest):
+        """Write the package manifest (cursor, node, peer, ack)."""
+        meta = {k: v for k, v in manifest.items() if k != 'tombstones'}
+        self._record(MANIFEST, json.dumps(meta, separators=(',', ':')).encode())
+
+    def thread(self, t):
+        payload = (
+            self._ref(t['id'])
+            + self._opt_text(t.get('title'))
+            + self._time(t.get('created_at'))
+            + self._time(t.get('updated_at'))
+            + self._opt_text(t.get('hlc'))
+        )
+        self._record(THREAD, payload)
+
+    def message(self, m):
+        atts = m.get('attachments', [])
+        payload = [
+            self._text(m['id']),
+            self._ref(m['thread_id']),
+            self._time(m.get('timestamp')),
+            self._time(m.get('updated_at')),
+            self._ref(m.get('author')),
+            self._opt_text(m.get('body')),
+            self._opt_text(m.get('hlc')),
+            _varint(len(atts)),
+        ]
+        for a in atts:
+            size = a.get('size')
+            payload.append(bytes.fromhex(a['sha256']))
+            payload.append(self._opt_text(a.get('name')))
+            payload.append(_varint(0 if size is None else size + 1))
+        # the author's signature, if any, is the optional 64-byte tail
+        if m.get('signature'):
+            payload.append(bytes.fromhex(m['signature']))
+        self._record(MESSAGE, b''.join(payload))
+
+    def tombstone(self, tomb):
+        payload = (
+            bytes([ENTITIES.index(tomb['entity'])])
+            + self._text(tomb['id'])
+            + self._opt_text(tomb.get('hlc'))
+        )
+        self._record(TOMBSTONE, payload)
+
+    def blob(self, digest, fh, size):
+        """Copy *size* bytes of a compressed blob from *fh*."""
+        head = bytes([BLOB]) + bytes.fromhex(digest)
+        self.fh.write(_varint(len(head) + size) + head)
+        remaining = size
+        while remaining:
+            chunk = fh.read(min(remaining, 1 << 16))
+            if not chunk:
+                raise ValueError('blob shorter than its size')
+            self.fh.write(chunk)
+            remaining -= len(chunk)
+
+    def close(self):
+        self._record(END, b'')
+
+
+class _BlobReader:
+    """File-like view of a blob record's data inside the package stream."""
+
+    def __init__(self, fh, size):
+        self.fh = fh
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = _read_exact(self.fh, size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def drain(self):
+        while self.remaining:
+            self.read(1 << 16)
+
+
+class PackReader:
+    """Iterate the records of a package read from *fh*.
+
+    Yields ``(kind, value)`` pairs where *kind* is ``'manifest'``,
+    ``'thread'``, ``'message'``, ``'tombstone'`` or ``'blob'``; records
+    have the same shape as in the tar format, and a blob's value is
+    ``(digest, reader)`` whose reader must be consumed before the next
+    iteration.  *head* holds bytes already read from *fh* while sniffing
+    the format.  Raises ``ValueError`` on a malformed package or a bad
+    signature.
+    """
+
+    def __init__(self, fh, head=b''):
+        self.fh = fh
+        header = head + _read_exact(fh, 6 - len(head))
+        if header[:4] != MAGIC:
+            raise ValueError('not a binary sync package')
+        if header[4] != VERSION:
+            raise ValueError(f'unsupported package version {header[4]}')
+        self.signed = bool(header[5] & FLAG_SIGNED)
+        self.public_key = _read_exact(fh, 32) if self.signed else None
+        self.chain = hashlib.sha256(header + (self.public_key or b'')).digest()
+        self.strings = []
+        self.last_time = 0
+
+    def _verifier(self):
+        from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+
+        return Ed25519PublicKey.from_public_bytes(self.public_key)
+
+    def __iter__(self):
+        verifier = self._verifier() if self.signed else None
+        pending = None
+        while True:
+            size = _read_varint(self.fh)
+            if size is None:
+                raise ValueError('package ends without end marker')
+            if size == 0:
+                raise ValueError('empty record')
+            kind = _read_exact(self.fh, 1)[0]
+            if pending is not None and kind != SIGNATURE:
+                raise ValueError('unsigned record in signed package')
+            if kind == BLOB:
+                if size < 33:
+                    raise ValueError('truncated blob record')
+                digest = _read_exact(self.fh, 32).hex()
+                reader = _BlobReader(self.fh, size - 33)
+                yield 'blob', (digest, reader)
+                reader.drain()
+                continue
+            body = bytes([kind]) + _read_exact(self.fh, size - 1)
+            if kind == END and not self.signed:
+                return
+            if kind == SIGNATURE:
+                if pending is None:
+                    raise ValueError('unexpected signature record')
+                from cryptography.exceptions import InvalidSignature
+
+                self.chain = hashlib.sha256(self.chain + pending).digest()
+                try:
+                    verifier.verify(body[1:], self.chain)
+                except InvalidSignature:
+                    raise ValueError('bad record signature') from None
+                if pending[0] == END:
+                    return
+                record, pending = self._decode(pending), None
+                if record is not None:
+                    yield record
+                continue
+            if self.signed:
+                pending = body
+                continue
+            record = self._decode(body)
+            if record is not None:
+                yield record
+
+    def _decode(self, body):
+        kind = body[0]
+        cur = _Cursor(memoryview(body)[1:], self)
+        if kind == STRING:
+            self.strings.append(cur.text())
+            return None
+        if kind == MANIFEST:
+            return 'manifest', json.loads(bytes(cur.data))
+        if kind == THREAD:
+            return 'thread', {
+                'id': cur.ref(),
+                'title': cur.opt_text(),
+                'created_at': cur.time(),
+                'updated_at': cur.time(),
+                'hlc': cur.opt_text(),
+            }
+        if kind == MESSAGE:
+            m = {
+                'id': cur.text(),
+                'thread_id': cur.ref(),
+                'timestamp': cur.time(),
+                'updated_at': cur.time(),
+                'author': cur.ref(),
+                'body': cur.opt_text(),
+                'hlc': cur.opt_text(),
+            }
+            atts = []
+            for _ in range(cur.varint()):
+                sha = cur.raw(32).hex()
+                name = cur.opt_text()
+                size = cur.varint()
+                atts.append({'sha256': sha, 'name': name, 'size': size - 1 if size else None})
+            if atts:
+                m['attachments'] = atts
+            if cur.pos < len(cur.data):
+                m['signature'] = cur.raw(64).hex()
+            return 'message', m
+        if kind == TOMBSTONE:
+            entity = cur.raw(1)[0]
+            if entity >= len(ENTITIES):
+                raise ValueError(f'unknown tombstone entity {entity}')
+            return 'tombstone', {
+                'entity': ENTITIES[entity],
+                'id': cur.text(),
+                'hlc': cur.opt_text(),
+            }
+        raise ValueError(f'unknown record type {kind}')
@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+
+def pytest_configure(config):
+    # the sync logger opens its file when sync is first imported
+    os.environ.setdefault(
+        "HAMBBS_SYNC_LOG", os.path.join(tempfile.mkdtemp(prefix="hambbs-"), "sync.log")
+    )
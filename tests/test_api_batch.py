@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+from db import get_conn
+from openbbs import create_app, db
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    app = create_app({"DB_PATH": str(tmp_path / "test.db"), "TESTING": True,
+                      "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")})
+    with app.app_context():
+        db.create_all()
+        yield app.test_client()
+
+
+def count(client, table):
+    conn = get_conn(client.application.config["DB_PATH"])
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_batch_is_idempotent(client):
+    payload = {
+        "threads": [{"id": "t1", "title": "Net"}, {"id": "t2"}],
+        "messages": [
+            {"id": "m1", "thread_id": "t1", "author": "W1AW", "body": "QST"},
+            {"id": "m2", "thread_id": "t1", "author": "K1ABC", "body": "QSL"},
+            {"id": "m3", "thread_id": "nope", "body": "lost"},
+        ],
+    }
+    first = client.post("/api/batch", json=payload).get_json()
+    assert [r["status"] for r in first["threads"]] == ["created", "error"]
+    assert [r["status"] for r in first["messages"]] == ["created", "created", "error"]
+    assert first["messages"][2] == {"id": "m3", "status": "error", "error": "unknown thread"}
+
+    # a replayed outbox changes nothing
+    changes = count(client, "changes")
+    again = client.post("/api/batch", json=payload).get_json()
+    assert [r["status"] for r in again["messages"]] == ["exists", "exists", "error"]
+    assert count(client, "changes") == changes and count(client, "messages") == 2
+
+    # so does a single post with a known id
+    assert client.post("/api/threads/t1/messages", json={"id": "m1", "body": "dup"}).get_json() == {"id": "m1"}
+    assert count(client, "messages") == 2
+
+
+def test_batch_size_limit(client, monkeypatch):
+    monkeypatch.setattr("openbbs.api.MAX_BATCH", 2)
+    resp = client.post("/api/batch", json={"threads": [{"title": str(i)} for i in range(3)]})
+    assert resp.status_code == 413 and count(client, "threads") == 0
+
+
+def test_ndjson_export(client):
+    client.post("/api/batch", json={
+        "threads": [{"id": "t1", "title": "Net"}],
+        "messages": [{"id": f"m{i}", "thread_id": "t1", "body": str(i)} for i in range(3)],
+    })
+    resp = client.get("/api/export")
+    assert resp.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in resp.data.decode().splitlines()]
+    meta = lines[0]
+    assert meta["type"] == "meta" and meta["since"] is None
+    assert [r["type"] for r in lines[1:]] == ["thread", "message", "message", "message"]
+
+    client.post("/api/threads/t1/messages", json={"id": "m9", "body": "late"})
+    delta = client.get(f"/api/export?since={meta['seq']}").data.decode().splitlines()
+    assert [json.loads(line).get("id") for line in delta[1:]] == ["t1", "m9"]
+
+
+def test_message_signatures_verified(client, tmp_path):
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+    from keycache import KeyCache, sign_message
+
+    author = Ed25519PrivateKey.generate()
+    KeyCache(tmp_path / "keys.db").update("W1AW", 1, author.public_key())
+    client.application.config["SYNC_KEYS_PATH"] = str(tmp_path / "keys.db")
+    client.post("/api/threads", json={"id": "t1", "title": "Net"})
+    old = "2020-01-01T00:00:00"
+
+    def message(mid, call, key=author, body="QST"):
+        m = {"id": mid, "thread_id": "t1", "timestamp": old, "author": call, "body": body}
+        return dict(m, signature=sign_message(key, m))
+
+    assert client.post("/api/threads/t1/messages", json=message("m1", "W1AW")).status_code == 200
+    forged = dict(message("m2", "W1AW"), body="backdated")
+    resp = client.post("/api/threads/t1/messages", json=forged)
+    assert resp.status_code == 400 and resp.get_json() == {"error": "bad signature"}
+    other = message("m3", "W1AW", key=Ed25519PrivateKey.generate())
+    batch = client.post("/api/batch", json={"messages": [other]}).get_json()
+    assert batch["messages"] == [{"id": "m3", "status": "error", "error": "bad signature"}]
+    # no key on record: the signature is dropped and the timestamp not trusted
+    client.post("/api/threads/t1/messages", json=message("m4", "K1ABC"))
+    rows = {r["id"]: r for r in get_conn(client.application.config["DB_PATH"]).execute(
+        "SELECT id, timestamp, signature FROM messages")}
+    assert set(rows) == {"m1", "m4"}
+    assert rows["m1"]["timestamp"] == old and rows["m1"]["signature"]
+    assert rows["m4"]["timestamp"] > old and rows["m4"]["signature"] is None
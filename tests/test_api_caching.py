@@ -0,0 +1,63 @@
+import gzip
+import json
+
+import pytest
+import zstandard
+
+from openbbs import create_app, db
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    app = create_app({"DB_PATH": str(tmp_path / "test.db"), "TESTING": True,
+                      "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")})
+    with app.app_context():
+        db.create_all()
+        yield app.test_client()
+
+
+def new_thread(client, title, body):
+    tid = client.post("/api/threads", json={"title": title}).get_json()["id"]
+    client.post(f"/api/threads/{tid}/messages", json={"author": "W1AW", "body": body})
+    return tid
+
+
+def test_conditional_get(client):
+    tid = new_thread(client, "Net", "QST")
+    first = client.get("/api/threads")
+    assert first.status_code == 200 and "Accept-Encoding" in first.headers["Vary"]
+    again = client.get("/api/threads", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304 and again.data == b""
+    detail = client.get(f"/api/threads/{tid}")
+    assert client.get(f"/api/threads/{tid}", headers={"If-None-Match": detail.headers["ETag"]}).status_code == 304
+
+    # any write moves the tag on
+    new_thread(client, "Swap", "for sale")
+    assert client.get("/api/threads", headers={"If-None-Match": first.headers["ETag"]}).status_code == 200
+
+
+def test_since_returns_delta(client):
+    tid = new_thread(client, "Net", "first")
+    seq = client.get(f"/api/threads/{tid}").get_json()["seq"]
+    client.post(f"/api/threads/{tid}/messages", json={"author": "K1ABC", "body": "second"})
+    new_thread(client, "Other", "elsewhere")
+    delta = client.get(f"/api/threads/{tid}?since={seq}").get_json()
+    assert [m["body"] for m in delta["messages"]] == ["second"]
+    assert delta["deleted"] == [] and delta["seq"] > seq
+    assert client.get(f"/api/threads/{tid}?since={delta['seq']}").get_json()["messages"] == []
+
+
+@pytest.mark.parametrize("coding", ["gzip", "zstd"])
+def test_compressed_responses(client, coding):
+    tid = new_thread(client, "Net", "73 " * 400)
+    resp = client.get(f"/api/threads/{tid}", headers={"Accept-Encoding": coding})
+    assert resp.headers["Content-Encoding"] == coding
+    assert resp.headers["ETag"].endswith(f'-{coding}"')
+    if coding == "gzip":
+        body = gzip.decompress(resp.data)
+    else:
+        body = zstandard.ZstdDecompressor().decompress(resp.data)
+    assert json.loads(body)["messages"][0]["body"] == "73 " * 400
+    # small bodies are not worth compressing
+    assert "Content-Encoding" not in client.get("/api/threads", headers={"Accept-Encoding": coding}).headers
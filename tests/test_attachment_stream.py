@@ -0,0 +1,154 @@
+import gzip
+import io
+import os
+
+from openbbs import create_app, db
+from openbbs.models import User, Forum, Attachment, Post
+from openbbs.views import generate_action_token
+import openbbs.attachments as attachments
+import pytest
+
+
+@pytest.fixture
+def app_ctx(tmp_path):
+    app = create_app(
+        {
+            "DB_PATH": str(tmp_path / "test.db"),
+            "TESTING": True,
+            "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key"),
+            "UPLOAD_FOLDER": str(tmp_path / "uploads"),
+        }
+    )
+    with app.app_context():
+        db.create_all()
+        yield app
+
+
+@pytest.fixture
+def client(app_ctx):
+    return app_ctx.test_client()
+
+
+def login(client, username):
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(User.query.filter_by(username=username).first().id)
+
+
+@pytest.fixture
+def attachment(app_ctx, client):
+    user = User(username="alice", password="pw")
+    forum = Forum(name="f1")
+    db.session.add_all([user, forum])
+    db.session.commit()
+    login(client, "alice")
+    data = bytes(range(256)) * 1000
+    resp = client.post(
+        "/post",
+        data={
+            "title": "t",
+            "body": "b",
+            "forum_id": forum.id,
+            "attachment": (io.BytesIO(data), "plan.bin"),
+        },
+        content_type="multipart/form-data",
+    )
+    assert resp.status_code == 302
+    return Attachment.query.first(), data
+
+
+def test_upload_is_stored_compressed(attachment):
+    att, data = attachment
+    with open(att.filename, "rb") as f:
+        assert gzip.decompress(f.read()) == data
+
+
+def test_gzip_client_gets_stored_bytes(client, attachment):
+    att, data = attachment
+    resp = client.get(f"/attachment/{att.id}", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(resp.data) == data
+
+
+def test_identity_client_gets_decompressed_stream(client, attachment):
+    att, data = attachment
+    resp = client.get(f"/attachment/{att.id}", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in resp.headers
+    assert resp.data == data
+    etag = resp.headers["ETag"]
+    again = client.get(
+        f"/attachment/{att.id}",
+        headers={"Accept-Encoding": "identity", "If-None-Match": etag},
+    )
+    assert again.status_code == 304
+
+
+def test_range_request_on_decompressed_stream(client, attachment):
+    att, data = attachment
+    resp = client.get(
+        f"/attachment/{att.id}",
+        headers={"Accept-Encoding": "identity", "Range": "bytes=1000-1999"},
+    )
+    assert resp.status_code == 206
+    assert resp.data == data[1000:2000]
+    assert resp.headers["Content-Range"] == f"bytes 1000-1999/{len(data)}"
+
+
+def test_identical_uploads_share_one_blob(app_ctx, client, attachment):
+    att, data = attachment
+    forum = Forum.query.first()
+    client.post(
+        "/post",
+        data={
+            "title": "t2",
+            "body": "b",
+            "forum_id": forum.id,
+            "attachment": (io.BytesIO(data), "copy.bin"),
+        },
+        content_type="multipart/form-data",
+    )
+    first, second = Attachment.query.order_by(Attachment.id).all()
+    assert first.sha256 == second.sha256
+    assert first.filename == second.filename
+    blob = first.filename
+    os.utime(blob, (0, 0))
+
+    user = User.query.filter_by(username="alice").first()
+    user.is_moderator = True
+    db.session.commit()
+    for att_row in (first, second):
+        post_id = att_row.post_id
+        token = generate_action_token(post_id, user.id)
+        client.post(f"/post/{post_id}/delete", data={"token": token})
+        attachments.unlink_later(["/nonexistent"]).result(timeout=5)
+        if Attachment.query.count():
+            assert os.path.exists(blob)
+    assert not os.path.exists(blob)
+    assert Post.query.count() == 0
+
+
+def test_synced_reference_keeps_blob_until_gc(app_ctx, client, attachment):
+    from sqlalchemy import text
+
+    att, _ = attachment
+    blob = att.filename
+    db.session.execute(
+        text("INSERT INTO message_attachments (message_id, sha256, name, size) VALUES ('m1', :d, 'plan.bin', 1)"),
+        {"d": att.sha256},
+    )
+    user = User.query.filter_by(username="alice").first()
+    user.is_moderator = True
+    db.session.commit()
+    os.utime(blob, (0, 0))
+    client.post(f"/post/{att.post_id}/delete", data={"token": generate_action_token(att.post_id, user.id)})
+    attachments.unlink_later(["/nonexistent"]).result(timeout=5)
+    assert os.path.exists(blob)
+
+    runner = app_ctx.test_cli_runner()
+    assert "removed 0 blobs" in runner.invoke(args=["attachments", "gc"]).output
+    db.session.execute(text("DELETE FROM message_attachments"))
+    db.session.commit()
+    # a blob still inside the delete grace period is swept later
+    os.utime(blob)
+    assert "removed 0 blobs" in runner.invoke(args=["attachments", "gc"]).output
+    assert "removed 1 blobs" in runner.invoke(args=["attachments", "gc", "--grace", "0"]).output
+    assert not os.path.exists(blob)
@@ -0,0 +1,84 @@
+import io
+import os
+import tarfile
+import tempfile
+from pathlib import Path
+
+import pytest
+import zstandard as zstd
+
+from blobstore import BlobStore
+from db import init_db, connect
+from sync import SyncEngine
+
+
+def test_put_deduplicates(tmp_path):
+    store = BlobStore(tmp_path)
+    d1, size = store.put(io.BytesIO(b"band plan" * 100))
+    d2, _ = store.put(io.BytesIO(b"band plan" * 100))
+    assert d1 == d2 and size == 900
+    assert store.path(d1).parent.parent.parent == tmp_path
+    assert len(list(tmp_path.glob("??/??/*.gz"))) == 1
+    with store.open(d1) as f:
+        assert f.read() == b"band plan" * 100
+
+
+def test_put_compressed_verifies_digest(tmp_path):
+    src = BlobStore(tmp_path / "a")
+    dst = BlobStore(tmp_path / "b")
+    digest, _ = src.put(io.BytesIO(b"firmware"))
+    with open(src.path(digest), "rb") as f:
+        with pytest.raises(ValueError):
+            dst.put_compressed("0" * 64, f)
+    with open(src.path(digest), "rb") as f:
+        assert dst.put_compressed(digest, f) == len(b"firmware")
+    assert dst.exists(digest)
+
+
+def test_delete_respects_grace(tmp_path):
+    store = BlobStore(tmp_path)
+    digest, _ = store.put(io.BytesIO(b"x"))
+    assert not store.delete(digest)
+    os.utime(store.path(digest), (0, 0))
+    assert store.delete(digest)
+    assert not store.exists(digest)
+
+
+def _engine(tmp_path, name):
+    db_fd, db_path = tempfile.mkstemp()
+    os.close(db_fd)
+    init_db(db_path)
+    return db_path, SyncEngine(db_path, blob_root=tmp_path / name)
+
+
+def test_sync_ships_each_blob_once(tmp_path):
+    src_db, src = _engine(tmp_path, "src")
+    digest, size = src.blobs.put(io.BytesIO(b"bulletin" * 50))
+    conn = connect(src_db)
+    conn.execute("INSERT INTO threads (id, title, created_at, updated_at) VALUES ('t1','T','2023','2023')")
+    for mid in ("m1", "m2"):
+        conn.execute(
+            "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+            (mid, "t1", "2023", "2023", "a", "see attached"),
+        )
+        conn.execute(
+            "INSERT INTO message_attachments (message_id, sha256, name, size) VALUES (?,?,?,?)",
+            (mid, digest, "bulletin.txt", size),
+        )
+    conn.commit()
+    pkg = tmp_path / "pkg.tar.zst"
+    src.pull(output_path=str(pkg))
+    tar_bytes = zstd.ZstdDecompressor().decompress(pkg.read_bytes())
+    with tarfile.open(fileobj=io.BytesIO(tar_bytes)) as tar:
+        names = [n for n in tar.getnames() if n.startswith("blobs/")]
+    assert names == [f"blobs/{digest}.gz"]
+
+    dst_db, dst = _engine(tmp_path, "dst")
+    dst.push(str(pkg))
+    assert dst.blobs.exists(digest)
+    rows = connect(dst_db).execute("SELECT message_id FROM message_attachments").fetchall()
+    assert sorted(r["message_id"] for r in rows) == ["m1", "m2"]
+
+    lean = tmp_path / "lean.tar.zst"
+    src.pull(output_path=str(lean), known_blobs=[digest])
+    assert lean.stat().st_size < pkg.stat().st_size
@@ -0,0 +1,117 @@
+import json
+import tarfile
+
+import pytest
+import zstandard as zstd
+
+from db import connect
+from openbbs import create_app, db
+from openbbs.models import User, Forum, Post
+from openbbs.views import generate_action_token
+from sync import SyncEngine
+
+
+@pytest.fixture
+def app_ctx(tmp_path):
+    app = create_app({"DB_PATH": str(tmp_path / "test.db"), "TESTING": True,
+                      "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")})
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def client(app_ctx):
+    return app_ctx.test_client()
+
+
+def login(client, user):
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(user.id)
+
+
+def raw(app):
+    return connect(app.config["DB_PATH"])
+
+
+def last_seq(app):
+    return raw(app).execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+
+def read_package(path):
+    data = zstd.ZstdDecompressor().decompress(open(path, "rb").read(), max_output_size=1 << 24)
+    out = path + ".tar"
+    open(out, "wb").write(data)
+    with tarfile.open(out) as tar:
+        index = json.load(tar.extractfile("index.json"))
+        msgs = {
+            t["id"]: json.load(tar.extractfile(f"threads/{t['id']}.json")) for t in index
+        }
+    return index, msgs
+
+
+def setup_thread():
+    user = User(username="alice", password="pw", is_moderator=True)
+    forum = Forum(name="f1")
+    db.session.add_all([user, forum])
+    db.session.commit()
+    root = Post(title="root", body="hello", author=user, forum=forum)
+    db.session.add(root)
+    db.session.flush()
+    reply = Post(title="re", body="reply", author=user, forum=forum, parent_id=root.id)
+    db.session.add(reply)
+    db.session.commit()
+    return user, forum, root, reply
+
+
+def test_web_posts_are_mirrored(app_ctx):
+    _, _, root, reply = setup_thread()
+    conn = raw(app_ctx)
+    thread = conn.execute("SELECT * FROM threads WHERE id=?", (root.uid,)).fetchone()
+    assert thread["title"] == "root"
+    msgs = conn.execute(
+        "SELECT id, author, body FROM messages WHERE thread_id=? ORDER BY timestamp", (root.uid,)
+    ).fetchall()
+    assert [(m["id"], m["author"], m["body"]) for m in msgs] == [
+        (root.uid, "alice", "hello"),
+        (reply.uid, "alice", "reply"),
+    ]
+
+
+def test_rolled_back_post_leaves_no_change(app_ctx):
+    user, forum, _, _ = setup_thread()
+    before = last_seq(app_ctx)
+    db.session.add(Post(title="x", body="y", author=user, forum=forum))
+    db.session.flush()
+    db.session.rollback()
+    assert last_seq(app_ctx) == before
+
+
+def test_edit_and_delete_are_captured(app_ctx, client):
+    user, _, root, reply = setup_thread()
+    login(client, user)
+    cursor = last_seq(app_ctx)
+    token = generate_action_token(reply.id, user.id)
+    client.post(f"/post/{reply.id}/edit", data={"title": "re", "body": "edited", "token": token})
+    assert raw(app_ctx).execute(
+        "SELECT body FROM messages WHERE id=?", (reply.uid,)
+    ).fetchone()["body"] == "edited"
+    client.post(f"/post/{reply.id}/delete", data={"token": token})
+    assert raw(app_ctx).execute("SELECT * FROM messages WHERE id=?", (reply.uid,)).fetchone() is None
+    ops = raw(app_ctx).execute(
+        "SELECT entity, op FROM changes WHERE entity_id=? AND seq>? ORDER BY seq", (reply.uid, cursor)
+    ).fetchall()
+    assert [tuple(r) for r in ops][-1] == ("message", "delete")
+
+
+def test_pull_with_cursor_exports_only_new_changes(app_ctx, tmp_path):
+    user, forum, root, _ = setup_thread()
+    cursor = last_seq(app_ctx)
+    other = Post(title="other", body="new", author=user, forum=forum)
+    db.session.add(other)
+    db.session.commit()
+    engine = SyncEngine(app_ctx.config["DB_PATH"], blob_root=tmp_path / "blobs")
+    pkg = str(tmp_path / "delta.tar.zst")
+    engine.pull(cursor=cursor, output_path=pkg)
+    index, msgs = read_package(pkg)
+    assert [t["id"] for t in index] == [other.uid]
+    assert [m["body"] for m in msgs[other.uid]] == ["new"]
@@ -0,0 +1,100 @@
+from openbbs import create_app, db
+from openbbs.counters import reconcile_counters, verify_counters
+from openbbs.models import User, Forum, Post
+from openbbs.views import generate_action_token
+import pytest
+from flask import g
+
+
+@pytest.fixture
+def app_ctx(tmp_path):
+    app = create_app({"DB_PATH": str(tmp_path / "test.db"), "TESTING": True,
+                      "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")})
+    with app.app_context():
+        db.create_all()
+        yield app
+
+
+@pytest.fixture
+def client(app_ctx):
+    return app_ctx.test_client()
+
+
+def create_user(username, is_mod=False):
+    user = User(username=username, password="pw", is_moderator=is_mod)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def login(client, username):
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(User.query.filter_by(username=username).first().id)
+    # requests share the test's app context, where flask-login caches the user
+    g.pop("_login_user", None)
+
+
+def counts(obj):
+    db.session.refresh(obj)
+    return obj.thread_count, obj.reply_count
+
+
+def post(client, forum, title, parent=None):
+    data = {"title": title, "body": "b", "forum_id": forum.id}
+    if parent:
+        data["parent_id"] = parent
+    client.post("/post", data=data)
+    return Post.query.filter_by(title=title).one().id
+
+
+def test_counters_follow_posts(app_ctx, client):
+    mod = create_user("mod", is_mod=True)
+    alice = create_user("alice")
+    f1, f2 = Forum(name="f1"), Forum(name="f2")
+    db.session.add_all([f1, f2])
+    db.session.commit()
+    login(client, "alice")
+    root = post(client, f1, "root")
+    reply = post(client, f1, "reply", parent=root)
+    post(client, f1, "nested", parent=reply)
+    other = post(client, f1, "other")
+    assert counts(f1) == (2, 2) and counts(alice) == (2, 2)
+    assert f1.last_post_id == other and f1.last_post_at == alice.last_post_at
+
+    # alice deletes her reply and its subtree; the mod brings back the reply
+    client.post(f"/post/{reply}/delete", data={"token": generate_action_token(reply, alice.id)})
+    assert counts(f1) == (2, 0)
+    login(client, "mod")
+    client.post(f"/post/{reply}/restore", data={"token": generate_action_token(reply, mod.id)})
+    assert counts(f1) == (2, 1)
+
+    client.post(f"/post/{root}/move", data={"forum_id": f2.id, "token": generate_action_token(root, mod.id)})
+    assert counts(f1) == (1, 0) and counts(f2) == (1, 1)
+    assert f1.last_post_id == other
+
+    client.post(f"/post/{reply}/split", data={"forum_id": f2.id, "token": generate_action_token(reply, mod.id)})
+    assert counts(f2) == (2, 0) and counts(alice) == (3, 0)
+
+    client.post(f"/post/{other}/delete", data={"token": generate_action_token(other, mod.id)})
+    assert counts(f1) == (0, 0) and f1.last_post_id is None
+    assert verify_counters() == []
+
+
+def test_reconcile_repairs_drift(app_ctx, client):
+    alice = create_user("alice")
+    forum = Forum(name="f1")
+    db.session.add(forum)
+    db.session.commit()
+    login(client, "alice")
+    root = post(client, forum, "root")
+    post(client, forum, "reply", parent=root)
+    forum.thread_count = 7
+    alice.last_post_at = None
+    db.session.commit()
+    assert sorted(verify_counters()) == [f"forum {forum.id}", f"user {alice.id}"]
+    assert reconcile_counters() == 2
+    assert counts(forum) == (1, 1) and alice.last_post_at is not None
+    assert verify_counters() == []
+
+    resp = client.get("/")
+    assert b"1 threads" in resp.data and b"Last post: reply by alice" in resp.data
@@ -0,0 +1,43 @@
+import threading
+
+import db
+from db import get_conn, get_pool, ensure_schema
+
+
+def test_connection_is_reused_per_thread(tmp_path):
+    path = tmp_path / "pool.db"
+    conn = get_conn(path)
+    assert get_conn(path) is conn
+    other = []
+    t = threading.Thread(target=lambda: other.append(get_conn(path)))
+    t.start()
+    t.join()
+    assert other[0] is not conn
+
+
+def test_pragmas_applied(tmp_path):
+    conn = get_conn(tmp_path / "pragma.db")
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+    assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+    tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master")}
+    assert {"threads", "messages", "outbox", "sync_log"} <= tables
+
+
+def test_schema_initialized_once(tmp_path, monkeypatch):
+    calls = []
+    real = db.init_db
+    monkeypatch.setattr(db, "init_db", lambda p: (calls.append(p), real(p)))
+    path = tmp_path / "once.db"
+    for _ in range(3):
+        ensure_schema(path)
+        get_conn(path)
+    assert len(calls) == 1
+
+
+def test_release_rolls_back_open_transaction(tmp_path):
+    path = tmp_path / "release.db"
+    conn = get_conn(path)
+    conn.execute("INSERT INTO threads (id, title) VALUES ('t', 'x')")
+    get_pool(path).release()
+    assert conn.execute("SELECT COUNT(*) FROM threads").fetchone()[0] == 0
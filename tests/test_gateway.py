@@ -0,0 +1,122 @@
+import time
+
+import pytest
+
+from db import connect, init_db, log_change, node_id
+from gateway import Gateway, split_kiss
+from radio import SimulatedVaraHF, kiss_encode
+from sync import SyncEngine
+
+
+class LossyVaraHF(SimulatedVaraHF):
+    """Drops every *nth* transmission."""
+
+    def __init__(self, nth):
+        super().__init__()
+        self.nth = nth
+        self.count = 0
+
+    def send(self, data):
+        self.count += 1
+        if self.count % self.nth:
+            super().send(data)
+
+
+def make_node(tmp_path, name, messages):
+    db_path = str(tmp_path / f"{name}.db")
+    init_db(db_path)
+    conn = connect(db_path)
+    conn.execute(
+        "INSERT INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
+        (f"t-{name}", f"Net {name}", "2024-03-01T00:00:00", "2024-03-01T00:00:00"),
+    )
+    log_change(conn, "thread", f"t-{name}")
+    for i in range(messages):
+        conn.execute(
+            "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+            (f"{name}{i}", f"t-{name}", f"2024-03-01T00:{i // 60:02d}:{i % 60:02d}",
+             f"2024-03-01T00:{i // 60:02d}:{i % 60:02d}", "W1AW", f"{name} report {i} " * 5),
+        )
+        log_change(conn, "message", f"{name}{i}")
+    conn.commit()
+    return SyncEngine(db_path, blob_root=tmp_path / f"{name}-blobs"), node_id(conn)
+
+
+def message_ids(engine):
+    return {r[0] for r in connect(engine.db_path).execute("SELECT id FROM messages")}
+
+
+def wait_for(condition, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.mark.parametrize("drop", [None, 9])
+def test_loopback_exchange(tmp_path, drop):
+    a, a_id = make_node(tmp_path, "a", 120)
+    b, b_id = make_node(tmp_path, "b", 40)
+    radio_a = LossyVaraHF(drop) if drop else SimulatedVaraHF()
+    radio_b = SimulatedVaraHF()
+    radio_a.connect(radio_b)
+    gw_a = Gateway(a, radio_a, tmp_path / "gw-a", peer=b_id, interval=0.05, retry=0.5)
+    # b learns its peer from the first package it receives
+    gw_b = Gateway(b, radio_b, tmp_path / "gw-b", interval=0.05, retry=0.5)
+    gw_a.start()
+    gw_b.start()
+    try:
+        everything = message_ids(a) | message_ids(b)
+        assert wait_for(lambda: message_ids(a) == everything == message_ids(b))
+        assert wait_for(lambda: gw_a.idle() and gw_b.idle())
+    finally:
+        gw_a.stop()
+        gw_b.stop()
+    assert gw_b.peer == a_id
+    assert gw_a.stats["packages_out"] == gw_b.stats["packages_in"] == 1
+    assert gw_b.stats["messages_in"] == 120 and gw_a.stats["messages_in"] == 40
+    if drop:
+        assert gw_b.stats["frames_in"] < gw_a.stats["frames_out"]
+    # both sides acknowledged what they sent, so nothing is sent again
+    assert a.peer_state(b_id)["acked_cursor"] and b.peer_state(a_id)["acked_cursor"]
+
+
+def test_failed_import_is_not_acknowledged(tmp_path, monkeypatch):
+    a, a_id = make_node(tmp_path, "a", 30)
+    b, b_id = make_node(tmp_path, "b", 0)
+    radio_a, radio_b = SimulatedVaraHF(), SimulatedVaraHF()
+    radio_a.connect(radio_b)
+    push = b.push
+    acked_seen = []
+
+    def flaky_push(path, *args, **kwargs):
+        acked_seen.append(a.peer_state(b_id)["acked_cursor"])
+        if len(acked_seen) == 1:
+            raise RuntimeError("database is locked")
+        return push(path, *args, **kwargs)
+
+    monkeypatch.setattr(b, "push", flaky_push)
+    gw_a = Gateway(a, radio_a, tmp_path / "gw-a", peer=b_id, interval=0.05, retry=0.3)
+    gw_b = Gateway(b, radio_b, tmp_path / "gw-b", peer=a_id, interval=0.05, retry=0.3)
+    gw_a.start()
+    gw_b.start()
+    try:
+        assert wait_for(lambda: message_ids(a) == message_ids(b))
+        assert wait_for(lambda: gw_a.idle() and gw_b.idle())
+    finally:
+        gw_a.stop()
+        gw_b.stop()
+    # the package was held in full but not acknowledged until it was imported
+    assert acked_seen == [0, 0]
+    assert a.peer_state(b_id)["acked_cursor"]
+    assert gw_a.stats["packages_out"] == gw_b.stats["packages_in"] == 1
+
+
+def test_split_kiss_keeps_partial_frames():
+    one, two = kiss_encode(b"one"), kiss_encode(b"two")
+    buffer = bytearray(b"noise" + one + two[:3])
+    assert split_kiss(buffer) == [one]
+    buffer += two[3:]
+    assert split_kiss(buffer) == [two] and buffer == b""
@@ -1,3 +1,4 @@
+import json
 from pathlib import Path
 from keycache import KeyCache, sign_checkpoint, verify_checkpoint
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
@@ -22,3 +23,55 @@ def test_checkpoint_sign_verify():
     sig = sign_checkpoint(priv, data)
     assert verify_checkpoint(pub, data, sig)
     assert not verify_checkpoint(pub, data + b"x", sig)
+
+
+def test_keycache_history_and_reopen(tmp_path: Path):
+    kc = KeyCache(tmp_path / "keys.db")
+    first, second = Ed25519PrivateKey.generate(), Ed25519PrivateKey.generate()
+    kc.update("alice", 1, first.public_key())
+    kc.update("alice", 2, second.public_key())
+    reopened = KeyCache(tmp_path / "keys.db")
+    assert reopened.get("alice").public_bytes_raw() == second.public_key().public_bytes_raw()
+    assert reopened.get("alice", version=1).public_bytes_raw() == first.public_key().public_bytes_raw()
+    assert [k["version"] for k in reopened.history("alice")] == [1, 2]
+    assert reopened.get("bob") is None
+
+
+def test_keycache_migrates_legacy_json(tmp_path: Path):
+    pub = Ed25519PrivateKey.generate().public_key()
+    legacy = tmp_path / "keys.json"
+    legacy.write_text(json.dumps({"alice": {"version": 3, "key": pub.public_bytes_raw().hex()}}))
+    kc = KeyCache(legacy)
+    assert kc.path == tmp_path / "keys.db"
+    assert kc.version("alice") == 3
+    assert not legacy.exists() and (tmp_path / "keys.json.bak").exists()
+    # the old path keeps working once migrated
+    assert KeyCache(legacy).key_bytes("alice") == pub.public_bytes_raw()
+
+
+def test_keycache_bulk_import(tmp_path: Path):
+    keys = [Ed25519PrivateKey.generate().public_key().public_bytes_raw().hex() for _ in range(3)]
+    dump = tmp_path / "directory.txt"
+    dump.write_text(f"# national directory\nW1AW 2 {keys[1]}\nW1AW,1,{keys[0]}\nK1ABC 1 {keys[2]}\n")
+    kc = KeyCache(tmp_path / "keys.db")
+    assert kc.import_file(dump) == 3
+    assert kc.import_file(dump) == 0
+    assert kc.key_bytes("W1AW").hex() == keys[1]
+    assert len(kc.history("W1AW")) == 2
+
+
+def test_keycache_remembers_misses_within_bound(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr("keycache.KEY_CACHE_SIZE", 2)
+    kc = KeyCache(tmp_path / "keys.db")
+    queries = []
+    kc._conn.set_trace_callback(queries.append)
+    assert kc.key_bytes("bob") is None
+    assert kc.key_bytes("bob") is None
+    assert len(queries) == 1
+    # a new key replaces the remembered miss
+    pub = Ed25519PrivateKey.generate().public_key()
+    kc.update("bob", 1, pub)
+    assert kc.key_bytes("bob") == pub.public_bytes_raw()
+    for user in ("carol", "dave", "erin"):
+        kc.key_bytes(user)
+    assert list(kc._raw) == ["dave", "erin"]
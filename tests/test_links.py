@@ -0,0 +1,116 @@
+from collections import deque
+
+import pytest
+
+from links import LinkManager
+from radio import opportunistic_relay
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def sink(log, fail=False):
+    def send(frame):
+        if fail:
+            raise IOError("no ack")
+        log.append(frame)
+
+    return send
+
+
+def test_routes_to_best_link_and_relays():
+    clock = Clock()
+    direct, relay = [], []
+    manager = LinkManager(clock=clock)
+    manager.add_link("hf", sink(direct), "bbs", path=1.0)
+    manager.add_link("vhf", sink(relay), "N0CALL", path=0.9)
+    manager.observe("hf", snr=-8, rtt=12)
+    manager.observe("vhf", snr=15, rtt=1)
+    for i in range(3):
+        manager.queue(b"frame %d" % i)
+    assert manager.flush() == 3
+    assert relay == [b"frame 0", b"frame 1", b"frame 2"] and not direct
+    # the relay degrades: losses pull its average below the direct link
+    for _ in range(10):
+        manager.observe("vhf", lost=True)
+    manager.queue(b"late")
+    manager.flush()
+    assert direct == [b"late"]
+    clock.now = 10.0
+    report = manager.report()
+    assert report["routed"] == {"relay": 3, "direct": 1}
+    assert report["links"]["vhf"]["frames"] == 3 and report["links"]["vhf"]["loss"] > 0.8
+    assert [d["link"] for d in report["decisions"]] == ["vhf"] * 3 + ["hf"]
+
+
+def test_failed_link_falls_back_and_holds_in_order():
+    good = []
+    manager = LinkManager()
+    manager.add_link("hf", sink([], fail=True), "bbs", path=1.0)
+    manager.add_link("vhf", sink(good), "N0CALL", path=0.5)
+    manager.queue(b"b", priority=5)
+    manager.queue(b"a", priority=1)
+    assert manager.flush() == 2 and good == [b"a", b"b"]
+    assert manager.links["hf"].failures == 1
+    # with no route left, frames wait for the next flush
+    manager.set_path("N0CALL", 0.0)
+    for frame in (b"x", b"y", b"z"):
+        manager.queue(frame)
+    assert manager.flush() == 0 and len(manager) == 3
+    manager.set_path("N0CALL", 0.5)
+    manager.flush()
+    assert good[2:] == [b"x", b"y", b"z"] and len(manager) == 0
+
+
+def test_held_link_recovers():
+    clock = Clock()
+    sent, down = [], [True]
+
+    def send(frame):
+        if down[0]:
+            raise IOError("no ack")
+        sent.append(frame)
+
+    manager = LinkManager(clock=clock, probe_interval=60.0)
+    manager.add_link("hf", send, "bbs", path=1.0, baud=300)
+    manager.queue(b"x" * 75)
+    while manager.links["hf"].quality() >= manager.min_score:
+        manager.flush()
+    assert manager.flush() == 0 and len(manager) == 1
+    # the link comes back; it is tried again once the probe interval passes
+    down[0] = False
+    clock.now += 30.0
+    assert manager.flush() == 0
+    clock.now += 30.0
+    assert manager.flush() == 1
+    for _ in range(20):
+        manager.queue(b"y")
+        assert manager.flush() == 1
+    assert manager.links["hf"].quality() > 0.9
+    # 75 bytes at 300 baud is two seconds on the air, failed tries included
+    hf = manager.links["hf"]
+    assert hf.airtime == pytest.approx(hf.failures * 2.0 + 2.0 + 20 * 8 / 300)
+
+
+@pytest.mark.parametrize("container", [list, deque])
+def test_opportunistic_relay_single_pass(container):
+    calls = []
+    queue = container([b"1", b"bad", b"2", b"bad"])
+
+    def forward(frame):
+        if frame == b"bad":
+            raise IOError("busy")
+
+    def peer():
+        calls.append(1)
+        return 2
+
+    opportunistic_relay(queue, forward, peer, lambda: 1)
+    assert list(queue) == [b"bad", b"bad"] and len(calls) == 1
+    opportunistic_relay(queue, forward, lambda: 0, lambda: 1)
+    assert list(queue) == [b"bad", b"bad"]
@@ -0,0 +1,119 @@
+import json
+
+import pytest
+
+import metrics
+from openbbs import create_app, db
+
+
+def value(name, *labels):
+    for sample in metrics.snapshot()[name]["samples"]:
+        if tuple(sample["labels"].values()) == labels:
+            return sample["value"]
+    return 0
+
+
+def test_registry_and_exposition():
+    hits = metrics.counter("test_hits_total", "hits", ("kind",))
+    assert metrics.counter("test_hits_total", "hits", ("kind",)) is hits
+    with pytest.raises(ValueError):
+        metrics.gauge("test_hits_total", "hits")
+    hits.labels("a").inc()
+    hits.labels("a").inc(2)
+    latency = metrics.histogram("test_seconds", "latency", buckets=(0.1, 1.0))
+    for v in (0.05, 0.05, 0.5, 5.0):
+        latency.observe(v)
+    assert value("test_hits_total", "a") == 3
+    sample = value("test_seconds")
+    assert sample["count"] == 4 and sample["buckets"] == [[0.1, 2], [1.0, 3], ["+Inf", 4]]
+    assert metrics.quantile(sample, 0.5) == pytest.approx(0.1)
+    text = metrics.prometheus()
+    assert '# TYPE hambbs_test_seconds histogram' in text
+    assert 'hambbs_test_seconds_bucket{le="+Inf"} 4' in text
+    assert 'hambbs_test_hits_total{kind="a"} 3' in text
+
+
+def test_radio_hot_path_counters():
+    from radio import add_crc, fec_decode, fec_encode, kiss_decode, kiss_encode, verify_crc
+
+    sent = value("radio_frames_sent_total")
+    crc = value("radio_crc_failures_total")
+    fec = value("radio_fec_seconds", "encode")["count"]
+    frame = kiss_encode(add_crc(fec_encode(b"QST de W1AW")))
+    assert fec_decode(verify_crc(kiss_decode(frame))) == b"QST de W1AW"
+    with pytest.raises(ValueError):
+        verify_crc(b"\x00\x01\x02")
+    assert value("radio_frames_sent_total") == sent + 1
+    assert value("radio_crc_failures_total") == crc + 1
+    assert value("radio_fec_seconds", "encode")["count"] == fec + 1
+
+
+def test_sync_records_bytes_and_rows(tmp_path):
+    from db import init_db
+    from sync import SyncEngine
+
+    init_db(str(tmp_path / "a.db"))
+    engine = SyncEngine(str(tmp_path / "a.db"), blob_root=tmp_path / "blobs")
+    before = value("sync_bytes_total", "out")
+    summary = engine.export(output_path=str(tmp_path / "out.zst"), format="pack")
+    assert value("sync_bytes_total", "out") == before + summary["size"]
+    assert value("sync_seconds", "out")["count"] >= 1
+    imported = value("sync_bytes_total", "in")
+    SyncEngine(str(tmp_path / "b.db"), blob_root=tmp_path / "b-blobs").push(str(tmp_path / "out.zst"))
+    assert value("sync_bytes_total", "in") == imported + summary["size"]
+
+
+def test_metrics_endpoint_and_stats(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    app = create_app({"DB_PATH": str(tmp_path / "test.db"), "TESTING": True,
+                      "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")})
+    with app.app_context():
+        db.create_all()
+        client = app.test_client()
+        client.post("/api/threads", json={"title": "Net"})
+        client.get("/api/threads")
+        client.open("/api/threads", method="FROBNICATE")
+        text = client.get("/metrics").get_data(as_text=True)
+        data = client.get("/metrics?format=json").get_json()
+    assert 'hambbs_http_requests_total{endpoint="api.threads",method="GET",status="200"}' in text
+    # made-up verbs share one label
+    assert 'hambbs_http_requests_total{endpoint="unmatched",method="other",status="405"}' in text
+    assert "FROBNICATE" not in text
+    sql = [s for s in data["http_request_sql_statements"]["samples"]
+           if s["labels"]["endpoint"] == "api.threads"]
+    assert sql and sql[0]["value"]["sum"] >= 1
+
+    import bbs
+
+    path = tmp_path / "metrics.json"
+    metrics.dump(path)
+    bbs.cmd_stats(type("obj", (), {"file": str(path), "url": None, "prefix": "http_", "json": False}))
+    out = capsys.readouterr().out
+    assert 'http_request_seconds{endpoint="api.threads",method="GET"} count=' in out
+    assert json.loads(path.read_text())["metrics"]["sql_statements_total"]
+
+
+def test_metrics_endpoint_is_restricted(tmp_path, monkeypatch):
+    from openbbs.models import User
+
+    monkeypatch.chdir(tmp_path)
+    app = create_app({"DB_PATH": str(tmp_path / "test.db"), "TESTING": True,
+                      "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")})
+    with app.app_context():
+        db.create_all()
+        mod = User(username="mod", password="pw", is_moderator=True)
+        db.session.add(mod)
+        db.session.commit()
+        mod_id = mod.id
+    # each request gets its own app context, so the login is not cached
+    remote = app.test_client()
+    remote.environ_base["REMOTE_ADDR"] = "203.0.113.7"
+    assert remote.get("/metrics").status_code == 403
+    with remote.session_transaction() as sess:
+        sess["_user_id"] = str(mod_id)
+    assert remote.get("/metrics").status_code == 200
+    app.config["METRICS_ALLOW"] = ("203.0.113.7",)
+    assert app.test_client().get("/metrics").status_code == 403
+    other = app.test_client()
+    other.environ_base["REMOTE_ADDR"] = "203.0.113.7"
+    assert other.get("/metrics?format=json").status_code == 200
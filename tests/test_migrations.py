@@ -0,0 +1,73 @@
+import sqlite3
+
+from db import CORE_MIGRATIONS, connect, init_db, migrate
+from openbbs import create_app, db
+from openbbs.models import Post, User
+from openbbs.migrations import WEB_MIGRATIONS
+from openbbs.threads import verify_threads
+
+
+def versions(path):
+    conn = connect(path)
+    rows = conn.execute("SELECT component, version FROM schema_version").fetchall()
+    conn.close()
+    return {r["component"]: r["version"] for r in rows}
+
+
+def test_core_migrations_are_recorded_once(tmp_path):
+    path = tmp_path / "core.db"
+    init_db(path)
+    assert versions(path) == {"core": len(CORE_MIGRATIONS)}
+    conn = connect(path)
+    statements = []
+    conn.set_trace_callback(statements.append)
+    assert migrate(conn, "core", CORE_MIGRATIONS) == []
+    assert len(statements) == 1
+
+
+def test_restart_keeps_data(tmp_path):
+    config = {"DB_PATH": str(tmp_path / "app.db"), "TESTING": True,
+              "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")}
+    app = create_app(config)
+    with app.app_context():
+        db.session.add(User(username="alice", password="pw"))
+        db.session.commit()
+    app = create_app(config)
+    with app.app_context():
+        assert User.query.filter_by(username="alice").count() == 1
+    assert versions(config["DB_PATH"]) == {
+        "core": len(CORE_MIGRATIONS),
+        "web": len(WEB_MIGRATIONS),
+    }
+
+
+def test_upgrades_legacy_database(tmp_path):
+    path = tmp_path / "legacy.db"
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(150) UNIQUE NOT NULL,
+            password VARCHAR(150) NOT NULL, bio TEXT, reputation INTEGER, is_moderator BOOLEAN);
+        CREATE TABLE forum (id INTEGER PRIMARY KEY, name VARCHAR(150) UNIQUE NOT NULL, description TEXT);
+        CREATE TABLE post (id INTEGER PRIMARY KEY, title VARCHAR(255) NOT NULL, body TEXT NOT NULL,
+            timestamp DATETIME, edited_at DATETIME, deleted BOOLEAN, owner_token VARCHAR(64),
+            user_id INTEGER NOT NULL, forum_id INTEGER NOT NULL, parent_id INTEGER);
+        CREATE TABLE attachment (id INTEGER PRIMARY KEY, filename VARCHAR(255) NOT NULL,
+            original_name VARCHAR(255) NOT NULL, post_id INTEGER NOT NULL);
+        INSERT INTO user (id, username, password) VALUES (1, 'old', 'pw');
+        INSERT INTO forum (id, name) VALUES (1, 'f');
+        INSERT INTO post (id, title, body, timestamp, user_id, forum_id, parent_id)
+            VALUES (1, 'root', 'b', '2020-01-01 00:00:00', 1, 1, NULL),
+                   (2, 'reply', 'r', '2020-01-02 00:00:00', 1, 1, 1);
+        """
+    )
+    conn.commit()
+    conn.close()
+    app = create_app({"DB_PATH": str(path), "TESTING": True,
+                      "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")})
+    with app.app_context():
+        root = db.session.get(Post, 1)
+        assert root.reply_count == 1
+        assert root.is_pinned in (False, 0)
+        assert verify_threads() == []
+        assert db.session.get(User, 1).username == "old"
@@ -0,0 +1,137 @@
+import pytest
+
+from db import connect, get_conn, init_db
+from outbox import ACKED, IN_FLIGHT, PENDING, HttpLink, OutboxFlusher, RadioLink, backoff
+from scheduler import LinkScheduler
+from sync import SyncEngine
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def queue(db_path, count):
+    conn = connect(db_path)
+    for i in range(count):
+        conn.execute(
+            "INSERT INTO outbox (id, thread_id, author, body, queued_at) VALUES (?,?,?,?,?)",
+            (f"q{i:03d}", "t1", "W1AW", f"report {i}", f"2024-03-01T00:00:{i % 60:02d}.{i:06d}"),
+        )
+    conn.commit()
+
+
+def states(db_path):
+    return dict(connect(db_path).execute("SELECT id, state FROM outbox").fetchall())
+
+
+class PushLink:
+    """Deliver packages straight into another node's database."""
+
+    def __init__(self, tmp_path, fail=0):
+        self.engine = SyncEngine(str(tmp_path / "dst.db"), blob_root=tmp_path / "blobs")
+        self.path = tmp_path / "in.zst"
+        self.fail = fail
+        self.sizes = []
+
+    def send(self, package):
+        if self.fail:
+            self.fail -= 1
+            raise IOError("link down")
+        self.sizes.append(len(package))
+        self.path.write_bytes(package)
+        self.engine.push(str(self.path))
+        return True
+
+    def poll(self):
+        return False
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "src.db")
+    init_db(path)
+    return path
+
+
+def test_flush_delivers_in_batches(tmp_path, db_path):
+    queue(db_path, 25)
+    link = PushLink(tmp_path)
+    flusher = OutboxFlusher(db_path, link, batch_size=10)
+    stats = flusher.flush()
+    assert stats == {"batches": 3, "acked": 25, "failed": 0}
+    assert set(states(db_path).values()) == {ACKED}
+    received = get_conn(link.engine.db_path).execute(
+        "SELECT id, author, body FROM messages ORDER BY id"
+    ).fetchall()
+    assert len(received) == 25 and tuple(received[0]) == ("q000", "W1AW", "report 0")
+    assert flusher.flush()["batches"] == 3
+
+
+def test_failed_batch_backs_off(tmp_path, db_path):
+    queue(db_path, 3)
+    clock = Clock()
+    flusher = OutboxFlusher(db_path, PushLink(tmp_path, fail=2), clock=clock)
+    flusher.flush()
+    assert set(states(db_path).values()) == {PENDING} and flusher.stats["failed"] == 3
+    # nothing is due until the backoff has passed, and it doubles
+    clock.now += backoff(1) - 1
+    assert flusher.flush_once() == 0
+    clock.now += 1
+    flusher.flush()
+    clock.now += backoff(1)
+    assert flusher.flush_once() == 0
+    clock.now += backoff(2)
+    flusher.flush()
+    assert set(states(db_path).values()) == {ACKED}
+    assert connect(db_path).execute("SELECT MAX(attempts) FROM outbox").fetchone()[0] == 3
+
+
+def test_http_link_acks_only_imported_batches(db_path, monkeypatch):
+    import transfer
+
+    replies = [
+        {"complete": True, "imported": False, "import": None, "import_error": "database is locked"},
+        {"complete": True, "imported": True, "import": {"messages": 2}, "import_error": None},
+    ]
+    monkeypatch.setattr(transfer, "upload", lambda *args, **kwargs: replies.pop(0))
+    queue(db_path, 2)
+    clock = Clock()
+    flusher = OutboxFlusher(db_path, HttpLink("http://node"), clock=clock)
+    flusher.flush_once()
+    assert set(states(db_path).values()) == {PENDING}
+    assert connect(db_path).execute("SELECT last_error FROM outbox").fetchone()[0] == "database is locked"
+    clock.now += backoff(1)
+    flusher.flush_once()
+    assert set(states(db_path).values()) == {ACKED}
+
+
+def test_radio_link_acks_when_scheduler_sends(tmp_path, db_path):
+    queue(db_path, 5)
+    sent = []
+    scheduler = LinkScheduler(sent.append, window=0)
+    flusher = OutboxFlusher(db_path, RadioLink(scheduler), batch_size=2)
+    assert flusher.flush_once() == 2
+    assert set(states(db_path).values()) == {IN_FLIGHT, PENDING}
+    flusher.flush()
+    assert len(sent) == 3 and set(states(db_path).values()) == {ACKED}
+    assert flusher.rate() > 0
+
+
+def test_scheduler_keeps_backoff_of_failed_packets():
+    def send(packet):
+        if packet == b"bad":
+            raise IOError("no ack")
+
+    scheduler = LinkScheduler(send, window=0)
+    scheduler.queue_packet(b"bad", priority=1)
+    scheduler.queue_packet(b"good", priority=5)
+    scheduler.run_once()
+    entry = scheduler.queue._heap[0]
+    assert entry.item == b"bad" and entry.attempts == 1 and entry.next_attempt > 1e9
+    # the packet backing off does not hold up the next one
+    scheduler.run_once()
+    assert [e.item for e in scheduler.queue._heap] == [b"bad"]
@@ -0,0 +1,169 @@
+import io
+import json
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+import zstandard
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from db import connect, init_db, log_change, node_id
+from keycache import KeyCache, message_payload, sign_message, verify_batch
+from sync import SyncEngine
+
+AUTHOR = Ed25519PrivateKey.generate()
+NODE = Ed25519PrivateKey.generate()
+
+
+def make_source(tmp_path, forged=False, stripped=False):
+    db_path = str(tmp_path / "src.db")
+    init_db(db_path)
+    conn = connect(db_path)
+    conn.execute("INSERT INTO threads (id, title, created_at, updated_at) VALUES ('t1','Net','2023-01-01','2023-01-01')")
+    for i, author in enumerate(["W1AW", "W1AW", "K1ABC"]):
+        m = {"id": f"m{i}", "thread_id": "t1", "timestamp": f"2023-01-01T00:00:0{i}", "author": author,
+             "body": f"msg {i}"}
+        signature = sign_message(AUTHOR, m) if author == "W1AW" else None
+        if forged and i == 1:
+            signature = sign_message(Ed25519PrivateKey.generate(), m)
+        if stripped and i == 1:
+            m["body"], signature = "QSY 7.040", None
+        conn.execute(
+            "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body, signature) VALUES (?,?,?,?,?,?,?)",
+            (m["id"], "t1", m["timestamp"], m["timestamp"], author, m["body"], signature),
+        )
+        log_change(conn, "message", m["id"])
+    conn.commit()
+    return SyncEngine(db_path, blob_root=tmp_path / "src-blobs"), node_id(conn)
+
+
+def keys_for(tmp_path, **users):
+    keys = KeyCache(tmp_path / "keys.json")
+    for user, key in users.items():
+        keys.update(user, 1, key.public_key())
+    return keys
+
+
+def target(tmp_path, keys=None, **options):
+    return SyncEngine(str(tmp_path / "dst.db"), blob_root=tmp_path / "dst-blobs", keys=keys, **options)
+
+
+def count(engine):
+    return connect(engine.db_path).execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+@pytest.mark.parametrize("fmt", ["tar", "pack"])
+def test_message_signatures_checked(tmp_path, fmt):
+    source, _ = make_source(tmp_path, forged=True)
+    path = source.pull(output_path=str(tmp_path / "p.zst"), format=fmt)
+    dst = target(tmp_path, keys_for(tmp_path, W1AW=AUTHOR))
+    summary = dst.push(path)
+    # K1ABC has no key on record, so its unsigned message is let through
+    assert summary["messages"] == 2 and summary["rejected"] == 1
+    row = connect(dst.db_path).execute("SELECT signature FROM messages WHERE id='m0'").fetchone()
+    assert row["signature"] == sign_message(AUTHOR, {"id": "m0", "thread_id": "t1",
+                                                    "timestamp": "2023-01-01T00:00:00",
+                                                    "author": "W1AW", "body": "msg 0"})
+
+
+@pytest.mark.parametrize("fmt", ["tar", "pack"])
+def test_stripped_signature_rejected(tmp_path, fmt):
+    source, _ = make_source(tmp_path, stripped=True)
+    path = source.pull(output_path=str(tmp_path / "p.zst"), format=fmt)
+    dst = target(tmp_path, keys_for(tmp_path, W1AW=AUTHOR))
+    summary = dst.push(path)
+    # W1AW's key is on record, so the unsigned, rewritten m1 is refused
+    assert summary["messages"] == 2 and summary["rejected"] == 1
+    ids = [r[0] for r in connect(dst.db_path).execute("SELECT id FROM messages ORDER BY id")]
+    assert ids == ["m0", "m2"]
+
+
+def test_require_signatures_drops_unsigned(tmp_path):
+    source, node = make_source(tmp_path)
+    path = source.pull(output_path=str(tmp_path / "p.zst"), format="pack", signing_key=NODE)
+    dst = target(tmp_path, keys_for(tmp_path, W1AW=AUTHOR, **{node: NODE}), require_signatures=True)
+    summary = dst.push(path)
+    assert summary["messages"] == 2 and summary["rejected"] == 1
+    unsigned = source.pull(output_path=str(tmp_path / "u.zst"))
+    with pytest.raises(ValueError, match="not signed"):
+        dst.push(unsigned)
+
+
+def rewrite_tar(path, edit):
+    with open(path, "rb") as f:
+        data = zstandard.ZstdDecompressor().stream_reader(f).read()
+    src = tarfile.open(fileobj=io.BytesIO(data))
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w") as dst:
+        for member in src.getmembers():
+            content = src.extractfile(member).read() if member.isfile() else None
+            if member.name == "threads/t1.json":
+                content = edit(content)
+                member.size = len(content)
+            dst.addfile(member, io.BytesIO(content) if content is not None else None)
+    with open(path, "wb") as f:
+        f.write(zstandard.ZstdCompressor().compress(out.getvalue()))
+
+
+def test_tar_package_signature(tmp_path):
+    source, node = make_source(tmp_path)
+    path = source.pull(output_path=str(tmp_path / "p.tar.zst"), signing_key=NODE)
+    keys = keys_for(tmp_path, **{node: NODE})
+    assert target(tmp_path, keys).push(path)["messages"] == 3
+
+    # an edited body no longer matches the signed root; nothing is applied
+    def tamper(content):
+        msgs = json.loads(content)
+        msgs[2]["body"] = "QSY 7.040"
+        return json.dumps(msgs).encode()
+
+    rewrite_tar(path, tamper)
+    fresh = SyncEngine(str(tmp_path / "fresh.db"), blob_root=tmp_path / "fresh-blobs", keys=keys)
+    with pytest.raises(ValueError, match="bad package signature"):
+        fresh.push(path)
+    assert count(fresh) == 0
+
+
+@pytest.mark.parametrize("fmt", ["tar", "pack"])
+def test_package_from_wrong_node_key(tmp_path, fmt):
+    source, node = make_source(tmp_path)
+    path = source.pull(output_path=str(tmp_path / "p.zst"), format=fmt,
+                       signing_key=Ed25519PrivateKey.generate())
+    dst = target(tmp_path, keys_for(tmp_path, **{node: NODE}))
+    with pytest.raises(ValueError, match="not signed by node"):
+        dst.push(path)
+    assert count(dst) == 0
+
+
+@pytest.mark.parametrize("fmt", ["tar", "pack"])
+def test_require_signatures_refuses_unknown_node(tmp_path, fmt):
+    source, _ = make_source(tmp_path)
+    path = source.pull(output_path=str(tmp_path / "p.zst"), format=fmt,
+                       signing_key=Ed25519PrivateKey.generate())
+    dst = target(tmp_path, keys_for(tmp_path, W1AW=AUTHOR), require_signatures=True)
+    with pytest.raises(ValueError, match="unknown node"):
+        dst.push(path)
+    assert count(dst) == 0
+
+
+def test_keycache_parses_each_key_once(tmp_path):
+    keys = keys_for(tmp_path, W1AW=AUTHOR)
+    assert keys.get("W1AW") is keys.get("W1AW")
+    other = Ed25519PrivateKey.generate()
+    keys.update("W1AW", 2, other.public_key())
+    assert keys.key_bytes("W1AW") == KeyCache(tmp_path / "keys.json").key_bytes("W1AW")
+    m = {"id": "m1", "thread_id": "t1", "timestamp": "2023-01-01", "author": "W1AW", "body": "hi"}
+    assert keys.verify("W1AW", message_payload(m), bytes.fromhex(sign_message(other, m)))
+    assert keys.verify("K1ABC", message_payload(m), b"") is None
+
+
+def test_verify_batch_in_pool_matches_serial():
+    raw = AUTHOR.public_key().public_bytes_raw()
+    items = []
+    for i in range(1200):
+        payload = f"msg {i}".encode()
+        signature = AUTHOR.sign(payload if i % 7 else b"other")
+        items.append((raw, payload, signature))
+    with ProcessPoolExecutor(2) as pool:
+        assert verify_batch(items, pool) == verify_batch(items)
+    assert verify_batch(items).count(False) == 172
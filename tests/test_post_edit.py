@@ -6,9 +6,8 @@ import pytest
 
 @pytest.fixture
 def app_ctx(tmp_path):
-    app = create_app()
-    app.config["SQLALCHEMY_DATABASE_URI"] = f'sqlite:///{tmp_path / "test.db"}'
-    app.config["TESTING"] = True
+    app = create_app({"DB_PATH": str(tmp_path / "test.db"), "TESTING": True,
+                      "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")})
     with app.app_context():
         db.create_all()
         yield app
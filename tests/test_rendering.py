@@ -0,0 +1,108 @@
+from openbbs import create_app, db, rendering
+from openbbs.models import User, Forum, Post, RenderedPost
+from openbbs.rendering import post_html, prewarm, preview_html
+from openbbs.views import generate_action_token
+import pytest
+
+
+@pytest.fixture
+def app_ctx(tmp_path):
+    app = create_app({"DB_PATH": str(tmp_path / "test.db"), "TESTING": True,
+                      "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")})
+    with app.app_context():
+        db.create_all()
+        rendering._lru.clear()
+        yield app
+
+
+@pytest.fixture
+def client(app_ctx):
+    return app_ctx.test_client()
+
+
+def make_post(body, parent=None):
+    user = User.query.filter_by(username="alice").first()
+    if user is None:
+        user = User(username="alice", password="pw")
+        db.session.add(user)
+    forum = Forum.query.first() or Forum(name="f1")
+    post = Post(title="t", body=body, author=user, forum=forum, parent=parent)
+    db.session.add(post)
+    db.session.commit()
+    return post
+
+
+def cached(post_id):
+    return db.session.get(RenderedPost, post_id)
+
+
+def test_post_rendered_once_and_escaped(app_ctx, client):
+    post = make_post("**73** <script>alert(1)</script> [x](javascript:alert(1))")
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(post.user_id)
+    resp = client.get(f"/forums/{post.forum_id}")
+    assert b"<strong>73</strong>" in resp.data
+    assert b"<script>alert" not in resp.data and b"&lt;script&gt;" in resp.data
+    assert b'href="#"' in resp.data
+    row = cached(post.id)
+    assert row is not None
+
+    # later views are served from the cache, even by another process
+    row.html = "<p>from cache</p>"
+    db.session.commit()
+    rendering._lru.clear()
+    assert post_html(post) == "<p>from cache</p>"
+
+
+def test_edit_invalidates(app_ctx, client):
+    post = make_post("first")
+    assert "first" in post_html(post)
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(post.user_id)
+    token = generate_action_token(post.id, post.user_id)
+    client.post(f"/post/{post.id}/edit", data={"title": "t", "body": "_second_", "token": token})
+    db.session.expire_all()
+    assert cached(post.id) is None
+    assert post_html(post) == "<p><em>second</em></p>"
+    assert cached(post.id).digest == rendering._digest("_second_")
+
+
+@pytest.mark.parametrize("link", [
+    "&#106;avascript:alert(1)",
+    "java&#x09;script:alert(1)",
+    "&#x20;javascript:alert(1)",
+    "JaVa&Tab;Script:alert(1)",
+    "data&colon;text/html,x",
+])
+def test_encoded_schemes_are_neutralised(link):
+    html = str(rendering.render_markdown(f"[x]({link}) ![i]({link})"))
+    assert 'href="#"' in html and 'src="#"' in html
+    assert "script" not in html.lower() and "data" not in html
+
+
+def test_prewarm_and_preview(app_ctx):
+    root = make_post("root")
+    make_post("reply", parent=root)
+    assert prewarm() == 2
+    assert prewarm() == 0
+    assert preview_html("# hi") == "<h1>hi</h1>"
+    assert preview_html("# hi") is preview_html("# hi")
+
+
+def test_cache_write_waits_for_session_transaction(app_ctx):
+    import sqlite3
+    import time
+
+    post = make_post("*waiting*")
+    other = make_post("other")
+    # the session holds SQLite's write lock until it commits
+    other.title = "renamed"
+    db.session.flush()
+    started = time.monotonic()
+    assert post_html(post) == "<p><em>waiting</em></p>"
+    assert time.monotonic() - started < 1.0
+    outside = sqlite3.connect(app_ctx.config["DB_PATH"])
+    query = "SELECT COUNT(*) FROM rendered_post WHERE post_id=?"
+    assert outside.execute(query, (post.id,)).fetchone()[0] == 0
+    db.session.commit()
+    assert outside.execute(query, (post.id,)).fetchone()[0] == 1
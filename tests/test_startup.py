@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# modules a web worker must not load until a request needs them
+LAZY = {"sync", "radio", "markdown", "zstandard", "reedsolo", "crcmod"}
+# import time of everything ``run.py`` loads, in microseconds.  Measured
+# at about 0.72 s with the lazy imports and 1.1-1.25 s without them, so
+# the budget is ~1.4x the measured figure: enough headroom for a noisy
+# machine while still failing if the eager imports come back.
+BUDGET_US = int(os.environ.get("OPENBBS_STARTUP_BUDGET_US", 1_000_000))
+
+
+def import_times(cwd):
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import run"],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    total = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        times[name.strip()] = int(cumulative)
+        # nested imports are indented below their importer
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return times, total
+
+
+def test_startup_skips_rarely_used_modules(tmp_path):
+    times, _ = import_times(tmp_path)
+    assert "openbbs.views" in times
+    assert not LAZY.intersection(times)
+
+
+def test_startup_within_budget(tmp_path):
+    _, total = import_times(tmp_path)
+    assert total < BUDGET_US
@@ -0,0 +1,112 @@
+from openbbs import create_app, db
+from openbbs.models import User, Forum, Post, Attachment, Flag, PostVersion
+from openbbs.views import generate_action_token
+from openbbs.threads import subtree_ids
+import openbbs.attachments as attachments
+import pytest
+
+
+@pytest.fixture
+def app_ctx(tmp_path):
+    app = create_app({"DB_PATH": str(tmp_path / "test.db"), "TESTING": True,
+                      "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")})
+    with app.app_context():
+        db.create_all()
+        yield app
+
+
+@pytest.fixture
+def client(app_ctx):
+    return app_ctx.test_client()
+
+
+def create_user(username, is_mod=False):
+    user = User(username=username, password="pw", is_moderator=is_mod)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def login(client, username):
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(User.query.filter_by(username=username).first().id)
+
+
+def make_thread(author, forum, depth=3):
+    root = Post(title="root", body="b", author=author, forum=forum)
+    db.session.add(root)
+    db.session.flush()
+    parent = root
+    ids = [root.id]
+    for i in range(depth):
+        reply = Post(title=f"r{i}", body="r", author=author, forum=forum, parent_id=parent.id)
+        sibling = Post(title=f"s{i}", body="s", author=author, forum=forum, parent_id=parent.id)
+        db.session.add_all([reply, sibling])
+        db.session.flush()
+        ids.extend([reply.id, sibling.id])
+        parent = reply
+    db.session.commit()
+    return root, ids
+
+
+def test_subtree_ids_walks_all_levels(app_ctx):
+    user = create_user("alice")
+    forum = Forum(name="f1")
+    db.session.add(forum)
+    db.session.commit()
+    root, ids = make_thread(user, forum)
+    other, _ = make_thread(user, forum, depth=1)
+    found = set(db.session.scalars(subtree_ids(root.id)))
+    assert found == set(ids)
+
+
+def test_move_updates_whole_subtree(app_ctx, client):
+    mod = create_user("mod", is_mod=True)
+    f1 = Forum(name="f1")
+    f2 = Forum(name="f2")
+    db.session.add_all([f1, f2])
+    db.session.commit()
+    root, ids = make_thread(mod, f1)
+    login(client, "mod")
+    token = generate_action_token(root.id, mod.id)
+    resp = client.post(f"/post/{root.id}/move", data={"forum_id": f2.id, "token": token})
+    assert resp.status_code == 302
+    forums = {p.forum_id for p in Post.query.filter(Post.id.in_(ids))}
+    assert forums == {f2.id}
+
+
+def test_hard_delete_removes_subtree_rows_and_files(app_ctx, client, tmp_path):
+    mod = create_user("mod", is_mod=True)
+    user = create_user("bob")
+    forum = Forum(name="f1")
+    db.session.add(forum)
+    db.session.commit()
+    root, ids = make_thread(user, forum)
+    blob = tmp_path / "a.gz"
+    blob.write_bytes(b"x")
+    db.session.add(Attachment(filename=str(blob), original_name="a", post_id=ids[-1]))
+    db.session.add(Flag(post_id=ids[1], user_id=mod.id, reason="spam"))
+    db.session.add(PostVersion(title="old", body="old", post_id=ids[2]))
+    db.session.commit()
+    login(client, "mod")
+    token = generate_action_token(root.id, mod.id)
+    resp = client.post(f"/post/{root.id}/delete", data={"token": token})
+    assert resp.status_code == 302
+    assert Post.query.filter(Post.id.in_(ids)).count() == 0
+    assert Attachment.query.count() == 0
+    assert Flag.query.count() == 0
+    assert PostVersion.query.count() == 0
+    attachments.unlink_later([str(tmp_path / "missing")]).result(timeout=5)
+    assert not blob.exists()
+
+
+def test_soft_delete_marks_subtree(app_ctx, client):
+    user = create_user("carol")
+    forum = Forum(name="f1")
+    db.session.add(forum)
+    db.session.commit()
+    root, ids = make_thread(user, forum)
+    login(client, "carol")
+    token = generate_action_token(root.id, user.id)
+    client.post(f"/post/{root.id}/delete", data={"token": token})
+    assert all(p.deleted for p in Post.query.filter(Post.id.in_(ids)))
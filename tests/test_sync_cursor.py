@@ -0,0 +1,67 @@
+from db import connect, init_db, log_change
+from sync import SyncEngine
+
+
+def setup_db(tmp_path, name):
+    db_path = str(tmp_path / f"{name}.db")
+    init_db(db_path)
+    return db_path, SyncEngine(db_path, blob_root=tmp_path / f"{name}-blobs")
+
+
+def post(db_path, tid, mid, body, ts="2023-01-01T00:00:00"):
+    conn = connect(db_path)
+    conn.execute("INSERT OR IGNORE INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
+                 (tid, "Thread", ts, ts))
+    log_change(conn, "thread", tid)
+    conn.execute("INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+                 (mid, tid, ts, ts, "alice", body))
+    log_change(conn, "message", mid)
+    conn.commit()
+
+
+def test_cursor_pull_sends_only_delta(tmp_path):
+    src, engine = setup_db(tmp_path, "src")
+    post(src, "t1", "m1", "one")
+    first = engine.export(cursor=0, output_path=str(tmp_path / "p1.tar.zst"))
+    assert (first["threads"], first["messages"]) == (1, 1)
+    post(src, "t1", "m2", "two")
+    second = engine.export(cursor=first["cursor"], output_path=str(tmp_path / "p2.tar.zst"))
+    assert second["messages"] == 1
+    assert second["cursor"] > first["cursor"]
+    empty = engine.export(cursor=second["cursor"], output_path=str(tmp_path / "p3.tar.zst"))
+    assert (empty["threads"], empty["messages"], empty["tombstones"]) == (0, 0, 0)
+    assert empty["cursor"] == second["cursor"]
+
+
+def test_tombstones_propagate_deletes(tmp_path):
+    src, engine = setup_db(tmp_path, "src")
+    dst, peer = setup_db(tmp_path, "dst")
+    post(src, "t1", "m1", "one")
+    first = engine.export(cursor=0, output_path=str(tmp_path / "p1.tar.zst"))
+    peer.push(first["path"])
+    conn = connect(src)
+    conn.execute("DELETE FROM messages WHERE id='m1'")
+    log_change(conn, "message", "m1", "delete")
+    conn.commit()
+    delta = engine.export(cursor=first["cursor"], output_path=str(tmp_path / "p2.tar.zst"))
+    assert delta["tombstones"] == 1
+    summary = peer.push(delta["path"])
+    assert summary["deleted"] == 1
+    assert summary["cursor"] == delta["cursor"]
+    assert connect(dst).execute("SELECT * FROM messages").fetchall() == []
+
+
+def test_clock_orders_edits_despite_skew(tmp_path):
+    src, engine = setup_db(tmp_path, "src")
+    dst, peer = setup_db(tmp_path, "dst")
+    post(src, "t1", "m1", "original")
+    peer.push(engine.export(cursor=0, output_path=str(tmp_path / "p1.tar.zst"))["path"])
+    # the later edit carries an older wall-clock updated_at
+    conn = connect(dst)
+    cursor = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+    conn.execute("UPDATE messages SET body='edited', updated_at='2000-01-01T00:00:00' WHERE id='m1'")
+    log_change(conn, "message", "m1")
+    conn.commit()
+    engine.push(peer.export(cursor=cursor, output_path=str(tmp_path / "p2.tar.zst"))["path"])
+    body = connect(src).execute("SELECT body FROM messages WHERE id='m1'").fetchone()["body"]
+    assert body == "edited"
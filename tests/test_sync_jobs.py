@@ -0,0 +1,127 @@
+import io
+import time
+
+import pytest
+
+from db import get_conn, log_change
+from openbbs import create_app, db
+from openbbs.jobs import JobRunner
+
+
+@pytest.fixture
+def app_ctx(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    app = create_app(
+        {
+            "DB_PATH": str(tmp_path / "test.db"),
+            "TESTING": True,
+            "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key"),
+            "UPLOAD_FOLDER": str(tmp_path / "uploads"),
+        }
+    )
+    with app.app_context():
+        db.create_all()
+        yield app
+        if "sync_jobs" in app.extensions:
+            app.extensions["sync_jobs"].shutdown()
+
+
+@pytest.fixture
+def client(app_ctx):
+    return app_ctx.test_client()
+
+
+def add_message(app, mid):
+    conn = get_conn(app.config["DB_PATH"])
+    conn.execute(
+        "INSERT OR IGNORE INTO threads (id, title, created_at, updated_at) VALUES ('t1','Net','2023-01-01','2023-01-01')"
+    )
+    conn.execute(
+        "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+        (mid, "t1", "2023-01-01T00:00:00", "2023-01-01T00:00:00", "W1AW", "hello"),
+    )
+    log_change(conn, "message", mid)
+    conn.commit()
+
+
+def wait(client, job):
+    for _ in range(200):
+        status = client.get(f"/api/sync/jobs/{job['id']}").get_json()
+        if status["state"] in ("done", "failed"):
+            return status
+        time.sleep(0.02)
+    raise AssertionError("job did not finish")
+
+
+def test_pull_job_builds_package(app_ctx, client):
+    add_message(app_ctx, "m1")
+    resp = client.post("/api/sync/pull", json={"cursor": 0})
+    assert resp.status_code == 202
+    job = resp.get_json()
+    assert resp.headers["Location"] == f"/api/sync/jobs/{job['id']}"
+    status = wait(client, job)
+    assert status["state"] == "done"
+    assert status["result"]["messages"] == 1
+    assert status["progress"] == {"done": 1, "total": 1}
+    package = client.get(f"/api/sync/jobs/{job['id']}/package")
+    assert package.status_code == 200
+    assert package.headers["X-Sync-Cursor"] == str(status["result"]["cursor"])
+
+
+def test_identical_pulls_share_a_job(app_ctx, client):
+    add_message(app_ctx, "m1")
+    first = client.post("/api/sync/pull", json={"cursor": 0, "threads": ["t1"]}).get_json()
+    second = client.post("/api/sync/pull", json={"threads": ["t1"], "cursor": 0}).get_json()
+    assert first["id"] == second["id"]
+    other = client.post("/api/sync/pull", json={"cursor": 1, "threads": ["t1"]}).get_json()
+    assert other["id"] != first["id"]
+    wait(client, first)
+    # a new change makes the cached package stale
+    add_message(app_ctx, "m2")
+    third = client.post("/api/sync/pull", json={"cursor": 0, "threads": ["t1"]}).get_json()
+    assert third["id"] != first["id"]
+    assert wait(client, third)["result"]["messages"] == 2
+
+
+def test_push_job_imports_and_cleans_up(app_ctx, client, tmp_path):
+    add_message(app_ctx, "m1")
+    job = client.post("/api/sync/pull", json={"cursor": 0}).get_json()
+    wait(client, job)
+    package = client.get(f"/api/sync/jobs/{job['id']}/package").data
+    resp = client.post(
+        "/api/sync/push",
+        data={"file": (io.BytesIO(package), "p.tar.zst"), "peer": "hilltop"},
+        content_type="multipart/form-data",
+    )
+    assert resp.status_code == 202
+    status = wait(client, resp.get_json())
+    assert status["state"] == "done"
+    assert status["result"]["peer"] == "hilltop"
+    assert not list((tmp_path / "uploads" / "jobs").glob("*.upload"))
+
+
+def test_expired_jobs_delete_their_package(app_ctx, client):
+    job = client.post("/api/sync/pull", json={}).get_json()
+    wait(client, job)
+    runner = app_ctx.extensions["sync_jobs"]
+    path = runner.get(job["id"]).path
+    assert path.exists()
+    runner.expire(now=time.time() + runner.ttl + 1)
+    assert not path.exists()
+    assert client.get(f"/api/sync/jobs/{job['id']}").status_code == 404
+
+
+def test_failed_job_is_retried():
+    runner = JobRunner(max_workers=1)
+
+    def boom(job):
+        raise RuntimeError("disk full")
+
+    job = runner.submit("pull", boom, key="k")
+    while job.finished is None:
+        time.sleep(0.01)
+    assert job.state == "failed" and job.error == "disk full"
+    retry = runner.submit("pull", lambda j: 1, key="k")
+    assert retry is not job
+    runner.shutdown()
+    assert retry.result == 1
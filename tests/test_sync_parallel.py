@@ -0,0 +1,48 @@
+import io
+import tarfile
+
+import zstandard as zstd
+
+from db import connect, init_db, log_change
+from sync import SyncEngine
+
+
+def setup_db(tmp_path, name, threads=0, messages=0):
+    db_path = str(tmp_path / f"{name}.db")
+    init_db(db_path)
+    conn = connect(db_path)
+    for t in range(threads):
+        conn.execute(
+            "INSERT INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
+            (f"t{t}", f"Net {t}", "2023-01-01", "2023-01-01"),
+        )
+    for i in range(messages):
+        ts = f"2023-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}"
+        conn.execute(
+            "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+            (f"m{i}", f"t{i % threads}", ts, ts, "W1AW", f"check in {i}"),
+        )
+        log_change(conn, "message", f"m{i}")
+    conn.commit()
+    return db_path, SyncEngine(db_path, blob_root=tmp_path / f"{name}-blobs")
+
+
+def members(path):
+    with open(path, "rb") as f:
+        data = zstd.ZstdDecompressor().stream_reader(f).read()
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return {m.name: tar.extractfile(m).read() for m in tar.getmembers() if m.isfile()}
+
+
+def test_parallel_export_is_deterministic(tmp_path, monkeypatch):
+    monkeypatch.setattr("sync.PARALLEL_BATCH", 50)
+    src, engine = setup_db(tmp_path, "src", threads=20, messages=600)
+    serial = engine.export(output_path=str(tmp_path / "serial.zst"))
+    two = engine.export(output_path=str(tmp_path / "two.zst"), workers=2)
+    three = engine.export(output_path=str(tmp_path / "three.zst"), workers=3)
+    assert (tmp_path / "two.zst").read_bytes() == (tmp_path / "three.zst").read_bytes()
+    assert members(serial["path"]) == members(two["path"])
+    assert two["messages"] == three["messages"] == 600
+
+    dst, peer = setup_db(tmp_path, "dst")
+    assert peer.push(two["path"])["messages"] == 600
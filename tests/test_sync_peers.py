@@ -0,0 +1,57 @@
+from db import connect, init_db, log_change
+from sync import SyncEngine
+
+
+def setup_db(tmp_path, name):
+    db_path = str(tmp_path / f"{name}.db")
+    init_db(db_path)
+    return db_path, SyncEngine(db_path, blob_root=tmp_path / f"{name}-blobs")
+
+
+def post(db_path, tid, mid, body):
+    ts = "2023-01-01T00:00:00"
+    conn = connect(db_path)
+    conn.execute("INSERT OR IGNORE INTO threads (id, title, created_at, updated_at) VALUES (?,?,?,?)",
+                 (tid, "Thread", ts, ts))
+    log_change(conn, "thread", tid)
+    conn.execute("INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+                 (mid, tid, ts, ts, "alice", body))
+    log_change(conn, "message", mid)
+    conn.commit()
+
+
+def test_peer_delta_round_trip(tmp_path):
+    a_path, a = setup_db(tmp_path, "a")
+    b_path, b = setup_db(tmp_path, "b")
+    post(a_path, "t1", "m1", "from a")
+    out = a.export(peer="b", output_path=str(tmp_path / "a1.tar.zst"))
+    assert out["messages"] == 1
+    b.push(out["path"], peer="a")
+
+    # nothing from a is echoed back; b's reply carries the ack
+    post(b_path, "t1", "m2", "from b")
+    back = b.export(peer="a", output_path=str(tmp_path / "b1.tar.zst"))
+    assert back["messages"] == 1
+    a.push(back["path"], peer="b")
+    state = a.peer_state("b")
+    assert state["acked_cursor"] == out["cursor"]
+    assert state["bytes_sent"] == out["size"]
+    assert state["bytes_received"] == back["size"]
+
+    # acknowledged and imported changes are not sent again
+    again = a.export(peer="b", output_path=str(tmp_path / "a2.tar.zst"))
+    assert (again["threads"], again["messages"]) == (0, 0)
+    packages = connect(a_path).execute(
+        "SELECT direction, COUNT(*) FROM sync_packages WHERE peer_id='b' GROUP BY direction"
+    ).fetchall()
+    assert dict(map(tuple, packages)) == {"in": 1, "out": 2}
+
+
+def test_unacknowledged_delta_is_resent(tmp_path):
+    a_path, a = setup_db(tmp_path, "a")
+    post(a_path, "t1", "m1", "one")
+    a.acknowledge("b", a.export(peer="b", output_path=str(tmp_path / "p1.tar.zst"))["cursor"])
+    post(a_path, "t1", "m2", "two")
+    lost = a.export(peer="b", output_path=str(tmp_path / "p2.tar.zst"))
+    retry = a.export(peer="b", output_path=str(tmp_path / "p3.tar.zst"))
+    assert lost["messages"] == retry["messages"] == 1
@@ -0,0 +1,136 @@
+import io
+import random
+
+import pytest
+import zstandard as zstd
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from db import connect, init_db, log_change
+from sync import SyncEngine
+from syncpack import PackReader, PackWriter
+
+CALLS = ["W1AW", "K1ABC", "N0CALL", "VE3XYZ", "G4ABC"]
+
+
+def setup_db(tmp_path, name, messages=0):
+    db_path = str(tmp_path / f"{name}.db")
+    init_db(db_path)
+    conn = connect(db_path)
+    rng = random.Random(1)
+    conn.execute("INSERT INTO threads (id, title, created_at, updated_at) VALUES ('t1','Net','2023-01-01','2023-01-01')")
+    log_change(conn, "thread", "t1")
+    for i in range(messages):
+        ts = f"2023-01-01T{i // 60 % 24:02d}:{i % 60:02d}:00"
+        conn.execute(
+            "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+            (f"m{i}", "t1", ts, ts, rng.choice(CALLS), f"check in {i} signal report 5{rng.randint(1, 9)}9"),
+        )
+        log_change(conn, "message", f"m{i}")
+    conn.commit()
+    return db_path, SyncEngine(db_path, blob_root=tmp_path / f"{name}-blobs")
+
+
+def test_records_round_trip():
+    buf = io.BytesIO()
+    writer = PackWriter(buf)
+    writer.manifest({"cursor": 7, "node": "n1", "tombstones": []})
+    thread = {"id": "t1", "title": "Net", "created_at": "2023-01-01",
+              "updated_at": "2023-01-01T10:00:00.250000", "hlc": None}
+    msg = {"id": "m1", "thread_id": "t1", "timestamp": "2023-01-01T10:00:00",
+           "updated_at": "2023-01-01T10:00:00", "author": None, "body": "",
+           "hlc": "0001700000000-00000-n1",
+           "attachments": [{"sha256": "ab" * 32, "name": "log.txt", "size": 0}]}
+    writer.thread(thread)
+    writer.message(msg)
+    writer.tombstone({"entity": "message", "id": "m0", "hlc": None})
+    writer.close()
+    buf.seek(0)
+    assert list(PackReader(buf)) == [
+        ("manifest", {"cursor": 7, "node": "n1"}),
+        ("thread", thread),
+        ("message", msg),
+        ("tombstone", {"entity": "message", "id": "m0", "hlc": None}),
+    ]
+
+
+def test_pack_package_round_trip(tmp_path):
+    src, engine = setup_db(tmp_path, "src", messages=50)
+    dst, peer = setup_db(tmp_path, "dst")
+    tar = engine.export(output_path=str(tmp_path / "p.tar.zst"))
+    pack = engine.export(output_path=str(tmp_path / "p.pack.zst"), format="pack")
+    assert pack["size"] < tar["size"]
+    summary = peer.push(pack["path"])
+    assert summary["messages"] == 50
+    assert summary["cursor"] == pack["cursor"]
+    rows = connect(dst).execute("SELECT * FROM messages ORDER BY id").fetchall()
+    assert [dict(r) for r in rows] == [
+        dict(r) for r in connect(src).execute("SELECT * FROM messages ORDER BY id")
+    ]
+
+
+def test_signed_package(tmp_path):
+    src, engine = setup_db(tmp_path, "src", messages=5)
+    dst, peer = setup_db(tmp_path, "dst")
+    key = Ed25519PrivateKey.generate()
+    path = engine.pull(output_path=str(tmp_path / "p.zst"), format="pack", level=0, signing_key=key)
+    # flip one byte of a signed message body and recompress
+    with open(path, "rb") as f:
+        raw = bytearray(zstd.ZstdDecompressor().stream_reader(f).read())
+    raw[raw.index(b"check in 3") + 9] ^= 1
+    bad = tmp_path / "bad.zst"
+    bad.write_bytes(zstd.ZstdCompressor().compress(bytes(raw)))
+    with pytest.raises(ValueError):
+        peer.push(str(bad))
+    assert connect(dst).execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 0
+    assert peer.push(path)["messages"] == 5
+
+
+def _split_records(raw, offset):
+    records = []
+    while offset < len(raw):
+        size, shift, start = 0, 0, offset
+        while True:
+            byte = raw[offset]
+            offset += 1
+            size |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        offset += size
+        records.append(raw[start:offset])
+    return records
+
+
+def test_signed_records_cannot_be_reordered():
+    key = Ed25519PrivateKey.generate()
+    buf = io.BytesIO()
+    writer = PackWriter(buf, signing_key=key)
+    for i, author in enumerate(["W1AW", "K1ABC"]):
+        writer.message({"id": f"m{i}", "thread_id": "t1", "timestamp": None,
+                        "updated_at": None, "author": author, "body": "hi", "hlc": None})
+    writer.close()
+    raw = buf.getvalue()
+    header, records = raw[:38], _split_records(raw, 38)
+    # record/signature pairs: t1, W1AW, m0, K1ABC, m1, end
+    pairs = [records[i:i + 2] for i in range(0, len(records), 2)]
+    assert len(list(PackReader(io.BytesIO(raw)))) == 2
+    swapped = [pairs[0], pairs[3], pairs[2], pairs[1], pairs[4], pairs[5]]
+    dropped = pairs[:4] + pairs[5:]
+    for tampered in (swapped, dropped):
+        data = header + b"".join(b"".join(p) for p in tampered)
+        with pytest.raises(ValueError):
+            list(PackReader(io.BytesIO(data)))
+
+
+@pytest.mark.parametrize("record", [
+    b"\x02\x04\x80",             # message id length is a truncated varint
+    b"\x04\x04\x01a\x05",        # thread id refers to a string never sent
+    b"\x01\x03",                 # thread id varint missing
+    b"\x06\x06" + b"\x00" * 40,  # blob record too short for its digest
+    b"\x02\x05\x07",             # unknown tombstone entity
+    b"\x00\x01\x00",             # empty record
+])
+def test_malformed_records_raise_value_error(record):
+    data = b"HBSP\x02\x00" + record
+    with pytest.raises(ValueError):
+        list(PackReader(io.BytesIO(data)))
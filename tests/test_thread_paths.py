@@ -0,0 +1,103 @@
+from openbbs import create_app, db
+from openbbs.models import User, Forum, Post
+from openbbs.views import generate_action_token
+from openbbs.threads import rebuild_threads, soft_delete_subtree, verify_threads
+import pytest
+
+
+@pytest.fixture
+def app_ctx(tmp_path):
+    app = create_app({"DB_PATH": str(tmp_path / "test.db"), "TESTING": True,
+                      "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key")})
+    with app.app_context():
+        db.create_all()
+        yield app
+
+
+@pytest.fixture
+def client(app_ctx):
+    return app_ctx.test_client()
+
+
+def create_user(username, is_mod=False):
+    user = User(username=username, password="pw", is_moderator=is_mod)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def login(client, username):
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(User.query.filter_by(username=username).first().id)
+
+
+def setup_thread():
+    user = create_user("mod", is_mod=True)
+    forum = Forum(name="f1")
+    db.session.add(forum)
+    db.session.commit()
+    root = Post(title="root", body="b", author=user, forum=forum)
+    db.session.add(root)
+    db.session.flush()
+    a = Post(title="a", body="a", author=user, forum=forum, parent_id=root.id)
+    db.session.add(a)
+    db.session.flush()
+    b = Post(title="b", body="b", author=user, forum=forum, parent_id=a.id)
+    c = Post(title="c", body="c", author=user, forum=forum, parent_id=root.id)
+    db.session.add_all([b, c])
+    db.session.commit()
+    return user, forum, root, a, b, c
+
+
+def test_insert_maintains_path_and_counters(app_ctx):
+    _, _, root, a, b, c = setup_thread()
+    assert b.path == f"{root.id:010d}/{a.id:010d}/{b.id:010d}/"
+    assert b.root_id == root.id and b.depth == 2
+    assert Post.query.get(root.id).reply_count == 3
+    assert Post.query.get(a.id).reply_count == 1
+    assert verify_threads() == []
+
+
+def test_split_and_delete_keep_counters_consistent(app_ctx, client):
+    user, forum, root, a, b, c = setup_thread()
+    login(client, "mod")
+    token = generate_action_token(a.id, user.id)
+    client.post(f"/post/{a.id}/split", data={"forum_id": forum.id, "token": token})
+    assert Post.query.get(root.id).reply_count == 1
+    moved = Post.query.get(b.id)
+    assert moved.root_id == a.id and moved.depth == 1
+    assert verify_threads() == []
+    token = generate_action_token(c.id, user.id)
+    client.post(f"/post/{c.id}/delete", data={"token": token})
+    assert Post.query.get(root.id).reply_count == 0
+    assert verify_threads() == []
+
+
+def test_rebuild_repairs_drift(app_ctx):
+    _, _, root, a, b, c = setup_thread()
+    Post.query.filter_by(id=root.id).update({"reply_count": 42, "path": None})
+    db.session.commit()
+    assert set(verify_threads()) == {root.id}
+    rebuild_threads()
+    assert verify_threads() == []
+    assert Post.query.get(root.id).reply_count == 3
+
+
+def test_soft_deleted_replies_are_not_counted(app_ctx):
+    from datetime import datetime, timedelta
+
+    _, _, root, a, b, c = setup_thread()
+    Post.query.filter_by(id=b.id).update({"timestamp": datetime.utcnow() + timedelta(hours=1)})
+    rebuild_threads()
+    assert Post.query.get(root.id).last_activity == Post.query.get(b.id).timestamp
+    soft_delete_subtree(a.id)
+    db.session.commit()
+    root = Post.query.get(root.id)
+    assert root.reply_count == 1 and root.last_activity < Post.query.get(b.id).timestamp
+    assert Post.query.get(a.id).reply_count == 0
+    assert verify_threads() == []
+    # restoring one post counts it again, but not its still-deleted reply
+    Post.query.get(a.id).deleted = False
+    db.session.commit()
+    assert Post.query.get(root.id).reply_count == 2
+    assert verify_threads() == []
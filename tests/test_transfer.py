@@ -0,0 +1,243 @@
+import hashlib
+import threading
+import time
+
+import pytest
+from werkzeug.serving import make_server
+
+from db import connect, init_db, log_change
+from openbbs import create_app, db
+from sync import SyncEngine
+from transfer import (
+    DATA_FRAME,
+    RadioReceiver,
+    RadioSender,
+    TransferStore,
+    build_manifest,
+    download,
+    upload,
+)
+
+
+@pytest.fixture
+def app_ctx(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    app = create_app(
+        {
+            "DB_PATH": str(tmp_path / "server.db"),
+            "TESTING": True,
+            "ENCRYPTION_KEY_PATH": str(tmp_path / "encryption.key"),
+            "UPLOAD_FOLDER": str(tmp_path / "uploads"),
+        }
+    )
+    with app.app_context():
+        db.create_all()
+        yield app
+        if "sync_jobs" in app.extensions:
+            app.extensions["sync_jobs"].shutdown()
+
+
+@pytest.fixture
+def client(app_ctx):
+    return app_ctx.test_client()
+
+
+def make_package(tmp_path, messages=300):
+    db_path = str(tmp_path / "src.db")
+    init_db(db_path)
+    conn = connect(db_path)
+    conn.execute("INSERT INTO threads (id, title, created_at, updated_at) VALUES ('t1','Net','2023-01-01','2023-01-01')")
+    for i in range(messages):
+        # digests keep the package from compressing to a single chunk
+        body = hashlib.sha256(str(i).encode()).hexdigest()
+        conn.execute(
+            "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+            (f"m{i}", "t1", "2023-01-01T00:00:00", "2023-01-01T00:00:00", "W1AW", body),
+        )
+        log_change(conn, "message", f"m{i}")
+    conn.commit()
+    engine = SyncEngine(db_path, blob_root=tmp_path / "src-blobs")
+    return engine.pull(output_path=str(tmp_path / "p.tar.zst"))
+
+
+def wait(client, job):
+    for _ in range(200):
+        status = client.get(f"/api/sync/jobs/{job['id']}").get_json()
+        if status["state"] in ("done", "failed"):
+            return status
+        time.sleep(0.02)
+    raise AssertionError("job did not finish")
+
+
+def put_chunk(client, manifest, index, data):
+    start = index * manifest["chunk_size"]
+    return client.put(
+        f"/api/sync/uploads/{manifest['id']}",
+        data=data,
+        headers={"Content-Range": f"bytes {start}-{start + len(data) - 1}/{manifest['size']}"},
+    )
+
+
+def test_upload_resumes_after_interruption(tmp_path, client):
+    path = make_package(tmp_path)
+    manifest = build_manifest(path, chunk_size=1024)
+    chunks = [open(path, "rb").read()[i * 1024 : (i + 1) * 1024] for i in range(len(manifest["chunks"]))]
+    assert len(chunks) > 4
+    status = client.post("/api/sync/uploads", json=manifest).get_json()
+    assert status["missing"] == list(range(len(chunks)))
+    for index in range(3):
+        put_chunk(client, manifest, index, chunks[index])
+    # the link drops; a corrupt chunk is rejected and not marked received
+    assert put_chunk(client, manifest, 3, b"x" * len(chunks[3])).status_code == 422
+    status = client.post("/api/sync/uploads", json=manifest).get_json()
+    assert status["missing"] == list(range(3, len(chunks)))
+    for index in status["missing"]:
+        resp = put_chunk(client, manifest, index, chunks[index])
+    # the import runs as a background job
+    assert resp.status_code == 202
+    assert wait(client, resp.get_json()["job"])["state"] == "done"
+    status = client.get(f"/api/sync/uploads/{manifest['id']}").get_json()
+    assert status["complete"] and status["imported"]
+    assert status["import"]["messages"] == 300
+    # the imported package is deleted; the transfer keeps its outcome
+    assert not list((tmp_path / "uploads" / "transfers").iterdir())
+
+
+def test_incoming_transfers_expire(tmp_path):
+    store = TransferStore(str(tmp_path / "t.db"), tmp_path / "transfers")
+    path = make_package(tmp_path, messages=20)
+    manifest = build_manifest(path, chunk_size=1024)
+    store.begin(manifest)
+    store.write_chunk(manifest["id"], 0, open(path, "rb").read(1024))
+    assert (tmp_path / "transfers" / f"{manifest['id']}.part").exists()
+    assert store.expire(3600, "in") == 0
+    assert store.expire(-1, "in") == 1
+    assert not list((tmp_path / "transfers").iterdir())
+    with pytest.raises(KeyError):
+        store.status(manifest["id"])
+
+
+def test_oversized_uploads_refused(tmp_path, app_ctx, client):
+    app_ctx.config["SYNC_MAX_PACKAGE"] = 1 << 20
+    digest = "0" * 64
+    huge = {"id": digest, "size": 10**13, "chunk_size": 10**13, "chunks": [digest]}
+    resp = client.post("/api/sync/uploads", json=huge)
+    assert resp.status_code == 400 and "limit" in resp.get_json()["error"]
+    wide = dict(huge, size=4 << 20, chunk_size=4 << 20)
+    assert client.post("/api/sync/uploads", json=wide).status_code == 400
+    assert not list((tmp_path / "uploads").rglob("*.part"))
+    # a chunk body longer than the manifest's chunk size is not read
+    manifest = build_manifest(make_package(tmp_path, messages=20), chunk_size=1024)
+    client.post("/api/sync/uploads", json=manifest)
+    resp = client.put(f"/api/sync/uploads/{manifest['id']}", data=b"x" * 2048,
+                      headers={"Content-Range": "bytes 0-2047/*"})
+    assert resp.status_code == 413
+
+
+def test_failed_import_runs_again_on_resume(tmp_path, client, monkeypatch):
+    from openbbs.sync_api import get_engine
+
+    engine = get_engine()
+    push = engine.push
+    calls = []
+
+    def flaky_push(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        return push(*args, **kwargs)
+
+    monkeypatch.setattr(engine, "push", flaky_push)
+    path = make_package(tmp_path, messages=20)
+    manifest = build_manifest(path, chunk_size=1024)
+    data = open(path, "rb").read()
+    client.post("/api/sync/uploads", json=manifest)
+    for index in range(len(manifest["chunks"])):
+        resp = put_chunk(client, manifest, index, data[index * 1024 : (index + 1) * 1024])
+    assert wait(client, resp.get_json()["job"])["state"] == "failed"
+    status = client.get(f"/api/sync/uploads/{manifest['id']}").get_json()
+    assert status["complete"] and not status["imported"]
+    assert status["import_error"] == "database is locked"
+    # the sender resumes with nothing left to send; the import runs again
+    resp = client.post("/api/sync/uploads", json=manifest)
+    assert wait(client, resp.get_json()["job"])["state"] == "done"
+    status = client.get(f"/api/sync/uploads/{manifest['id']}").get_json()
+    assert status["imported"] and status["import"]["messages"] == 20
+    assert status["import_error"] is None
+    assert client.post("/api/sync/uploads", json=manifest).get_json()["imported"]
+    assert len(calls) == 2
+
+
+def test_download_serves_ranges(tmp_path, app_ctx, client):
+    resp = client.post("/api/sync/downloads", json={"chunk_size": 64})
+    assert resp.status_code == 202
+    manifest = wait(client, resp.get_json())["result"]
+    assert manifest.pop("cursor") == 0
+    url = f"/api/sync/downloads/{manifest['id']}"
+    whole = client.get(url).data
+    assert hashlib.sha256(whole).hexdigest() == manifest["id"]
+    resp = client.get(url, headers={"Range": "bytes=64-127"})
+    assert resp.status_code == 206
+    assert hashlib.sha256(resp.data).hexdigest() == manifest["chunks"][1]
+    assert client.get(f"{url}/manifest").get_json() == manifest
+    # packages built for downloads are deleted once they expire
+    store = TransferStore(app_ctx.config["DB_PATH"], tmp_path / "uploads" / "transfers")
+    source = store.source(manifest["id"])
+    assert source.exists()
+    assert store.expire(-1) == 1
+    assert not source.exists()
+
+
+def test_http_client_round_trip(tmp_path, app_ctx):
+    server = make_server("127.0.0.1", 0, app_ctx, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}"
+        path = make_package(tmp_path)
+        status = upload(url, path, chunk_size=1024)
+        assert status["complete"] and status["import"]["messages"] == 300
+        # a second upload of the same package has nothing left to send
+        assert upload(url, path, chunk_size=1024)["missing"] == []
+
+        store = TransferStore(str(tmp_path / "client.db"), tmp_path / "client-transfers")
+        tid, pkg = download(url, store, chunk_size=1024)
+        assert store.status(tid)["complete"]
+        assert build_manifest(pkg, 1024) == store.manifest(tid, "in")
+    finally:
+        server.shutdown()
+
+
+def exchange(sender, receiver, drop_after=None):
+    """Pass frames both ways until done; return the data frames sent."""
+    to_receiver, sent, data_frames = sender.start(), 0, 0
+    while to_receiver and not sender.done:
+        to_sender = []
+        for frame in to_receiver:
+            if drop_after is not None and sent >= drop_after:
+                return data_frames
+            sent += 1
+            data_frames += frame[:1] == DATA_FRAME
+            to_sender += receiver.handle(frame)
+        to_receiver = [f for reply in to_sender for f in sender.handle(reply)]
+    return data_frames
+
+
+def test_radio_transfer_resumes(tmp_path):
+    path = make_package(tmp_path)
+    sending = TransferStore(str(tmp_path / "a.db"), tmp_path / "a")
+    tid = sending.offer(path, chunk_size=1024)["id"]
+    receiving = TransferStore(str(tmp_path / "b.db"), tmp_path / "b")
+    done = []
+
+    first = exchange(RadioSender(sending, tid), RadioReceiver(receiving), drop_after=30)
+    assert first and receiving.missing(tid)
+    # a new session (both ends restarted) sends only what was lost
+    sender = RadioSender(sending, tid)
+    second = exchange(sender, RadioReceiver(receiving, lambda t, p: done.append(p)))
+    assert sender.done
+    assert open(done[0], "rb").read() == open(path, "rb").read()
+
+    fresh = TransferStore(str(tmp_path / "c.db"), tmp_path / "c")
+    full = exchange(RadioSender(sending, tid), RadioReceiver(fresh))
+    assert second < full
@@ -0,0 +1,59 @@
+import random
+
+import pytest
+
+from compression import dictionary_bytes, get_dictionary, import_dictionary, train_dictionary
+from db import connect, init_db, log_change
+from radio import compress_frame, decompress_frame
+from sync import SyncEngine
+
+CALLS = ["W1AW", "K1ABC", "N0CALL", "VE3XYZ", "G4ABC"]
+
+
+def setup_db(tmp_path, name, messages=0):
+    db_path = str(tmp_path / f"{name}.db")
+    init_db(db_path)
+    conn = connect(db_path)
+    rng = random.Random(1)
+    conn.execute("INSERT INTO threads (id, title, created_at, updated_at) VALUES ('t1','Net','2023-01-01','2023-01-01')")
+    for i in range(messages):
+        ts = f"2023-01-01T{i // 60 % 24:02d}:{i % 60:02d}:00"
+        conn.execute(
+            "INSERT INTO messages (id, thread_id, timestamp, updated_at, author, body) VALUES (?,?,?,?,?,?)",
+            (f"m{i}", "t1", ts, ts, rng.choice(CALLS),
+             f"{rng.choice(CALLS)} de {rng.choice(CALLS)} check in {i} signal report 5{rng.randint(1, 9)}9 73"),
+        )
+        log_change(conn, "message", f"m{i}")
+    conn.commit()
+    return db_path, SyncEngine(db_path, blob_root=tmp_path / f"{name}-blobs")
+
+
+def test_dictionary_package_round_trip(tmp_path):
+    src, engine = setup_db(tmp_path, "src", messages=400)
+    dst, peer = setup_db(tmp_path, "dst")
+    dict_id = train_dictionary(src, size=4096)
+    pkg = engine.pull(thread_ids=["t1"], output_path=str(tmp_path / "p.tar.zst"), dict_id=dict_id)
+    with pytest.raises(KeyError):
+        peer.push(pkg)
+    assert import_dictionary(dst, dictionary_bytes(src, dict_id)) == dict_id
+    assert peer.push(pkg)["messages"] == 400
+
+
+def test_long_distance_package(tmp_path):
+    src, engine = setup_db(tmp_path, "src", messages=50)
+    dst, peer = setup_db(tmp_path, "dst")
+    pkg = engine.pull(output_path=str(tmp_path / "p.tar.zst"), level=19, long_distance=True)
+    assert peer.push(pkg)["messages"] == 50
+
+
+def test_radio_frame_compression_with_dictionary(tmp_path):
+    src, _ = setup_db(tmp_path, "src", messages=400)
+    zdict = get_dictionary(src, train_dictionary(src, size=4096))
+    payload = b"W1AW de K1ABC check in 7 signal report 599 73"
+    plain = compress_frame(payload)
+    framed = compress_frame(payload, zdict)
+    assert len(framed) < len(plain)
+    assert decompress_frame(framed, {zdict.dict_id(): zdict}) == payload
+    assert decompress_frame(plain) == payload
+    with pytest.raises(ValueError):
+        decompress_frame(framed)
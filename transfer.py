@@ -0,0 +1,616 @@
+"""Resumable, chunked transfer of sync packages over HTTP and radio.
+
+A package is cut into fixed-size chunks, each named by its SHA-256, and
+described by a manifest::
+
+    {"id": <sha256 of the package>, "size": N, "chunk_size": C, "chunks": [<sha256>, ...]}
+
+The transfer id is the digest of the whole package, so sending the same
+package again resumes the earlier attempt.  The receiver keeps a bitmap of
+verified chunks in ``transfers`` and the partial package under
+``uploads/transfers``; after an interruption it reports what it still
+lacks and only those chunks are sent again.  The outcome of importing a
+complete package is recorded on the transfer too, so an import that failed
+is run again when the sender resumes.
+
+Over HTTP, chunks travel as ``Content-Range`` uploads to
+``/api/sync/uploads/<id>`` and ``Range`` downloads from
+``/api/sync/downloads/<id>`` (see :func:`upload` and :func:`download`).
+The node builds download packages and imports uploads in background jobs,
+which the client polls.
+Over the radio, :class:`RadioSender` and :class:`RadioReceiver` cut the
+same messages into frames that fit one ARQ chunk.
+"""
+import hashlib
+import json
+import os
+import struct
+import time
+import urllib.request
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import metrics
+from db import ensure_schema, get_conn
+
+CHUNK_SIZE = 64 * 1024
+# largest package and chunk a node agrees to receive
+MAX_PACKAGE_SIZE = 1024 * 1024 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+# on the air a lost chunk costs minutes, so keep them small
+RADIO_CHUNK_SIZE = 4 * 1024
+# SlidingWindowARQ sends payloads in 256-byte chunks
+RADIO_MTU = 256
+HTTP_TIMEOUT = 60
+# seconds between polls of a node's background job
+JOB_POLL = 0.5
+
+RETRANSMITTED = metrics.counter(
+    'radio_frames_retransmitted_total', 'Radio transfer frames sent again', ('kind',)
+)
+
+
+def build_manifest(path, chunk_size=CHUNK_SIZE):
+    """Return the manifest of the package at *path*."""
+    whole = hashlib.sha256()
+    chunks = []
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            whole.update(data)
+            chunks.append(hashlib.sha256(data).hexdigest())
+            size += len(data)
+    return {'id': whole.hexdigest(), 'size': size, 'chunk_size': chunk_size, 'chunks': chunks}
+
+
+def missing_chunks(bitmap, count):
+    """Return the indexes of the chunks whose bit is clear in *bitmap*."""
+    return [i for i in range(count) if not bitmap[i >> 3] & (1 << (i & 7))]
+
+
+def _is_digest(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+class TransferStore:
+    """Transfer state in ``transfers`` plus package files under *root*.
+
+    Outgoing transfers (``offer``/``read_chunk``) point at a finished
+    package; incoming ones (``begin``/``write_chunk``) are assembled in
+    ``<root>/<id>.part`` and renamed to ``<id>.pkg`` once every chunk has
+    been verified.  Incoming packages larger than *max_size* bytes are
+    refused.
+    """
+
+    def __init__(self, db_path, root=None, max_size=MAX_PACKAGE_SIZE):
+        self.db_path = str(db_path)
+        self.root = Path(root or Path('uploads') / 'transfers')
+        self.max_size = max_size
+        ensure_schema(self.db_path)
+
+    def _conn(self):
+        return get_conn(self.db_path)
+
+    def _row(self, tid, direction):
+        row = self._conn().execute(
+            "SELECT * FROM transfers WHERE transfer_id=? AND direction=?", (tid, direction)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f'unknown transfer {tid}')
+        return row
+
+    def _owned(self, path):
+        # packages built for sending live directly under the root
+        return Path(path).resolve().parent == self.root.resolve()
+
+    def offer(self, path, chunk_size=CHUNK_SIZE, peer=None):
+        """Register the package at *path* for sending and return its manifest."""
+        manifest = build_manifest(path, chunk_size)
+        count = len(manifest['chunks'])
+        now = datetime.utcnow().isoformat()
+        conn = self._conn()
+        old = conn.execute(
+            "SELECT path FROM transfers WHERE transfer_id=? AND direction='out'", (manifest['id'],)
+        ).fetchone()
+        if old is not None and old['path'] != str(path) and self._owned(old['path']):
+            # an identical package was built before; keep only the new copy
+            Path(old['path']).unlink(missing_ok=True)
+        conn.execute(
+            """INSERT OR REPLACE INTO transfers (transfer_id, direction, size, chunk_size,
+            chunks, bitmap, path, peer, created_at, completed_at)
+            VALUES (?, 'out', ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (manifest['id'], manifest['size'], chunk_size, json.dumps(manifest['chunks']),
+             b'\xff' * ((count + 7) // 8), str(path), peer, now, now)
+        )
+        conn.commit()
+        return manifest
+
+    def manifest(self, tid, direction='out'):
+        row = self._row(tid, direction)
+        return {
+            'id': tid,
+            'size': row['size'],
+            'chunk_size': row['chunk_size'],
+            'chunks': json.loads(row['chunks']),
+        }
+
+    def read_chunk(self, tid, index):
+        """Return chunk *index* of outgoing transfer *tid*."""
+        row = self._row(tid, 'out')
+        if not 0 <= index * row['chunk_size'] < row['size']:
+            raise ValueError(f'chunk {index} out of range')
+        with open(row['path'], 'rb') as f:
+            f.seek(index * row['chunk_size'])
+            return f.read(row['chunk_size'])
+
+    def source(self, tid):
+        """Return the package file of outgoing transfer *tid*."""
+        return Path(self._row(tid, 'out')['path'])
+
+    def find(self, prefix, direction='in'):
+        """Return the id of the transfer whose id starts with hex *prefix*."""
+        row = self._conn().execute(
+            "SELECT transfer_id FROM transfers WHERE direction=? AND transfer_id LIKE ?",
+            (direction, prefix + '%')
+        ).fetchone()
+        if row is None:
+            raise KeyError(f'unknown transfer {prefix}')
+        return row['transfer_id']
+
+    def begin(self, manifest, peer=None):
+        """Start or resume receiving *manifest*; return the missing chunk indexes.
+
+        Raises ``ValueError`` for a malformed manifest, one whose package or
+        chunks are larger than this store accepts, or one that differs from
+        the transfer already in progress under the same id.
+        """
+        try:
+            tid = manifest['id']
+            size = int(manifest['size'])
+            chunk_size = int(manifest['chunk_size'])
+            chunks = list(manifest['chunks'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('malformed manifest') from None
+        if (
+            not _is_digest(tid)
+            or chunk_size <= 0
+            or size <= 0
+            or len(chunks) != -(-size // chunk_size)
+            or not all(_is_digest(c) for c in chunks)
+        ):
+            raise ValueError('malformed manifest')
+        if size > self.max_size:
+            raise ValueError(f'package of {size} bytes exceeds the {self.max_size} byte limit')
+        if chunk_size > MAX_CHUNK_SIZE:
+            raise ValueError(f'chunks of {chunk_size} bytes exceed the {MAX_CHUNK_SIZE} byte limit')
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT chunks FROM transfers WHERE transfer_id=? AND direction='in'", (tid,)
+        ).fetchone()
+        if row is not None:
+            if json.loads(row['chunks']) != chunks:
+                raise ValueError(f'manifest does not match transfer {tid}')
+            return self.missing(tid)
+        self.root.mkdir(parents=True, exist_ok=True)
+        part = self.root / f'{tid}.part'
+        with open(part, 'wb') as f:
+            f.truncate(size)
+        conn.execute(
+            """INSERT INTO transfers (transfer_id, direction, size, chunk_size, chunks,
+            bitmap, path, peer, created_at)
+            VALUES (?, 'in', ?, ?, ?, ?, ?, ?, ?)""",
+            (tid, size, chunk_size, json.dumps(chunks), bytes((len(chunks) + 7) // 8),
+             str(part), peer, datetime.utcnow().isoformat())
+        )
+        conn.commit()
+        return list(range(len(chunks)))
+
+    def missing(self, tid):
+        row = self._row(tid, 'in')
+        return missing_chunks(row['bitmap'], len(json.loads(row['chunks'])))
+
+    def status(self, tid):
+        row = self._row(tid, 'in')
+        chunks = json.loads(row['chunks'])
+        return {
+            'id': tid,
+            'size': row['size'],
+            'chunks': len(chunks),
+            'missing': missing_chunks(row['bitmap'], len(chunks)),
+            'complete': row['completed_at'] is not None,
+            'imported': row['imported_at'] is not None,
+            'import': json.loads(row['import_result']) if row['import_result'] else None,
+            'import_error': row['import_error'],
+            'peer': row['peer'],
+        }
+
+    def record_import(self, tid, summary=None, error=None):
+        """Record the import *summary* of incoming transfer *tid*, or the *error* it raised.
+
+        Once imported the package is deleted; the transfer stays on record
+        so a sender resuming it learns the outcome.
+        """
+        conn = self._conn()
+        conn.execute(
+            """UPDATE transfers SET imported_at=?, import_result=?, import_error=?
+            WHERE transfer_id=? AND direction='in'""",
+            (None if error else datetime.utcnow().isoformat(),
+             None if error else json.dumps(summary), error, tid)
+        )
+        conn.commit()
+        if error is None:
+            Path(self._row(tid, 'in')['path']).unlink(missing_ok=True)
+
+    def bitmap(self, tid):
+        return bytes(self._row(tid, 'in')['bitmap'])
+
+    def write_chunk(self, tid, index, data):
+        """Store chunk *index* of incoming transfer *tid*.
+
+        Returns True once every chunk has arrived and the package has been
+        assembled.  Raises ``ValueError`` if *data* does not match the
+        manifest, so a corrupt chunk is simply requested again.
+        """
+        row = self._row(tid, 'in')
+        chunks = json.loads(row['chunks'])
+        if not 0 <= index < len(chunks):
+            raise ValueError(f'chunk {index} out of range')
+        if hashlib.sha256(data).hexdigest() != chunks[index]:
+            raise ValueError(f'chunk {index} does not match its digest')
+        if row['completed_at']:
+            return True
+        with open(row['path'], 'r+b') as f:
+            f.seek(index * row['chunk_size'])
+            f.write(data)
+        conn = self._conn()
+        # other requests may be writing chunks of the same transfer
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = self._row(tid, 'in')
+            bitmap = bytearray(current['bitmap'])
+            bitmap[index >> 3] |= 1 << (index & 7)
+            conn.execute(
+                "UPDATE transfers SET bitmap=? WHERE transfer_id=? AND direction='in'",
+                (bytes(bitmap), tid)
+            )
+            complete = not missing_chunks(bitmap, len(chunks))
+            if complete and not current['completed_at']:
+                self._assemble(conn, current)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return complete
+
+    def _assemble(self, conn, row):
+        tid = row['transfer_id']
+        part = Path(row['path'])
+        h = hashlib.sha256()
+        with open(part, 'rb') as f:
+            for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(data)
+        if h.hexdigest() != tid:
+            raise ValueError(f'assembled package does not match transfer {tid}')
+        final = part.with_suffix('.pkg')
+        os.replace(part, final)
+        conn.execute(
+            "UPDATE transfers SET path=?, completed_at=? WHERE transfer_id=? AND direction='in'",
+            (str(final), datetime.utcnow().isoformat(), tid)
+        )
+
+    def path(self, tid):
+        """Return the assembled package of a completed incoming transfer."""
+        row = self._row(tid, 'in')
+        if not row['completed_at']:
+            raise KeyError(f'transfer {tid} is incomplete')
+        return Path(row['path'])
+
+    def pending(self, peer=None):
+        """Return the ids of incomplete incoming transfers, oldest first."""
+        query = "SELECT transfer_id FROM transfers WHERE direction='in' AND completed_at IS NULL"
+        params = []
+        if peer is not None:
+            query += " AND peer=?"
+            params.append(peer)
+        rows = self._conn().execute(query + " ORDER BY created_at", params).fetchall()
+        return [r['transfer_id'] for r in rows]
+
+    def expire(self, max_age, direction='out'):
+        """Forget transfers in *direction* started more than *max_age* seconds ago.
+
+        Incoming packages, finished or abandoned, are deleted with them, as
+        are outgoing packages this store built under its root; packages
+        offered from elsewhere belong to the caller.
+        """
+        cutoff = (datetime.utcnow() - timedelta(seconds=max_age)).isoformat()
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT transfer_id, path FROM transfers WHERE direction=? AND created_at<?",
+            (direction, cutoff)
+        ).fetchall()
+        for row in rows:
+            if direction == 'in' or self._owned(row['path']):
+                Path(row['path']).unlink(missing_ok=True)
+        conn.executemany(
+            "DELETE FROM transfers WHERE transfer_id=? AND direction=?",
+            [(row['transfer_id'], direction) for row in rows]
+        )
+        conn.commit()
+        return len(rows)
+
+
+# ---- HTTP client ----
+
+def _request(url, data=None, method=None, headers=None):
+    req = urllib.request.Request(url, data=data, method=method, headers=headers or {})
+    with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT) as resp:
+        return resp.read(), resp.headers
+
+
+def _wait(base_url, job):
+    """Poll the node's sync *job* until it is done or failed; return its final state."""
+    while job['state'] not in ('done', 'failed'):
+        time.sleep(JOB_POLL)
+        body, _ = _request(f"{base_url}/api/sync/jobs/{job['id']}")
+        job = json.loads(body)
+    return job
+
+
+def upload(base_url, path, chunk_size=CHUNK_SIZE, peer=None):
+    """Send the package at *path* to the node at *base_url*.
+
+    The server answers the manifest with the chunks it still lacks, so
+    calling this again after an interruption resumes.  Returns the
+    server's final status, including the import summary.
+    """
+    base_url = base_url.rstrip('/')
+    manifest = build_manifest(path, chunk_size)
+    body, _ = _request(
+        f'{base_url}/api/sync/uploads',
+        json.dumps(dict(manifest, peer=peer)).encode(),
+        headers={'Content-Type': 'application/json'},
+    )
+    status = json.loads(body)
+    with open(path, 'rb') as f:
+        for index in status['missing']:
+            start = index * chunk_size
+            f.seek(start)
+            data = f.read(chunk_size)
+            body, _ = _request(
+                f"{base_url}/api/sync/uploads/{manifest['id']}",
+                data,
+                'PUT',
+                {'Content-Range': f"bytes {start}-{start + len(data) - 1}/{manifest['size']}"},
+            )
+            status = json.loads(body)
+    if status.get('job'):
+        # the node imports the package in the background
+        _wait(base_url, status['job'])
+        body, _ = _request(f"{base_url}/api/sync/uploads/{manifest['id']}")
+        status = json.loads(body)
+    return status
+
+
+def download(base_url, store, tid=None, **options):
+    """Fetch a package from the node at *base_url* into *store*.
+
+    Without *tid* the server builds a new package from the pull *options*
+    (``cursor``, ``peer``, ``format``...); with it, an earlier download is
+    resumed.  Returns ``(tid, path)`` once the package is complete.
+    """
+    base_url = base_url.rstrip('/')
+    if tid is None:
+        body, _ = _request(
+            f'{base_url}/api/sync/downloads',
+            json.dumps(options).encode(),
+            headers={'Content-Type': 'application/json'},
+        )
+        job = _wait(base_url, json.loads(body))
+        if job['state'] == 'failed':
+            raise IOError(f"package build failed: {job['error']}")
+        manifest = job['result']
+    else:
+        body, _ = _request(f'{base_url}/api/sync/downloads/{tid}/manifest')
+        manifest = json.loads(body)
+    tid = manifest['id']
+    chunk_size = manifest['chunk_size']
+    for index in store.begin(manifest, peer=base_url):
+        start = index * chunk_size
+        end = min(start + chunk_size, manifest['size']) - 1
+        data, _ = _request(
+            f'{base_url}/api/sync/downloads/{tid}', headers={'Range': f'bytes={start}-{end}'}
+        )
+        store.write_chunk(tid, index, data)
+    return tid, store.path(tid)
+
+
+# ---- radio ----
+#
+# frame = kind:1 id:8 index:u32 offset:u32 total:u32 data
+#
+# A message of *total* bytes is split across frames by offset and handed
+# on once every byte has arrived.  ``M`` carries a manifest, ``D`` one
+# chunk, ``S`` the receiver's bitmap (empty if it does not know the
+# transfer) and ``Q`` asks for an ``S``.
+
+_FRAME = struct.Struct('>c8sIII')
+MANIFEST_FRAME = b'M'
+DATA_FRAME = b'D'
+STATUS_FRAME = b'S'
+QUERY_FRAME = b'Q'
+
+
+def radio_frames(kind, tid, index, data, mtu=RADIO_MTU):
+    """Split message *data* into frames of at most *mtu* bytes."""
+    room = mtu - _FRAME.size
+    prefix = bytes.fromhex(tid[:16])
+    if not data:
+        return [_FRAME.pack(kind, prefix, index, 0, 0)]
+    return [
+        _FRAME.pack(kind, prefix, index, offset, len(data)) + data[offset:offset + room]
+        for offset in range(0, len(data), room)
+    ]
+
+
+class _Reassembler:
+    def __init__(self):
+        self.partial = {}
+
+    def add(self, frame):
+        """Return ``(kind, prefix, index, data)`` once a message is whole."""
+        if len(frame) < _FRAME.size:
+            return None
+        kind, prefix, index, offset, total = _FRAME.unpack_from(frame)
+        data = frame[_FRAME.size:]
+        if offset + len(data) > total:
+            return None
+        if total == 0:
+            return kind, prefix.hex(), index, b''
+        key = (kind, prefix, index)
+        parts = self.partial.setdefault(key, {})
+        parts[offset] = data
+        if sum(len(p) for p in parts.values()) < total:
+            return None
+        del self.partial[key]
+        return kind, prefix.hex(), index, b''.join(parts[o] for o in sorted(parts))
+
+
+class RadioReceiver:
+    """Receiving end of a radio transfer.
+
+    Feed every frame to :meth:`handle` and send back the frames it returns.
+    Progress lives in *store*, so a receiver created after a restart
+    carries on with the same transfer.  *on_complete* is called with the
+    transfer id and package path when a package is whole.
+    """
+
+    def __init__(self, store, on_complete=None, peer=None, mtu=RADIO_MTU):
+        self.store = store
+        self.on_complete = on_complete
+        self.peer = peer
+        self.mtu = mtu
+        self.frames = _Reassembler()
+
+    def _status(self, tid):
+        return radio_frames(STATUS_FRAME, tid, 0, self.store.bitmap(tid), self.mtu)
+
+    def handle(self, frame):
+        message = self.frames.add(frame)
+        if message is None:
+            return []
+        kind, prefix, index, data = message
+        if kind == MANIFEST_FRAME:
+            try:
+                manifest = json.loads(data)
+                self.store.begin(manifest, self.peer)
+            except ValueError:
+                return []
+            return self._status(manifest['id'])
+        try:
+            tid = self.store.find(prefix)
+        except KeyError:
+            # unknown transfer: ask the sender for its manifest
+            return radio_frames(STATUS_FRAME, prefix, 0, b'', self.mtu)
+        if kind == QUERY_FRAME:
+            return self._status(tid)
+        if kind == DATA_FRAME:
+            try:
+                complete = self.store.write_chunk(tid, index, data)
+            except ValueError:
+                return []
+            if complete:
+                if self.on_complete:
+                    self.on_complete(tid, self.store.path(tid))
+                return self._status(tid)
+        return []
+
+
+class RadioSender:
+    """Sending end of a radio transfer of outgoing transfer *tid*.
+
+    Send the frames from :meth:`start`, then pass every received frame to
+    :meth:`handle` and send what it returns, until :attr:`done`.
+    """
+
+    def __init__(self, store, tid, mtu=RADIO_MTU):
+        self.store = store
+        self.tid = tid
+        self.mtu = mtu
+        self.manifest = store.manifest(tid)
+        self.frames = _Reassembler()
+        self.done = False
+        self._started = False
+        self._sent = set()
+
+    def start(self):
+        data = json.dumps(self.manifest, separators=(',', ':')).encode()
+        frames = radio_frames(MANIFEST_FRAME, self.tid, 0, data, self.mtu)
+        if self._started:
+            RETRANSMITTED.labels('manifest').inc(len(frames))
+        self._started = True
+        return frames
+
+    def handle(self, frame):
+        message = self.frames.add(frame)
+        if message is None:
+            return []
+        kind, prefix, _, bitmap = message
+        if kind != STATUS_FRAME or not self.tid.startswith(prefix):
+            return []
+        if not bitmap:
+            return self.start()
+        missing = missing_chunks(bitmap, len(self.manifest['chunks']))
+        if not missing:
+            self.done = True
+            return []
+        out = []
+        for index in missing:
+            frames = radio_frames(DATA_FRAME, self.tid, index, self.store.read_chunk(self.tid, index), self.mtu)
+            if index in self._sent:
+                RETRANSMITTED.labels('data').inc(len(frames))
+            self._sent.add(index)
+            out += frames
+        return out + radio_frames(QUERY_FRAME, self.tid, 0, b'', self.mtu)
+
+
+def radio_send(arq, store, tid, timeout=60.0):
+    """Send outgoing transfer *tid* over *arq* (a :class:`radio.SlidingWindowARQ`).
+
+    Returns True once the receiver has the whole package, or False if it
+    stays silent for *timeout* seconds; calling again later resumes.
+    """
+    sender = RadioSender(store, tid)
+    frames = sender.start()
+    deadline = time.monotonic() + timeout
+    while not sender.done:
+        for frame in frames:
+            arq.send(frame)
+        frames = []
+        while not frames and not sender.done:
+            if time.monotonic() > deadline:
+                return False
+            data = arq.receive()
+            if data:
+                frames = sender.handle(data)
+                deadline = time.monotonic() + timeout
+    return True
+
+
+def radio_receive(arq, store, timeout=60.0, peer=None):
+    """Receive one package over *arq*; return its path, or None on *timeout*."""
+    done = []
+    receiver = RadioReceiver(store, lambda tid, path: done.append(path), peer)
+    deadline = time.monotonic() + timeout
+    while not done:
+        if time.monotonic() > deadline:
+            return None
+        data = arq.receive()
+        if not data:
+            continue
+        deadline = time.monotonic() + timeout
+        for reply in receiver.handle(data):
+            arq.send(reply)
+    return done[0]